@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Measure the time, memory allocations and SQL queries needed to wrap every hit of a result set.
+
+Usage: benchmark_hit_wrappers.py DB_DATA_PATH [QUERY] [--hits N] [--field FIELD]
+Hits are read the way facets and exports read them: philo_id and bytes only, plus one metadata
+field if --field is given, and kept in memory. Without a query, all objects of the default object
+level are used."""
+
+import sys
+import time
+import tracemalloc
+from optparse import OptionParser
+
+from philologic.runtime.DB import DB
+
+
+def main():
+    parser = OptionParser(usage="%prog DB_DATA_PATH [QUERY] [--hits N] [--field FIELD]")
+    parser.add_option("--hits", type="int", default=100000, help="number of hits to wrap")
+    parser.add_option("--field", default="", help="metadata field to read from each hit")
+    options, args = parser.parse_args()
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+    db = DB(args[0])
+    if len(args) > 1:
+        hits = db.query(args[1])
+    else:
+        hits = db.get_all(db.locals["default_object_level"])
+    hits.finish()
+    queries = [0]
+
+    def count_query(statement):
+        queries[0] += 1
+
+    db.dbh.set_trace_callback(count_query)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    wrapped = []
+    for hit in hits[0 : options.hits]:
+        hit.philo_id, hit.bytes
+        if options.field:
+            hit[options.field]
+        wrapped.append(hit)
+    elapsed = time.perf_counter() - start
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    if not wrapped:
+        print("No hits")
+        return
+    print("hits wrapped: %d" % len(wrapped))
+    print("time per hit: %.2f us" % (elapsed / len(wrapped) * 1e6))
+    print("memory held per hit: %.0f bytes" % (allocated / len(wrapped)))
+    print("SQL queries per hit: %.2f" % (queries[0] / len(wrapped)))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,8 @@ else
   sudo /usr/bin/install -c db/corpus_search /bin/
   sudo /usr/bin/install -c db/pack4 /bin/
 fi
+sudo mkdir -p /usr/local/lib
+sudo /usr/bin/install -c db/libcorpus_search.so /usr/local/lib/
 
 cd ..;
 PYTHON_INSTALL="\n## INSTALLING PYTHON LIBRARY ##"
@@ -6,6 +6,9 @@
 #include "db.h"
 #include "unpack.h"
 
+// exit status of corpus_search when it stopped at its hit limit before the end of the results
+#define EXIT_TRUNCATED 2
+
 typedef struct word_rec {
   char *word;
   int type;
@@ -55,6 +58,9 @@ typedef struct search_stage {
   } data;
 } search_stage;
 
+// set to 0 by in-process callers to silence the per-word diagnostics on stderr
+int corpus_search_verbose = 1;
+
 word_rec * fetch_word(dbh *db, char *word) {
   word_rec rec;
   word_rec *ret;
@@ -213,6 +219,42 @@ uint32_t *word_next_hit(dbh *db, word_rec *rec) {
   }
 }
 
+int prefix_cmp(uint32_t *L, uint32_t *R, int depth) {
+  // compares the first depth fields of two hits
+  int i;
+  for (i = 0; i < depth; i++) {
+    if (L[i] != R[i]) {
+      return L[i] < R[i] ? -1 : 1;
+    }
+  }
+  return 0;
+}
+
+uint32_t *word_seek(dbh *db, word_rec *rec, uint32_t *target, int depth) {
+  // advances rec to its first hit whose first depth fields are not less than target's.
+  // Blocks that end before target are skipped by their header hits without reading them from disk,
+  // so a frequent word only pays for the blocks around the hits of the rarer words it is matched with.
+  while (prefix_cmp(rec->current_hit, target, depth) < 0) {
+    if (rec->type == 1 && rec->block_position > 0 && rec->header_position < rec->block_count
+        && prefix_cmp(rec->next_header, target, depth) < 0) {
+      rec->current_block += 1;
+      rec->block_position = 0;
+    }
+    if (word_next_hit(db, rec) == NULL) {
+      return NULL;
+    }
+  }
+  return rec->current_hit;
+}
+
+void free_word_rec(word_rec *rec) {
+  free(rec->word);
+  bitsvectorOld(rec->header);
+  bitsvectorOld(rec->block);
+  free(rec->current_hit);
+  free(rec->next_header);
+}
+
 word_rec new_word_rec(dbh *db, char *word) {
   word_rec rec;
 
@@ -327,7 +369,7 @@ int sent_cmp(dbh *db, uint32_t *L, uint32_t *R, int arg) {
   
   for (i = 0; i < 6; i++) { //ugly...db has 9 fields, only 7 are good for sorting
     if (L[i] != R[i] ) {
-      fprintf(stderr,"mismatch at %d\n",i);
+      if (corpus_search_verbose) fprintf(stderr,"mismatch at %d\n",i);
       return L[i] < R[i] ? -1 : 1;
     }
   }
@@ -448,7 +490,7 @@ int down_heap(word_heap *heap, int i) {
 void add_record(word_heap *heap, word_rec *rec) {
   /* first make space if needed */
   int i;
-  fprintf(stderr,"heap has %d records\n", heap->rec_count);
+  if (corpus_search_verbose) fprintf(stderr,"heap has %d records\n", heap->rec_count);
   if (heap->rec_count <= heap->rec_alloced) {
     /* should check for success here; running out of memory is a concern */
     heap->records = realloc(heap->records,sizeof(word_rec)*(heap->rec_count+1) );
@@ -465,7 +507,7 @@ void add_record(word_heap *heap, word_rec *rec) {
   /* exchange the new record with it's parent */ 
   //fprintf(stderr, "calling up_heap on new record %d\n", heap->rec_count - 1);
   up_heap(heap,heap->rec_count - 1);
-  fprintf(stderr,"heap order:\n");
+  if (corpus_search_verbose) fprintf(stderr,"heap order:\n");
   //dump_heap(heap);
 }
 
@@ -493,11 +535,11 @@ word_rec * add_word(word_heap *heap, char *word) {
   word_rec *rec = NULL;
   rec = fetch_word(heap->db,word);
   if (rec == NULL) {
-    fprintf(stderr, "%s not found.\n", word);
+    if (corpus_search_verbose) fprintf(stderr, "%s not found.\n", word);
     return NULL;
   }
   else {
-    fprintf(stderr, "%s has %lld occurrences.\n", word, rec->freq);
+    if (corpus_search_verbose) fprintf(stderr, "%s has %lld occurrences.\n", word, rec->freq);
     add_record(heap,rec);
     free(rec);
   }
@@ -505,6 +547,7 @@ word_rec * add_word(word_heap *heap, char *word) {
 
 uint32_t * heap_advance(word_heap *heap) {
   word_rec *r;
+  word_rec popped;
   uint32_t *hit;
   if (heap->rec_count == 0) {
     // fprintf(stderr, "stage done\n");
@@ -523,7 +566,9 @@ uint32_t * heap_advance(word_heap *heap) {
     if (hit == NULL) {
 //      fprintf(stderr, "done with word %s, popping\n", heap->current_word);
       // if we are done with the word, pop it off
-      pop_record(heap);
+      popped = pop_record(heap);
+      heap->current_word = NULL;
+      free_word_rec(&popped);
 //      fprintf(stderr, "heap has %d records remaining\n", heap->rec_count);
     } else {
       // otherwise, we've modified the 0 records and may need to move it.
@@ -536,12 +581,32 @@ uint32_t * heap_advance(word_heap *heap) {
   }
 }
 
+uint32_t * heap_seek(word_heap *heap, uint32_t *target, int depth) {
+  // like heap_advance, but first moves every word past the hits that sort before target
+  word_rec rec;
+  int i = 0;
+  while (i < heap->rec_count) {
+    if (word_seek(heap->db, &heap->records[i], target, depth) == NULL) {
+      rec = heap->records[i];
+      heap->records[i] = heap->records[heap->rec_count - 1];
+      heap->rec_count -= 1;
+      free_word_rec(&rec);
+    } else {
+      i += 1;
+    }
+  }
+  for (i = (int)heap->rec_count / 2 - 1; i >= 0; i--) {
+    down_heap(heap, i);
+  }
+  return heap_advance(heap);
+}
+
 uint32_t * corpus_advance(corpus *corpus) {
   // requires that corpus has a readable fh and malloc'd current_hit.  Does not require current_hit to be init'd.
 //  fprintf(stderr, "advancing corpus: ");
   size_t res = fread(corpus->current_hit,sizeof(uint32_t), 7, corpus->fh); // read 1 7-wide hit into current_hit
   if (res < 7) {
-    fprintf(stderr, "READ FAILED %d\n",res);
+    if (corpus_search_verbose) fprintf(stderr, "READ FAILED %d\n",res);
     corpus->current_hit = NULL;
     return NULL;
   } else {
@@ -558,6 +623,23 @@ uint32_t * stage_advance(search_stage * stage) {
   }
 }
 
+uint32_t * stage_seek(search_stage * stage, uint32_t *target, int depth) {
+  // advances a stage that sorts before target, skipping the hits that cannot reach it
+  if (stage->kind == HEAP && prefix_cmp(stage->data.heap.current_hit, target, depth) < 0) {
+    return heap_seek(&stage->data.heap, target, depth);
+  }
+  return stage_advance(stage);
+}
+
+int object_depth(uint32_t *object) {
+  // number of leading non-zero fields of a corpus object id, the fields contains_cmp compares
+  int depth = 0;
+  while (depth < 7 && object[depth] != 0) {
+    depth += 1;
+  }
+  return depth;
+}
+
 uint32_t * stage_current_hit(search_stage * stage) {
   if (stage->kind == CORPUS) {
     return stage->data.corp.current_hit;
@@ -706,7 +788,8 @@ uint32_t * search_advance(search_stage *stages,int size) {
 	//  fprintf(stderr,"pre L-advance: ");
         //dump_search_result_ascii(stderr,stages, size);
       }
-      advance_res = stage_advance(prev);
+      // hits of prev in earlier sentences than curr can no longer match, so skip them all at once
+      advance_res = stage_seek(prev, stage_current_hit(curr), 6);
       if (c > 1) {               // since we've advanced prev, if it is not the innermost hit, we have to check it against it's own prev stage in the next loop cycle
         c -= 1;
       } 
@@ -726,7 +809,11 @@ uint32_t * search_advance(search_stage *stages,int size) {
 
     } else if (check_res > 0) {  // if prev is ahead of curr, advance curr
 //      fprintf(stderr, "advancing R\n");
-      advance_res = stage_advance(curr);
+      if (prev->kind == CORPUS) {
+        advance_res = stage_seek(curr, stage_current_hit(prev), object_depth(stage_current_hit(prev)));
+      } else {
+        advance_res = stage_seek(curr, stage_current_hit(prev), 6);
+      }
     }
   }
 }
@@ -748,6 +835,151 @@ uint32_t * search_advance(search_stage *stages,int size) {
   //       current = current + 1
 
 
+// In-process search API, used by the philologic.runtime.libphilo ctypes bindings.
+// A search is built like corpus_search reads its input: words are added to the current stage,
+// and search_next_stage plays the role of the blank line separating query terms.
+
+typedef struct philo_search {
+  dbh *db;
+  search_stage stages[20];
+  int stage_c;
+  word_heap heap;
+  corpus corp;
+  int (*search_method)(dbh *,uint32_t *,uint32_t *, int);
+  int search_method_arg;
+  int started;
+  int done;
+} philo_search;
+
+philo_search * new_search(dbh *db, char *method, int method_arg, char *corpus_fn) {
+  philo_search *s = calloc(1, sizeof(philo_search));
+  s->db = db;
+  s->search_method = phrase_cmp;
+  s->search_method_arg = 1;
+  if (method != NULL) {
+    if (strcmp(method, "phrase") == 0) s->search_method = phrase_cmp;
+    else if (strcmp(method, "proxy") == 0) s->search_method = proximity_cmp;
+    else if (strcmp(method, "sent") == 0) s->search_method = sent_cmp;
+    else if (strcmp(method, "cooc") == 0) s->search_method = sent_cmp;
+    s->search_method_arg = method_arg;
+  }
+  if (corpus_fn != NULL) {
+    s->corp.fn = malloc(strlen(corpus_fn) + 1);
+    strcpy(s->corp.fn, corpus_fn);
+    s->corp.fh = fopen(s->corp.fn, "r");
+    if (s->corp.fh == NULL) {
+      free(s->corp.fn);
+      free(s);
+      return NULL;
+    }
+    s->corp.current_hit = malloc(7 * sizeof(uint32_t));
+    init_stage_corp(&s->stages[0], &s->corp);
+    s->stage_c = 1;
+  }
+  s->heap = new_heap(db);
+  return s;
+}
+
+int search_add_word(philo_search *s, char *word) {
+  // returns 1 if the word is in the index, 0 otherwise
+  word_rec *rec = fetch_word(s->db, word);
+  if (rec == NULL) {
+    return 0;
+  }
+  add_record(&s->heap, rec);
+  free(rec);
+  return 1;
+}
+
+int search_next_stage(philo_search *s) {
+  if (s->started || s->stage_c + 1 >= 20) {
+    return -1;
+  }
+  init_stage_heap(&s->stages[s->stage_c], &s->heap, s->search_method, s->search_method_arg);
+  s->stage_c += 1;
+  s->heap = new_heap(s->db);
+  return s->stage_c;
+}
+
+int search_hit_width(philo_search *s) {
+  // number of uint32 in a binary hit: sentence prefix and page, then word id and byte per word stage
+  int i;
+  int words = 1;
+  for (i = 0; i < s->stage_c; i++) {
+    if (s->stages[i].kind == HEAP) words += 1;
+  }
+  return 7 + 2 * words;
+}
+
+int search_hits(philo_search *s, uint32_t *buffer, int max_hits) {
+  // writes up to max_hits hits in the binary hitlist format into buffer; returns the number written,
+  // 0 once the search is exhausted.
+  int i;
+  int count = 0;
+  int size;
+  uint32_t *hit;
+  uint32_t *out = buffer;
+  if (!s->started) {
+    init_stage_heap(&s->stages[s->stage_c], &s->heap, s->search_method, s->search_method_arg);
+    s->started = 1;
+  }
+  size = s->stage_c + 1;
+  while (!s->done && count < max_hits) {
+    if (stage_current_hit(&s->stages[s->stage_c]) == NULL) {
+      s->done = 1;
+      break;
+    }
+    if (s->stages[s->stage_c].init == 1) {
+      int first = 1;
+      for (i = 0; i < size; i++) {
+        hit = stage_current_hit(&s->stages[i]);
+        if (s->stages[i].kind == HEAP) {
+          if (first == 1) {
+            memcpy(out, hit, 6 * sizeof(uint32_t));
+            out[6] = hit[8];
+            out += 7;
+            first = 0;
+          }
+          out[0] = hit[6];
+          out[1] = hit[7];
+          out += 2;
+        }
+      }
+      count += 1;
+    }
+    if (search_advance(s->stages, size) == NULL) {
+      s->done = 1;
+    }
+  }
+  return count;
+}
+
+void free_search(philo_search *s) {
+  int i, j;
+  word_heap *heap;
+  for (i = 0; i <= s->stage_c; i++) {
+    if (i == s->stage_c && !s->started) {
+      heap = &s->heap;
+    } else if (s->stages[i].kind == HEAP) {
+      heap = &s->stages[i].data.heap;
+    } else {
+      continue;
+    }
+    for (j = 0; j < heap->rec_count; j++) {
+      free_word_rec(&heap->records[j]);
+    }
+    free(heap->records);
+    free(heap->current_hit);
+  }
+  if (s->corp.fh != NULL) {
+    fclose(s->corp.fh);
+    free(s->corp.fn);
+    free(s->corp.current_hit);
+  }
+  free(s);
+}
+
+#ifndef CORPUS_SEARCH_LIBRARY
 int main(int argc, char **argv) {
 
   char buffer[256];
@@ -770,12 +1002,16 @@ int main(int argc, char **argv) {
   int stage_c = 0;
   corpus corp;
   uint32_t * search_res;
+  int limit = 0; // stop after this many hits, 0 for no limit
+  int first_page = 0; // flush the output once this many hits are written
+  int hit_count = 0;
+  int truncated = 0;
   
   search_method = &phrase_cmp;
   search_method_arg = 1;
   dump_search_result = &dump_search_result_ascii;
 
-  while ((optc = getopt(argc, argv, "c:m:a:o:")) != -1) {
+  while ((optc = getopt(argc, argv, "c:m:a:o:l:p:")) != -1) {
     switch (optc) {
     case 'c': // corpus file
       fprintf(stderr, "corpus '%s'\n", optarg);
@@ -799,6 +1035,14 @@ int main(int argc, char **argv) {
       search_method_arg_str = optarg;
       sscanf(optarg,"%d",  &search_method_arg);
       break;
+    case 'l': // maximum number of hits
+      fprintf(stderr, "limit '%s'\n", optarg);
+      sscanf(optarg,"%d", &limit);
+      break;
+    case 'p': // size of the first page of hits
+      fprintf(stderr, "first page '%s'\n", optarg);
+      sscanf(optarg,"%d", &first_page);
+      break;
     case 'o': // output mode
       fprintf(stderr, "output '%s'\n", optarg);
       output_arg = optarg;
@@ -839,8 +1083,18 @@ int main(int argc, char **argv) {
   while (stage_current_hit(&stages[stage_c]) != NULL) {
     // if this is not the intial stage, print the current hit;
     if (stages[stage_c].init == 1) {
+      if (limit > 0 && hit_count == limit) {
+        // there is at least one more hit: the output is truncated
+        truncated = 1;
+        break;
+      }
       // fprintf(stdout, "MATCH");
       dump_search_result(stdout,stages,stage_c + 1);
+      hit_count += 1;
+      if (hit_count == first_page) {
+        // make the first page readable right away
+        fflush(stdout);
+      }
     }
     search_res = search_advance(stages,stage_c + 1);
     if (search_res == NULL) {
@@ -849,5 +1103,10 @@ int main(int argc, char **argv) {
     }
   }
 
+  if (truncated) {
+    fprintf(stderr, "stopped at %d hits\n", limit);
+    return EXIT_TRUNCATED;
+  }
   return 0;
 }
+#endif
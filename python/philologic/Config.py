@@ -875,6 +875,53 @@ web_config_defaults = OrderedDict(
                 "comment": "# The link should start with http:// or https://. This will display an error report link in the header and in document navigation",
             },
         ),
+        (
+            "hitlist_cache_size",
+            {
+                "value": 1024,
+                "comment": """
+               # The hitlist_cache_size variable sets the disk space in megabytes available to cached search results
+               # in data/hitlists. Results are evicted when the cache grows past this size.""",
+            },
+        ),
+        (
+            "hitlist_cache_policy",
+            {
+                "value": "lru",
+                "comment": """
+               # The hitlist_cache_policy variable sets which cached results get evicted first: "lru" for the least
+               # recently used, "lfu" for the least frequently used.""",
+            },
+        ),
+        (
+            "hitlist_cache_max_age",
+            {
+                "value": 86400,
+                "comment": "# Cached search results unused for more than hitlist_cache_max_age seconds are evicted. Set to 0 to disable.",
+            },
+        ),
+        (
+            "hitlist_cache_sweep_interval",
+            {"value": 300, "comment": "# Minimum number of seconds between two sweeps of the hitlist cache"},
+        ),
+        (
+            "row_cache_size",
+            {
+                "value": 50000,
+                "comment": """
+               # The row_cache_size variable sets how many metadata rows (text objects, pages, lines and words) each
+               # web server process keeps in memory between requests.""",
+            },
+        ),
+        (
+            "collocation_workers",
+            {
+                "value": 4,
+                "comment": """
+               # The collocation_workers variable sets how many processes count collocates in parallel for large
+               # result sets. Set to 1 to count them in the web server process.""",
+            },
+        ),
     ]
 )
 
@@ -5,11 +5,17 @@ import os
 import sqlite3
 import time
 import unicodedata
+from array import array
+from collections import defaultdict
+from json import dump, dumps, loads
 
-from json import loads
-
+from philologic.utils import smash_accents
 from tqdm import tqdm
 
+OBJECT_LEVELS = ("doc", "div1", "div2", "div3", "para")
+INT_NULLS = {"int32": -(1 << 31), "int64": -(1 << 63)}  # null in integer columns of the object index
+MAX_YEAR_SPAN = 100000  # widest range of values of a metadata field indexed by year
+
 
 def make_sql_table(table, file_in, db_file="toms.db", indices=[], depth=7):
     def inner_make_sql_table(loader_obj):
@@ -84,13 +90,57 @@ def normalized_word_frequencies(loader_obj):
     print("%s: Generating normalized word frequencies..." % time.ctime())
     frequencies = loader_obj.destination + "/frequencies"
     output = open(frequencies + "/normalized_word_frequencies", "w")
+    vocabulary = []
     for line in open(frequencies + "/word_frequencies"):
-        word, _ = line.split("\t")
+        word, count = line.split("\t")
         norm_word = word.lower()
         norm_word = [i for i in unicodedata.normalize("NFKD", norm_word) if not unicodedata.combining(i)]
         norm_word = "".join(norm_word)
         print(norm_word + "\t" + word, file=output)
+        vocabulary.append((norm_word.encode("utf8"), word.encode("utf8"), int(count)))
     output.close()
+    write_vocabulary(frequencies, vocabulary)
+
+
+def write_vocabulary(frequencies, vocabulary):
+    """Write the sorted vocabulary used by philologic.runtime.TermIndex for in-process term expansion.
+    vocabulary: norm_word TAB word lines sorted by normalized form
+    vocabulary.offsets: start offset of each line (uint64)
+    vocabulary.counts: corpus frequency of the word of each line (uint64)
+    vocabulary.trigrams: sorted byte trigrams of normalized forms, 3 bytes each
+    vocabulary.trigrams.offsets: start of each trigram's postings (uint64, one extra for the end)
+    vocabulary.trigrams.postings: sorted line numbers containing each trigram (uint32)"""
+    vocabulary.sort()
+    offsets = array("Q")
+    counts = array("Q")
+    trigrams = defaultdict(lambda: array("I"))
+    position = 0
+    with open(frequencies + "/vocabulary", "wb") as output:
+        for line_number, (norm_word, word, count) in enumerate(vocabulary):
+            offsets.append(position)
+            counts.append(count)
+            line = norm_word + b"\t" + word + b"\n"
+            output.write(line)
+            position += len(line)
+            for trigram in set(norm_word[i : i + 3] for i in range(len(norm_word) - 2)):
+                trigrams[trigram].append(line_number)
+    with open(frequencies + "/vocabulary.offsets", "wb") as output:
+        offsets.tofile(output)
+    with open(frequencies + "/vocabulary.counts", "wb") as output:
+        counts.tofile(output)
+    trigram_offsets = array("Q")
+    postings_position = 0
+    with open(frequencies + "/vocabulary.trigrams", "wb") as keys_output, open(
+        frequencies + "/vocabulary.trigrams.postings", "wb"
+    ) as postings_output:
+        for trigram in sorted(trigrams):
+            keys_output.write(trigram)
+            trigram_offsets.append(postings_position)
+            trigrams[trigram].tofile(postings_output)
+            postings_position += len(trigrams[trigram])
+    trigram_offsets.append(postings_position)
+    with open(frequencies + "/vocabulary.trigrams.offsets", "wb") as output:
+        trigram_offsets.tofile(output)
 
 
 def metadata_frequencies(loader_obj):
@@ -140,11 +190,380 @@ def normalized_metadata_frequencies(loader_obj):
             pass
 
 
+def object_index(loader_obj):
+    """Write the per-level object tables used by philologic.runtime.ObjectIndex to data/objects:
+    objects.json: bit widths of packed philo_ids, object counts and sortable fields
+    <level>.keys: packed philo_ids of all objects of a level in document order (uint64)
+    <level>.word_counts: prefix sums of the word counts of those objects, with a leading 0 (uint64)
+    <level>.<field>.ranks: collation rank of the accent-smashed field value, 0 when null (uint32)
+    <level>.doc_offsets: position of the first object of each doc in the level, with the end (uint32)
+    <level>.<column>.int32 or .int64: integer toms column, with the smallest value for nulls
+    <level>.<column>.codes: other toms columns, as codes into the column dictionary, 0 when null (uint32)
+    <level>.<column>.dictionary: JSON encoded values of the codes from 1, one per line, with their
+    start offsets and the end in <level>.<column>.dictionary.offsets (uint64)
+    lines.starts, lines.rowids: start_byte and rowid of the lines sorted by doc_id, start_byte and end_byte
+    lines.max_ends: running maximum of end_byte within each doc (all uint64)
+    lines.doc_offsets: position of the first line of each doc_id, with the end (uint64)
+    years.<field>.word_counts: prefix sums of the word counts of the objects of each year of a field
+    whose values are all integers, from its first year, with a leading 0 (uint64)
+    years.<field>.<philo_type>.counts: prefix sums of the number of objects of a type per year (uint64)
+    words.names: vocabulary id of each row of the words table, in rowid (document) order (uint32)
+    words.vocabulary: JSON encoded words of those ids from 0, one per line, with their start offsets
+    and the end in words.vocabulary.offsets (uint64)
+    words.sentences: position of the first word of each sentence in words.names, with the end (uint64)
+    words.keys: philo_ids of the words packed into 64 bits, sorted (uint64), with their positions in
+    words.names in words.positions (uint64) if the rows are not already in philo_id order"""
+    print("%s: Generating object index..." % time.ctime())
+    destination = loader_obj.destination + "/objects"
+    os.makedirs(destination, exist_ok=True)
+    conn = sqlite3.connect(loader_obj.destination + "/toms.db")
+    cursor = conn.cursor()
+    philo_ids = {}
+    maxima = [0 for _ in OBJECT_LEVELS]
+    for depth, level in enumerate(OBJECT_LEVELS, 1):
+        cursor.execute("SELECT philo_id FROM toms WHERE philo_type=?", (level,))
+        philo_ids[level] = sorted(tuple(int(i) for i in philo_id.split()[:depth]) for philo_id, in cursor)
+        for position, maximum in enumerate(map(max, zip(*philo_ids[level]))):
+            maxima[position] = max(maxima[position], maximum)
+    bits = [max(maximum.bit_length(), 1) for maximum in maxima]
+    if sum(bits) > 64:
+        print("%s: philo_ids are too wide to pack in 64 bits, skipping object index" % time.ctime())
+        conn.close()
+        return
+    shifts = [sum(bits[position + 1 :]) for position in range(len(bits))]
+    for level in OBJECT_LEVELS:
+        keys = array("Q", (sum(i << shift for i, shift in zip(philo_id, shifts)) for philo_id in philo_ids[level]))
+        with open("%s/%s.keys" % (destination, level), "wb") as output:
+            keys.tofile(output)
+
+    word_count_levels = []
+    for depth, level in enumerate(OBJECT_LEVELS, 1):
+        try:
+            cursor.execute("SELECT philo_id, word_count FROM toms WHERE philo_type=?", (level,))
+        except sqlite3.OperationalError:  # loaded without the get_word_counts filter
+            break
+        word_counts = {tuple(int(i) for i in philo_id.split()[:depth]): count for philo_id, count in cursor}
+        prefix_sums = array("Q", [0])
+        for philo_id in philo_ids[level]:
+            prefix_sums.append(prefix_sums[-1] + int(word_counts.get(philo_id) or 0))
+        with open("%s/%s.word_counts" % (destination, level), "wb") as output:
+            prefix_sums.tofile(output)
+        word_count_levels.append(level)
+
+    ranks = {}
+    for field in loader_obj.metadata_fields:
+        if field in loader_obj.metadata_fields_not_found or field not in loader_obj.metadata_types:
+            continue
+        field_type = loader_obj.metadata_types[field]
+        if field_type == "div":
+            levels = ["div1", "div2", "div3"]
+        else:
+            levels = [level for level in OBJECT_LEVELS if level == field_type]
+        if not levels:
+            continue
+        values = {}
+        try:
+            for depth, level in enumerate(OBJECT_LEVELS, 1):
+                if level in levels:
+                    cursor.execute("SELECT philo_id, %s FROM toms WHERE philo_type=?" % field, (level,))
+                    values[level] = {
+                        tuple(int(i) for i in philo_id.split()[:depth]): value for philo_id, value in cursor
+                    }
+        except sqlite3.OperationalError:
+            continue
+        # same collation as the sort of HitList: empty values sort as "ZZZZZ", nulls have no value
+        collation = {"ZZZZZ"}
+        for level in levels:
+            for philo_id, value in values[level].items():
+                if value is not None:
+                    values[level][philo_id] = smash_accents(str(value) or "ZZZZZ")
+                    collation.add(values[level][philo_id])
+        collation = {value: rank for rank, value in enumerate(sorted(collation), 1)}
+        for level in levels:
+            field_ranks = array("I")
+            for philo_id in philo_ids[level]:
+                value = values[level].get(philo_id)
+                field_ranks.append(0 if value is None else collation[value])
+            with open("%s/%s.%s.ranks" % (destination, level, field), "wb") as output:
+                field_ranks.tofile(output)
+        ranks[field] = {"levels": levels, "missing": collation["ZZZZZ"]}
+
+    for level in OBJECT_LEVELS[1:]:
+        doc_offsets = array("I")
+        position = 0
+        for (doc_id,) in philo_ids["doc"]:
+            while position < len(philo_ids[level]) and philo_ids[level][position][0] < doc_id:
+                position += 1
+            doc_offsets.append(position)
+        doc_offsets.append(len(philo_ids[level]))
+        with open("%s/%s.doc_offsets" % (destination, level), "wb") as output:
+            doc_offsets.tofile(output)
+
+    columns = {}
+    for depth, level in enumerate(OBJECT_LEVELS, 1):
+        level_columns = write_columns(cursor, destination, level, depth, philo_ids[level])
+        if level_columns is not None:
+            columns[level] = level_columns
+    lines = write_line_index(cursor, destination)
+    fields = [field for field in loader_obj.metadata_fields if field not in loader_obj.metadata_fields_not_found]
+    years = write_year_index(cursor, destination, fields)
+    words = write_token_stream(cursor, destination)
+    conn.close()
+
+    with open(destination + "/objects.json", "w") as output:
+        dump(
+            {
+                "levels": list(OBJECT_LEVELS),
+                "bits": bits,
+                "counts": {level: len(philo_ids[level]) for level in OBJECT_LEVELS},
+                "word_counts": word_count_levels,
+                "ranks": ranks,
+                "columns": columns,
+                "lines": lines,
+                "years": years,
+                "words": words,
+            },
+            output,
+        )
+
+
+def write_line_index(cursor, destination):
+    """Write the interval index of the lines table used to find the line containing a byte offset.
+    Returns False if the database has no lines or their ids or offsets are not integers."""
+    try:
+        cursor.execute(
+            "SELECT rowid, doc_id, start_byte, end_byte FROM lines ORDER BY doc_id, start_byte, end_byte, rowid"
+        )
+        lines = cursor.fetchall()
+    except sqlite3.OperationalError:
+        return False
+    if not lines or not all(isinstance(value, int) and value >= 0 for line in lines for value in line):
+        return False
+    starts = array("Q")
+    max_ends = array("Q")
+    rowids = array("Q")
+    doc_offsets = array("Q")
+    for rowid, doc_id, start_byte, end_byte in lines:
+        first_line = len(doc_offsets) <= doc_id
+        while len(doc_offsets) <= doc_id:
+            doc_offsets.append(len(starts))
+        max_end = end_byte if first_line else max(max_ends[-1], end_byte)
+        starts.append(start_byte)
+        max_ends.append(max_end)
+        rowids.append(rowid)
+    doc_offsets.append(len(starts))
+    for name, values in (
+        ("starts", starts),
+        ("max_ends", max_ends),
+        ("rowids", rowids),
+        ("doc_offsets", doc_offsets),
+    ):
+        with open("%s/lines.%s" % (destination, name), "wb") as output:
+            values.tofile(output)
+    return True
+
+
+def write_year_index(cursor, destination, fields):
+    """Write the per-year word and object counts of the metadata fields whose values are all integers,
+    as used for time series. Returns the first and last year and the object types of each field."""
+    years = {}
+    for field in fields:
+        try:
+            cursor.execute("SELECT philo_type, %s, word_count FROM toms WHERE %s IS NOT NULL" % (field, field))
+            rows = cursor.fetchall()
+        except sqlite3.OperationalError:
+            try:
+                cursor.execute("SELECT philo_type, %s, 0 FROM toms WHERE %s IS NOT NULL" % (field, field))
+                rows = cursor.fetchall()
+            except sqlite3.OperationalError:
+                continue
+        try:
+            rows = [(philo_type, int(year), int(word_count or 0)) for philo_type, year, word_count in rows]
+        except (TypeError, ValueError):
+            continue
+        if not rows:
+            continue
+        first_year = min(year for _, year, _ in rows)
+        last_year = max(year for _, year, _ in rows)
+        if last_year - first_year > MAX_YEAR_SPAN:
+            continue
+        word_counts = [0] * (last_year - first_year + 1)
+        counts = defaultdict(lambda: [0] * (last_year - first_year + 1))
+        for philo_type, year, word_count in rows:
+            word_counts[year - first_year] += word_count
+            counts[philo_type][year - first_year] += 1
+        for name, year_counts in [("word_counts", word_counts)] + [
+            ("%s.counts" % philo_type, type_counts) for philo_type, type_counts in counts.items()
+        ]:
+            prefix_sums = array("Q", [0])
+            for count in year_counts:
+                prefix_sums.append(prefix_sums[-1] + count)
+            with open("%s/years.%s.%s" % (destination, field, name), "wb") as output:
+                prefix_sums.tofile(output)
+        years[field] = {"first": first_year, "last": last_year, "types": sorted(counts)}
+    return years
+
+
+def write_token_stream(cursor, destination):
+    """Write the words table as a stream of vocabulary ids in document order, with the sentence boundaries
+    and packed philo_ids needed to find the words around a hit. Returns the bit widths of the packed
+    philo_ids and whether the stream is in philo_id order, or None if the words table is missing or its
+    philo_ids do not fit in 64 bits."""
+    try:
+        cursor.execute("SELECT philo_id, philo_name FROM words ORDER BY rowid")
+    except sqlite3.OperationalError:
+        return None
+    names = array("I")
+    sentences = array("Q")
+    vocabulary = {}
+    maxima = [0] * 7
+    sentence = None
+    for philo_id, philo_name in cursor:
+        philo_id = [int(i) for i in philo_id.split()[:7]]
+        for position, value in enumerate(philo_id):
+            if value > maxima[position]:
+                maxima[position] = value
+        if philo_id[:6] != sentence:
+            sentences.append(len(names))
+            sentence = philo_id[:6]
+        names.append(vocabulary.setdefault(philo_name, len(vocabulary)))
+    if not names:
+        return None
+    sentences.append(len(names))
+    bits = [max(maximum.bit_length(), 1) for maximum in maxima]
+    if sum(bits) > 64:
+        return None
+    shifts = [sum(bits[position + 1 :]) for position in range(len(bits))]
+    cursor.execute("SELECT philo_id FROM words ORDER BY rowid")
+    keys = array("Q", (sum(int(i) << shift for i, shift in zip(philo_id.split(), shifts)) for philo_id, in cursor))
+    in_order = all(keys[position] < keys[position + 1] for position in range(len(keys) - 1))
+    if not in_order:
+        positions = array("Q", sorted(range(len(keys)), key=keys.__getitem__))
+        keys = array("Q", (keys[position] for position in positions))
+        with open(destination + "/words.positions", "wb") as output:
+            positions.tofile(output)
+    offsets = array("Q", [0])
+    with open(destination + "/words.vocabulary", "wb") as output:
+        for word in vocabulary:  # in id order
+            line = (dumps(word) + "\n").encode("utf8")
+            output.write(line)
+            offsets.append(offsets[-1] + len(line))
+    for name, values in (
+        ("names", names),
+        ("sentences", sentences),
+        ("keys", keys),
+        ("vocabulary.offsets", offsets),
+    ):
+        with open("%s/words.%s" % (destination, name), "wb") as output:
+            values.tofile(output)
+    return {"bits": bits, "count": len(names), "vocabulary": len(vocabulary), "in_order": in_order}
+
+
+def write_columns(cursor, destination, level, depth, philo_ids):
+    """Write the toms rows of a level as one array per column, in the order of philo_ids. Returns
+    the list of (column, encoding) pairs, or None if some rows could not be stored."""
+    cursor.execute("SELECT * FROM toms WHERE philo_type=? ORDER BY rowid", (level,))
+    names = [description[0] for description in cursor.description]
+    rows = {}
+    for row in cursor:
+        rows.setdefault(tuple(int(i) for i in row[names.index("philo_id")].split()[:depth]), row)
+    rows = [rows.get(philo_id) for philo_id in philo_ids]
+    if any(row is None for row in rows):
+        return None
+    columns = []
+    for column, name in enumerate(names):
+        values = [row[column] for row in rows]
+        if name == "philo_id":
+            # rebuilt from the keys at runtime
+            padded_ids = (" ".join(map(str, philo_id + (0,) * (7 - depth))) for philo_id in philo_ids)
+            if any(value != padded_id for value, padded_id in zip(values, padded_ids)):
+                return None
+            columns.append((name, "philo_id"))
+            continue
+        if all(value is None or isinstance(value, int) for value in values):
+            integers = [value for value in values if value is not None]
+            for encoding, typecode in (("int32", "i"), ("int64", "q")):
+                null = INT_NULLS[encoding]
+                if all(null < value < -null for value in integers):
+                    with open("%s/%s.%s.%s" % (destination, level, name, encoding), "wb") as output:
+                        array(typecode, (null if value is None else value for value in values)).tofile(output)
+                    columns.append((name, encoding))
+                    break
+            else:
+                return None
+            continue
+        if any(isinstance(value, bytes) for value in values):
+            return None
+        dictionary = {}
+        codes = array("I")
+        for value in values:
+            # keyed by type as well so that 1 and 1.0 stay distinct
+            codes.append(0 if value is None else dictionary.setdefault((type(value), value), len(dictionary) + 1))
+        offsets = array("Q", [0])
+        with open("%s/%s.%s.dictionary" % (destination, level, name), "wb") as output:
+            for _, value in dictionary:
+                line = (dumps(value) + "\n").encode("utf8")
+                output.write(line)
+                offsets.append(offsets[-1] + len(line))
+        with open("%s/%s.%s.dictionary.offsets" % (destination, level, name), "wb") as output:
+            offsets.tofile(output)
+        with open("%s/%s.%s.codes" % (destination, level, name), "wb") as output:
+            codes.tofile(output)
+        columns.append((name, "codes"))
+    return columns
+
+
+def philo_id_keys(loader_obj):
+    """Add an integer philo_key column to the toms and words tables, with the positions of the philo_id
+    packed from the most significant bits so that the objects within any philo_id prefix form one key
+    range. The shift of each position is stored in the philo_key_shifts table."""
+    print("%s: Packing philo_ids into integer keys..." % time.ctime())
+    conn = sqlite3.connect(loader_obj.destination + "/toms.db")
+    cursor = conn.cursor()
+    tables = []
+    maxima = [0] * 7
+    for table in ("toms", "words"):
+        try:
+            cursor.execute("SELECT philo_id FROM %s" % table)
+        except sqlite3.OperationalError:
+            continue
+        for (philo_id,) in cursor:
+            for position, value in enumerate(philo_id.split()[:7]):
+                value = int(value)
+                if value > maxima[position]:
+                    maxima[position] = value
+        tables.append(table)
+    bits = [max(maximum.bit_length(), 1) for maximum in maxima]
+    if not tables or sum(bits) > 63:
+        print("%s: philo_ids are too wide to pack in 63 bits, skipping philo_id keys" % time.ctime())
+        conn.close()
+        return
+    shifts = [sum(bits[position + 1 :]) for position in range(len(bits))]
+
+    def pack_philo_id(philo_id):
+        return sum(int(i) << shift for i, shift in zip(philo_id.split(), shifts))
+
+    conn.create_function("pack_philo_id", 1, pack_philo_id, deterministic=True)
+    for table in tables:
+        cursor.execute("ALTER TABLE %s ADD COLUMN philo_key INTEGER" % table)
+        cursor.execute("UPDATE %s SET philo_key = pack_philo_id(philo_id)" % table)
+    if "toms" in tables:
+        cursor.execute("CREATE INDEX toms_philo_key_index ON toms (philo_key, philo_type, philo_id)")
+    if "words" in tables:
+        cursor.execute("CREATE INDEX words_philo_key_index ON words (philo_key)")
+    cursor.execute("CREATE TABLE philo_key_shifts (position INTEGER, shift INTEGER)")
+    cursor.executemany("INSERT INTO philo_key_shifts VALUES (?, ?)", enumerate(shifts))
+    conn.commit()
+    conn.close()
+
+
 DefaultPostFilters = [
     word_frequencies,
     normalized_word_frequencies,
     metadata_frequencies,
     normalized_metadata_frequencies,
+    philo_id_keys,
+    object_index,
 ]
 
 
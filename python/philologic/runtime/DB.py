@@ -1,16 +1,22 @@
 """DB class containing many niceties to retrieve data from SQL"""
 
 import hashlib
+import itertools
 import os
+import shutil
 import sqlite3
 from philologic.Config import Config, db_locals_defaults, db_locals_header
 
 from philologic.runtime import Query
 
 from . import HitList
+from . import HitlistCache
+from . import hitlist_filter
 from . import MetadataQuery
 from . import QuerySyntax
 from .HitWrapper import HitWrapper, PageWrapper
+from .ObjectIndex import load_object_index
+from .RowCache import MISSING, get_row_cache
 
 
 def hit_to_string(hit, width):
@@ -39,6 +45,7 @@ class DB:
         self.width = width
         self.locals = Config(dbpath + "/db.locals.py", db_locals_defaults, db_locals_header)
         self.cached = cached
+        self.row_cache = get_row_cache(dbpath) if cached else None
 
     def __getitem__(self, item):
         if self.width != 9:  # verify this isn't a page id
@@ -57,31 +64,99 @@ class DB:
             dbh.row_factory = sqlite3.Row
             setattr(self, "dbh", dbh)
             return self.dbh
+        elif attr == "philo_key_shifts":
+            # Bit shift of each philo_id position in the integer philo_key columns, if the database has them
+            try:
+                shifts = [shift for shift, in self.dbh.execute("SELECT shift FROM philo_key_shifts ORDER BY position")]
+            except sqlite3.OperationalError:
+                shifts = []
+            setattr(self, "philo_key_shifts", shifts or None)
+            return self.philo_key_shifts
+
+    def philo_key(self, philo_id):
+        """Pack a philo_id into the integer stored in the philo_key column of toms and words.
+        Returns None if the database has no philo_key column or the philo_id cannot be packed."""
+        shifts = self.philo_key_shifts
+        if shifts is None:
+            return None
+        philo_id = [int(i) for i in philo_id]
+        if any(philo_id[len(shifts) :]):
+            return None
+        key = 0
+        for position, value in enumerate(philo_id[: len(shifts)]):
+            limit = 1 << (shifts[position - 1] - shifts[position]) if position else 1 << (63 - shifts[0])
+            if not 0 <= value < limit:
+                return None
+            key |= value << shifts[position]
+        return key
+
+    def philo_key_range(self, prefix):
+        """Return the lowest and highest philo_key of the objects whose philo_id starts with prefix"""
+        prefix = [int(i) for i in prefix]
+        lowest = self.philo_key(prefix)
+        if lowest is None:
+            return None
+        if not prefix:
+            return 0, (1 << 63) - 1
+        depth = min(len(prefix), len(self.philo_key_shifts))
+        return lowest, lowest + (1 << self.philo_key_shifts[depth - 1]) - 1
+
+    def cached_row(self, key, lookup, *args):
+        """Return the row stored under key in the row cache, calling lookup(*args) on a miss"""
+        if self.row_cache is None:
+            return lookup(*args)
+        row = self.row_cache.get(key)
+        if row is MISSING:
+            row = lookup(*args)
+            self.row_cache.put(key, row)
+        return row
 
     def get_id_lowlevel(self, item):
         """Retrieve text object metadata"""
         hit_s = hit_to_string(item, self.width)
-        c = self.dbh.cursor()
-        c.execute("SELECT * FROM toms WHERE philo_id=? LIMIT 1;", (hit_s,))
-        return c.fetchone()
+        return self.cached_row(("toms", hit_s), self.__select_object, hit_s)
+
+    def __select_object(self, hit_s):
+        object_index = load_object_index(self.path)
+        if object_index is not None:
+            row = object_index.row(hit_s.split())
+            if row is not None:
+                return row
+        return self.__select_by_id("toms", hit_s)
 
     def get_word(self, item):
         """Retrieve word from words table"""
         word_s = hit_to_string(item, self.width)
-        c = self.dbh.cursor()
-        c.execute("SELECT * FROM words WHERE philo_id=? LIMIT 1;", (word_s,))
-        return c.fetchone()
+        return self.cached_row(("words", word_s), self.__select_by_id, "words", word_s)
 
     def get_page(self, item):
         """Retrieve page data"""
         page_id_s = " ".join(str(s) for s in item)
+        return self.cached_row(("pages", page_id_s), self.__select_by_id, "pages", page_id_s)
+
+    def __select_by_id(self, table, philo_id):
         c = self.dbh.cursor()
-        c.execute("SELECT * FROM pages WHERE philo_id=? LIMIT 1;", (page_id_s,))
+        if table in ("toms", "words"):
+            key = self.philo_key(philo_id.split())
+            if key is not None:
+                c.execute("SELECT * FROM %s WHERE philo_key=? LIMIT 1;" % table, (key,))
+                return c.fetchone()
+        c.execute("SELECT * FROM %s WHERE philo_id=? LIMIT 1;" % table, (philo_id,))
         return c.fetchone()
 
     def get_line(self, byte_offset, doc_id):
         """Retrieve line data"""
+        return self.cached_row(("lines", doc_id, byte_offset), self.__select_line, byte_offset, doc_id)
+
+    def __select_line(self, byte_offset, doc_id):
         c = self.dbh.cursor()
+        object_index = load_object_index(self.path)
+        if object_index is not None and object_index.has_lines():
+            rowid = object_index.line_rowid(doc_id, byte_offset)
+            if rowid is None:
+                return None
+            c.execute("SELECT * FROM lines WHERE rowid=?", (rowid,))
+            return c.fetchone()
         try:
             c.execute(
                 "SELECT * FROM lines WHERE doc_id=? and start_byte < ? and end_byte > ? LIMIT 1",
@@ -92,13 +167,16 @@ class DB:
             return ""
 
     def get_all(self, philo_type="doc", sort_order=["rowid"], raw_results=False):
-        """ get all objects of type philo_type """
+        """get all objects of type philo_type"""
         hash = hashlib.sha1()
         hash.update(self.path.encode("utf8"))
         hash.update(philo_type.encode("utf8"))
         all_hash = hash.hexdigest()
         all_file = self.path + "/hitlists/" + all_hash + ".hitlist"
-        if not os.path.isfile(all_file):
+        HitlistCache.discard_abandoned(all_file)
+        cached = os.path.isfile(all_file)
+        HitlistCache.record_access(all_file, cached)
+        if not cached:
             # write out the corpus file
             if philo_type == "div":
                 param_dicts = [{"philo_type": ['"div1"|"div2"|"div3"']}]
@@ -124,12 +202,13 @@ class DB:
             try:
                 limit = int(limit)
             except (TypeError, ValueError):
-                limit = 10000000
+                limit = None
 
         hash = hashlib.sha1()
         hash.update(self.path.encode("utf8"))
         has_metadata = False
         corpus_file = None
+        key_values = []
 
         for key, value in metadata.items():
             if isinstance(value, str):
@@ -143,12 +222,16 @@ class DB:
                 has_metadata = True
                 key_value = "%s=%s" % (key, "|".join(value))
                 hash.update(key_value.encode("utf8"))
+                key_values.append(key_value)
 
         if has_metadata:
             corpus_hash = hash.hexdigest()
             corpus_file = self.path + "/hitlists/" + corpus_hash + ".hitlist"
+            HitlistCache.discard_abandoned(corpus_file)
+            cached = os.path.isfile(corpus_file)
+            HitlistCache.record_access(corpus_file, cached)
 
-            if not os.path.isfile(corpus_file):
+            if not cached:
                 # before we query, we need to figure out what type each parameter belongs to,
                 # and sort them into a list of dictionaries, one for each type.
                 metadata_dicts = [{} for level in self.locals["metadata_hierarchy"]]
@@ -187,7 +270,12 @@ class DB:
             search_file = self.path + "/hitlists/" + search_hash + ".hitlist"
             if sort_order == ["rowid"]:
                 sort_order = None
-            if not os.path.isfile(search_file):
+            HitlistCache.discard_abandoned(search_file)
+            cached = os.path.isfile(search_file)
+            if not cached and corpus_file is not None:
+                cached = self.filter_cached_search(search_file, corpus_file, key_values, qs, method, method_arg, limit)
+            HitlistCache.record_access(search_file, cached)
+            if not cached:
                 return Query.query(
                     self,
                     qs,
@@ -204,7 +292,50 @@ class DB:
             grouped = QuerySyntax.group_terms(parsed)
             split = Query.split_terms(grouped)
             words_per_hit = len(split)
-            return HitList.HitList(search_file, words_per_hit, self, sort_order=sort_order, raw=raw_results)
+            return HitList.HitList(
+                search_file,
+                words_per_hit,
+                self,
+                sort_order=sort_order,
+                raw=raw_results,
+                terms=split,
+                corpus_file=corpus_file,
+            )
         if corpus:
             return corpus
         return self.get_all(self.locals["default_object_level"], sort_order)
+
+    def filter_cached_search(self, search_file, corpus_file, key_values, qs, method, method_arg, limit):
+        """Build the hitlist of a metadata-restricted search by filtering the finished hitlist of the same
+        search with none or only some of the metadata, if one is cached. Returns True if it did."""
+        for size in range(len(key_values) - 1, -1, -1):
+            for subset in itertools.combinations(key_values, size):
+                hash = hashlib.sha1()
+                hash.update(self.path.encode("utf8"))
+                for value in subset + (qs, method, str(method_arg), str(limit)):
+                    hash.update(value.encode("utf8"))
+                source_file = self.path + "/hitlists/" + hash.hexdigest() + ".hitlist"
+                try:
+                    with open(source_file + ".done") as flag:
+                        if flag.readline().startswith("truncated"):
+                            continue
+                except OSError:
+                    continue
+                if os.path.exists(source_file + ".error"):
+                    continue
+                HitlistCache.record_access(source_file, True)
+                hitlist_fh = HitlistCache.claim(search_file)
+                if hitlist_fh is None:  # being built by another request
+                    return True
+                split = Query.split_terms(QuerySyntax.group_terms(QuerySyntax.parse_query(qs)))
+                width = 7 + 2 * len(split)
+                with hitlist_fh:
+                    truncated = hitlist_filter.filter_hitlist(source_file, corpus_file, hitlist_fh, width, limit)
+                    if os.path.exists(source_file + ".terms"):
+                        shutil.copyfile(source_file + ".terms", search_file + ".terms")
+                    with open(search_file + ".done", "w") as flag:
+                        if truncated:
+                            flag.write("truncated\n")
+                        flag.write("filtered %s\n" % os.path.basename(source_file))
+                return True
+        return False
@@ -1,15 +1,40 @@
 #!/usr/bin/env python3
 
+import mmap
 import os
 import time
 import struct
-from .HitWrapper import HitWrapper
+from collections import namedtuple
+from .HitWrapper import HitWrapper, fetch_rows
+from .HitlistCache import is_abandoned
+from .HitlistNotifier import HitlistNotifier
+from .ObjectIndex import load_object_index
+from .TermIndex import load_term_index
 from philologic.utils import smash_accents
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Readers block on inotify events for at most this long before checking the hitlist again
+NOTIFY_TIMEOUT = 1.0
+# Polling interval when notifications are not available
+POLL_INTERVAL = 0.05
+# Readers check that the search writing an unfinished hitlist is still alive this often
+CLAIM_CHECK_INTERVAL = 1.0
+
 obj_dict = {"doc": 1, "div1": 2, "div2": 3, "div3": 4, "para": 5, "sent": 6, "word": 7}
 
+# Estimated number of hits with the bounds it must lie within; upper is None when unknown
+HitCount = namedtuple("HitCount", "count lower upper exact")
+
 
 class HitList(object):
+    """Hitlist backed by a memory map of the binary hitlist file, which may still be growing while
+    corpus_search writes to it. Hits are decoded in batches from a NumPy view of the map, or from a
+    memoryview cast to unsigned ints when NumPy is not installed."""
+
     def __init__(
         self,
         filename,
@@ -22,9 +47,14 @@ class HitList(object):
         methodarg=3,
         sort_order=None,
         raw=False,
+        terms=None,
+        corpus_file=None,
     ):
         self.filename = filename
         self.words = words
+        self.terms = terms  # split query groups, used to estimate the length of the hitlist
+        self.corpus_file = corpus_file
+        self.term_frequencies = None
         self.method = method
         self.methodarg = methodarg
         self.sort_order = sort_order
@@ -39,15 +69,29 @@ class HitList(object):
         else:
             self.has_word_id = 0  # unfortunately.  fix this next time I have 3 months to spare.
             self.length = methodarg + 1 + (words)
-        self.fh = open(self.filename, "rb")  # need a full path here.
         self.format = "=%dI" % self.length  # short for object id's, int for byte offset.
         self.hitsize = struct.calcsize(self.format)
         self.doc = doc
         self.byte = byte
         self.position = 0
         self.done = False
+        self.truncated = False  # the search stopped at its limit before the end of the results
+        self.count = 0
+        self.hits = None
+        self.mapped_count = 0
+        self.notifier = None
+        self.polling = False
+        self.last_claim_check = time.time()
         self.update()
-        if self.sort_order:
+        object_index = load_object_index(dbh.path) if self.sort_order else None
+        if object_index is not None and object_index.has_ranks(self.sort_order):
+            self.finish()
+            if self.count:
+                self.map_hits()
+                self.sorted_hitlist = self.hits[object_index.sort(self.hits, self.sort_order)]
+            else:
+                self.sorted_hitlist = []
+        elif self.sort_order:
             metadata_types = set([dbh.locals["metadata_types"][i] for i in self.sort_order])
             if "div" in metadata_types:
                 metadata_types.remove("div")
@@ -68,16 +112,8 @@ class HitList(object):
                 sql_row = dict(i)
                 philo_id = tuple(int(s) for s in sql_row["philo_id"].split() if int(s))
                 metadata[philo_id] = [smash_accents(sql_row[m] or "ZZZZZ") for m in sort_order]
-            self.sorted_hitlist = []
-            iter_position = 0
-            self.seek(iter_position)
-            while True:
-                try:
-                    hit = self.readhit(iter_position)
-                except IndexError as IOError:
-                    break
-                self.sorted_hitlist.append(hit)
-                iter_position += 1
+            self.finish()
+            self.sorted_hitlist = self.read_hits(0, self.count)
 
             def sort_by_metadata(philo_id):
                 while philo_id:
@@ -95,77 +131,110 @@ class HitList(object):
         if self.sort_order:
             return self.get_slice(n)
         else:
-            self.update()
             if isinstance(n, slice):
                 return self.get_slice(n)
             else:
                 if self.raw:
                     return self.readhit(n)
                 else:
-                    self.readhit(n)
                     return HitWrapper(self.readhit(n), self.dbh)
 
     def get_slice(self, n):
         if self.sort_order:
             try:
-                for hit in self.sorted_hitlist[n]:
+                for hit in self.sorted_hits(n):
                     yield HitWrapper(hit, self.dbh)
             except IndexError:
                 pass
         else:
-            self.update()
             # need to handle negative offsets.
             slice_position = n.start or 0
-            self.seek(slice_position)
-            while True:
-                if n.stop is not None:
-                    if slice_position >= n.stop:
-                        break
-                try:
-                    hit = self.readhit(slice_position)
-                except IndexError as IOError:
-                    break
+            for hit in self.iter_hits(slice_position, n.stop):
                 if self.raw:
                     yield hit
                 else:
                     yield HitWrapper(hit, self.dbh)
-                slice_position += 1
 
     def __len__(self):
         self.update()
         return self.count
 
+    def get_resolved_slice(self, start, stop):
+        """Return hits start to stop as a list of HitWrappers whose metadata, pages, words and lines
+        are fetched together with a few queries, as needed to render a page of results"""
+        if self.sort_order:
+            hits = list(self.sorted_hits(slice(start, stop)))
+        else:
+            hits = list(self.iter_hits(start, stop))
+        if self.raw:
+            return hits
+        rows = fetch_rows(self.dbh, hits)
+        return [HitWrapper(hit, self.dbh, rows=rows) for hit in hits]
+
     def __iter__(self):
         if self.sort_order:
-            for hit in self.sorted_hitlist:
+            for hit in self.sorted_hits(slice(None)):
                 yield HitWrapper(hit, self.dbh)
         else:
-            self.update()
-            iter_position = 0
-            self.seek(iter_position)
-            while True:
-                try:
-                    hit = self.readhit(iter_position)
-                except IndexError as IOError:
-                    break
+            for hit in self.iter_hits(0):
                 if self.raw:
                     yield hit
                 else:
                     yield HitWrapper(hit, self.dbh)
-                iter_position += 1
+
+    def estimate_length(self):
+        """Return a HitCount for the hitlist without waiting for the search to finish. Single-term
+        searches over the whole corpus are counted exactly from the word frequencies. Otherwise the
+        hits found so far are extrapolated over the share of the corpus already searched, between
+        those hits and the frequency of the rarest term, which no search can exceed."""
+        self.update()
+        if self.done:
+            return HitCount(self.count, self.count, self.count, True)
+        if self.term_frequencies is None and self.terms is not None:
+            term_index = load_term_index(self.dbh.path)
+            if term_index is not None:
+                lowercase = self.dbh.locals["lowercase_index"]
+                self.term_frequencies = [term_index.group_frequency(group, lowercase) for group in self.terms]
+        frequencies = [f for f in self.term_frequencies or [] if f is not None]
+        upper = min(frequencies) if len(frequencies) == len(self.terms or []) else None
+        if upper is not None and len(self.terms) == 1 and self.corpus_file is None:
+            return HitCount(upper, upper, upper, True)
+        count = upper
+        if self.count:
+            progress = self.search_progress()
+            if progress:
+                count = int(self.count / progress)
+                if upper is not None:
+                    count = min(count, upper)
+        if count is None or count < self.count:
+            count = self.count
+        return HitCount(count, self.count, upper, False)
+
+    def search_progress(self):
+        """Share of the corpus words up to the end of the document of the last hit written, or
+        None without document word counts"""
+        object_index = load_object_index(self.dbh.path)
+        if object_index is None or "doc" not in object_index.config.get("word_counts", []):
+            return None
+        last_hit = np.array(self.read_hits(self.count - 1, self.count), dtype=np.uint32)
+        position = object_index.lookup("doc", last_hit)[0]
+        prefix_sums = object_index.word_counts("doc")
+        if position < 0 or not prefix_sums[-1]:
+            return None
+        return float(prefix_sums[position + 1]) / float(prefix_sums[-1])
+
+    def sorted_hits(self, n):
+        """Return a slice of the sorted hits as tuples"""
+        hits = self.sorted_hitlist[n]
+        if np is not None and isinstance(hits, np.ndarray):
+            return map(tuple, hits.tolist())
+        return hits
 
     def seek(self, n):
         if self.position == n:
             pass
         else:
-            while n >= len(self):
-                if self.done:
-                    raise IndexError
-                else:
-                    time.sleep(0.05)
-                    self.update()
-            offset = self.hitsize * n
-            self.fh.seek(offset)
+            self.wait_for(n)
             self.position = n
 
     def update(self):
@@ -174,48 +243,113 @@ class HitList(object):
             pass
         else:
             try:
-                os.stat(self.filename + ".done")
+                with open(self.filename + ".done") as flag:
+                    self.truncated = flag.readline().startswith("truncated")
                 self.done = True
             except OSError:
                 pass
-            self.size = os.stat(self.filename).st_size  # in bytes
+            try:
+                self.size = os.stat(self.filename).st_size  # in bytes
+            except FileNotFoundError:  # an abandoned search being discarded and run again
+                self.size = 0
             self.count = int(self.size / self.hitsize)
+            if self.done and self.notifier is not None:
+                self.notifier.close()
+                self.notifier = None
+
+    def wait_for_change(self):
+        """Block until corpus_search writes more hits or flags the hitlist as done, then update.
+        Uses inotify when available, and otherwise falls back to polling the file."""
+        if self.notifier is None and not self.polling:
+            try:
+                self.notifier = HitlistNotifier(self.filename)
+            except OSError:
+                self.polling = True
+            else:
+                # Anything written before the watch was set up is picked up here
+                self.update()
+                return
+        if self.notifier is not None:
+            self.notifier.wait(NOTIFY_TIMEOUT)
+        else:
+            time.sleep(POLL_INTERVAL)
+        self.update()
+        if not self.done and time.time() - self.last_claim_check > CLAIM_CHECK_INTERVAL:
+            self.last_claim_check = time.time()
+            if is_abandoned(self.filename):
+                # the worker died: keep the hits it wrote rather than waiting forever
+                self.done = True
 
     def finish(self):
+        self.update()
         while not self.done:
-            self.update()
-            time.sleep(0.05)
+            self.wait_for_change()
 
-    def readhit(self, n):
-        # reads hitlist into buffer, unpacks
-        # should do some work to read k at once, track buffer state.
-        self.update()
-        while n >= len(self):
+    def wait_for(self, n):
+        """Block until hit n has been written, raising IndexError if the hitlist ends before it"""
+        if n >= self.count:
+            self.update()
+        while n >= self.count:
             if self.done:
                 raise IndexError
-            else:
-                time.sleep(0.05)
-                self.update()
-        if n != self.position:
-            offset = self.hitsize * n
-            self.fh.seek(offset)
-            self.position = n
-        buffer = self.fh.read(self.hitsize)
-        self.position += 1
-        return struct.unpack(self.format, buffer)
+            self.wait_for_change()
+
+    def map_hits(self):
+        """(Re)map the hitlist file so that all hits written so far are addressable"""
+        if self.mapped_count == self.count:
+            return
+        mapped_size = self.count * self.hitsize
+        with open(self.filename, "rb") as hitlist_file:
+            buffer = mmap.mmap(hitlist_file.fileno(), mapped_size, access=mmap.ACCESS_READ)
+        if np is not None:
+            self.hits = np.frombuffer(buffer, dtype=np.uint32).reshape(self.count, self.length)
+        else:
+            self.hits = memoryview(buffer).cast("I")
+        self.mapped_count = self.count
+
+    def read_hits(self, start, stop):
+        """Decode hits start to stop (which must already be written) in one batch, as a list of tuples"""
+        stop = min(stop, self.count)
+        if start >= stop:
+            return []
+        if stop > self.mapped_count:
+            self.map_hits()
+        if np is not None:
+            return list(map(tuple, self.hits[start:stop].tolist()))
+        values = iter(self.hits[start * self.length : stop * self.length].tolist())
+        return list(zip(*[values] * self.length))
+
+    def iter_hits(self, start=0, stop=None):
+        """Iterate over hits from start to stop, decoding all hits available at a time in one batch"""
+        position = start
+        while stop is None or position < stop:
+            try:
+                self.wait_for(position)
+            except IndexError:
+                break
+            batch_end = self.count
+            if stop is not None and stop < batch_end:
+                batch_end = stop
+            for hit in self.read_hits(position, batch_end):
+                yield hit
+            position = batch_end
+            self.position = position
+
+    def readhit(self, n):
+        self.wait_for(n)
+        self.position = n + 1
+        return self.read_hits(n, n + 1)[0]
 
     def get_total_word_count(self):
-        philo_ids = []
         total_count = 0
-        iter_position = 0
-        self.seek(iter_position)
-        while True:
-            try:
-                hit = self.readhit(iter_position)
-                philo_ids.append(hit)
-            except IndexError as IOError:
-                break
-            iter_position += 1
+        self.finish()
+        object_index = load_object_index(self.dbh.path)
+        if object_index is not None and object_index.has_word_counts() and self.length == 7:
+            if not self.count:
+                return 0
+            self.map_hits()
+            return object_index.total_word_count(self.hits)
+        philo_ids = self.read_hits(0, self.count)
         c = self.dbh.dbh.cursor()
         query = "SELECT SUM(word_count) FROM toms WHERE "
         ids = []
@@ -257,6 +391,7 @@ class CombinedHitlist(object):
                     sentence_counts[sentence_id] += 1
 
         self.done = True
+        self.truncated = False
 
     def __len__(self):
         return len(self.combined_hitlist)
@@ -264,6 +399,12 @@ class CombinedHitlist(object):
     def __getitem__(self, key):
         return self.combined_hitlist[key]
 
+    def get_resolved_slice(self, start, stop):
+        return self.combined_hitlist[start:stop]
+
+    def estimate_length(self):
+        return HitCount(len(self), len(self), len(self), True)
+
     def __getattr__(self, name):
         return self.combined_hitlist[name]
 
@@ -271,6 +412,7 @@ class CombinedHitlist(object):
 class WordPropertyHitlist(object):
     def __init__(self, hitlist):
         self.done = True
+        self.truncated = False
         self.hitlist = hitlist
 
     def __getitem__(self, key):
@@ -282,10 +424,17 @@ class WordPropertyHitlist(object):
     def __len__(self):
         return len(self.hitlist)
 
+    def get_resolved_slice(self, start, stop):
+        return self.hitlist[start:stop]
+
+    def estimate_length(self):
+        return HitCount(len(self), len(self), len(self), True)
+
 
 class NoHits(object):
     def __init__(self):
         self.done = True
+        self.truncated = False
 
     def __len__(self):
         return 0
@@ -296,6 +445,9 @@ class NoHits(object):
     def __iter__(self):
         return ""
 
+    def get_resolved_slice(self, start, stop):
+        return []
+
     def finish(self):
         return
 
@@ -304,3 +456,6 @@ class NoHits(object):
 
     def get_total_word_count(self):
         return 0
+
+    def estimate_length(self):
+        return HitCount(0, 0, 0, True)
@@ -1,10 +1,14 @@
 #!/usr/bin/python3
 """All different types of hit objects"""
 
+import sqlite3
 import sys
 
+from .ObjectIndex import load_object_index
+from .RowCache import MISSING
+
 TEXT_OBJECT_LEVELS = {"doc": 1, "div1": 2, "div2": 3, "div3": 4, "para": 5, "sent": 6, "word": 7}
-SHARED_CACHE = {}
+SQL_BATCH_SIZE = 999  # max number of host parameters in a sqlite query
 
 
 def _safe_lookup(row, field):
@@ -18,12 +22,169 @@ def _safe_lookup(row, field):
     return metadata
 
 
+def _id_string(philo_id, width):
+    philo_id = list(philo_id[:width])
+    return " ".join(str(i) for i in philo_id + [0] * (width - len(philo_id)))
+
+
+def _page_id(hit, page_i):
+    return " ".join(str(i) for i in [hit[0], 0, 0, 0, 0, 0, 0, 0, page_i])
+
+
+def _select_in(db, table, philo_ids):
+    """Return the rows of table with the given philo_ids, keyed by philo_id, reading the row cache
+    of db first and storing the rows it did not hold"""
+    rows = {}
+    philo_ids = set(philo_ids)
+    if db.row_cache is not None:
+        for philo_id in list(philo_ids):
+            row = db.row_cache.get((table, philo_id))
+            if row is not MISSING:
+                philo_ids.remove(philo_id)
+                if row is not None:
+                    rows[philo_id] = row
+    if table == "toms":
+        object_index = load_object_index(db.path)
+        if object_index is not None:
+            for philo_id in list(philo_ids):
+                row = object_index.row(philo_id.split())
+                if row is not None:
+                    rows[philo_id] = row
+                    philo_ids.remove(philo_id)
+                    if db.row_cache is not None:
+                        db.row_cache.put((table, philo_id), row)
+    philo_ids = sorted(philo_ids)
+    cursor = db.dbh.cursor()
+    for start in range(0, len(philo_ids), SQL_BATCH_SIZE):
+        batch = philo_ids[start : start + SQL_BATCH_SIZE]
+        column, values = "philo_id", batch
+        if table in ("toms", "words") and db.philo_key_shifts is not None:
+            keys = [db.philo_key(philo_id.split()) for philo_id in batch]
+            if None not in keys:
+                column, values = "philo_key", keys
+        try:
+            cursor.execute("SELECT * FROM %s WHERE %s IN (%s)" % (table, column, ",".join("?" * len(batch))), values)
+        except sqlite3.OperationalError:
+            return rows
+        found = {}
+        for row in cursor:
+            found.setdefault(row["philo_id"], row)  # first match, like the LIMIT 1 lookups
+        rows.update(found)
+        if db.row_cache is not None:
+            for philo_id in batch:
+                db.row_cache.put((table, philo_id), found.get(philo_id))
+    return rows
+
+
+def fetch_rows(db, hits):
+    """Fetch the toms, pages, words and lines rows needed by the HitWrappers of a list of raw hits
+    with a few set-based queries, instead of one query per object when the wrappers are read.
+    Returns a dict to pass to HitWrapper(hit, db, rows=rows)."""
+    object_ids = set()
+    word_ids = set()
+    line_offsets = {}
+    for hit in hits:
+        for depth in range(1, 7):
+            object_ids.add(_id_string(hit[:depth], db.width))
+        if len(hit) == 7:
+            object_ids.add(_id_string(hit, db.width))
+            word_ids.add(_id_string(hit, db.width))
+            continue
+        object_ids.add(_id_string(hit[:6] + (hit[7],), db.width))
+        parent_id = hit[:6]
+        remaining = hit[7:]
+        for position in range(0, len(remaining), 2):
+            word_ids.add(_id_string(parent_id + (remaining[position],), db.width))
+        offsets = sorted(remaining[1::2])
+        if offsets:
+            line_offsets.setdefault(hit[0], set()).add(offsets[0])
+    rows = {("toms", philo_id): row for philo_id, row in _select_in(db, "toms", object_ids).items()}
+    page_ids = set()
+    for hit in hits:
+        if len(hit) == 7:
+            page_ids.add(_page_id(hit, _safe_lookup(rows.get(("toms", _id_string(hit, db.width))), "page")))
+        else:
+            page_ids.add(_page_id(hit, hit[6]))
+        for depth in range(1, 7):
+            object_row = rows.get(("toms", _id_string(hit[:depth], db.width)))
+            page_ids.add(_page_id(hit, _safe_lookup(object_row, "page")))
+    rows.update((("pages", page_id), row) for page_id, row in _select_in(db, "pages", page_ids).items())
+    rows.update((("words", word_id), row) for word_id, row in _select_in(db, "words", word_ids).items())
+    _select_lines(db, line_offsets, rows)
+    return rows
+
+
+def _select_lines(db, line_offsets, rows):
+    """Add the lines containing the byte offsets of each doc in line_offsets to rows"""
+    cursor = db.dbh.cursor()
+    object_index = load_object_index(db.path)
+    line_rowids = {}
+    for doc_id, offsets in line_offsets.items():
+        if db.row_cache is not None:
+            for offset in list(offsets):
+                line = db.row_cache.get(("lines", doc_id, offset))
+                if line is not MISSING:
+                    offsets.remove(offset)
+                    if line is not None:
+                        rows[("lines", doc_id, offset)] = line
+            if not offsets:
+                continue
+        if object_index is not None and object_index.has_lines():
+            for offset in offsets:
+                line_rowids[doc_id, offset] = object_index.line_rowid(doc_id, offset)
+            continue
+        try:
+            cursor.execute(
+                "SELECT * FROM lines WHERE doc_id=? and start_byte < ? and end_byte > ?",
+                (doc_id, max(offsets), min(offsets)),
+            )
+        except sqlite3.OperationalError:
+            return
+        lines = cursor.fetchall()
+        for offset in offsets:
+            for line in lines:
+                if line["start_byte"] < offset < line["end_byte"]:
+                    rows[("lines", doc_id, offset)] = line
+                    break
+            if db.row_cache is not None:
+                db.row_cache.put(("lines", doc_id, offset), rows.get(("lines", doc_id, offset)))
+    if line_rowids:
+        lines = {}
+        rowids = sorted(set(rowid for rowid in line_rowids.values() if rowid is not None))
+        for start in range(0, len(rowids), SQL_BATCH_SIZE):
+            batch = rowids[start : start + SQL_BATCH_SIZE]
+            cursor.execute("SELECT * FROM lines WHERE rowid IN (%s) ORDER BY rowid" % ",".join("?" * len(batch)), batch)
+            lines.update(zip(batch, cursor))
+        for (doc_id, offset), rowid in line_rowids.items():
+            line = lines.get(rowid)
+            if line is not None:
+                rows[("lines", doc_id, offset)] = line
+            if db.row_cache is not None:
+                db.row_cache.put(("lines", doc_id, offset), line)
+
+
 class HitWrapper:
-    """Class representing an individual hit with all its ancestors"""
+    """Class representing an individual hit with all its ancestors.
+    Words, page, line and ancestor objects are only built when first accessed."""
+
+    __slots__ = (
+        "db",
+        "hit",
+        "object_type",
+        "philo_id",
+        "bytes",
+        "row",
+        "rows",
+        "_words",
+        "_page",
+        "_ancestors",
+        "_line",
+    )
 
-    def __init__(self, hit, db, obj_type=False, method="proxy"):
+    def __init__(self, hit, db, obj_type=False, method="proxy", rows=None):
         self.db = db
         self.hit = hit
+        self.rows = rows
         if obj_type:
             self.object_type = obj_type
         else:
@@ -36,58 +197,86 @@ class HitWrapper:
             self.object_type = [k for k in TEXT_OBJECT_LEVELS if TEXT_OBJECT_LEVELS[k] == length][0]
         self.row = None
         self.bytes = []
-        self.words = []
-        if len(list(hit)) == 7:
+        if len(hit) == 7:
             self.philo_id = hit
-            self.words.append(WordWrapper(hit, db, self.start_byte))
-            page_i = self["page"]
         else:
-            self.philo_id = hit[:6] + (self.hit[7],)
-            parent_id = self.hit[:6]
-            remaining = list(self.hit[7:])
-            while remaining:
-                self.words += [parent_id + (remaining.pop(0),)]
-                if remaining:
-                    self.bytes.append(remaining.pop(0))
-            self.bytes.sort()
-            self.words.sort(key=lambda x: x[-1])  # assumes words in same sent, as does search4
-            self.words = [WordWrapper(word, db, byte) for word, byte in zip(self.words, self.bytes)]
-
-            page_i = self.hit[6]
-        page_id = [self.hit[0], 0, 0, 0, 0, 0, 0, 0, page_i]
-        self.page = PageWrapper(page_id, db)
-        self.ancestors = {}
-        for object_type in TEXT_OBJECT_LEVELS:
-            if object_type == "word":
-                self.ancestors["word"] = self.words[0]
+            self.philo_id = hit[:6] + (hit[7],)
+            self.bytes = sorted(hit[8::2])
+        if rows is not None:
+            self.row = rows.get(("toms", _id_string(self.philo_id, db.width)))
+        self._words = None
+        self._page = None
+        self._ancestors = {}
+        self._line = None
+
+    @property
+    def words(self):
+        if self._words is None:
+            if len(self.hit) == 7:
+                self._words = [WordWrapper(self.hit, self.db, self.start_byte, rows=self.rows)]
             else:
-                self.ancestors[object_type] = ObjectWrapper(self.hit, self.db, object_type)
-        try:
-            self.line = LineWrapper(self.philo_id, self.bytes[0], db)
-        except IndexError:
-            self.line = ""
+                parent_id = self.hit[:6]
+                words = sorted((parent_id + (position,) for position in self.hit[7::2]), key=lambda x: x[-1])
+                # assumes words in same sent, as does search4
+                self._words = [
+                    WordWrapper(word, self.db, byte, rows=self.rows) for word, byte in zip(words, self.bytes)
+                ]
+        return self._words
+
+    @property
+    def page(self):
+        if self._page is None:
+            if len(self.hit) == 7:
+                page_i = self["page"]
+            else:
+                page_i = self.hit[6]
+            self._page = PageWrapper([self.hit[0], 0, 0, 0, 0, 0, 0, 0, page_i], self.db, rows=self.rows)
+        return self._page
+
+    @property
+    def line(self):
+        if self._line is None:
+            if self.bytes:
+                self._line = LineWrapper(self.philo_id, self.bytes[0], self.db, rows=self.rows)
+            else:
+                self._line = ""
+        return self._line
+
+    @property
+    def ancestors(self):
+        return {object_type: self.ancestor(object_type) for object_type in TEXT_OBJECT_LEVELS}
+
+    def ancestor(self, object_type):
+        """Return the wrapper of the hit's ancestor of the given type, building it on first use"""
+        if object_type == "word":
+            return self.words[0]
+        if object_type not in self._ancestors:
+            row = None
+            if self.rows is not None:
+                row = self.rows.get(("toms", _id_string(self.hit[: TEXT_OBJECT_LEVELS[object_type]], self.db.width)))
+            self._ancestors[object_type] = ObjectWrapper(self.hit, self.db, object_type, row=row, rows=self.rows)
+        return self._ancestors[object_type]
 
     def __getitem__(self, key):
         if key in TEXT_OBJECT_LEVELS:
-            return self.ancestors[key]
+            return self.ancestor(key)
         else:
             if key in self.db.locals["metadata_fields"]:
                 f_type = self.db.locals["metadata_types"][key]
                 if f_type == "div":
                     for div_type in ("div3", "div2", "div1"):
-                        val = self.ancestors[div_type][key]
+                        val = self.ancestor(div_type)[key]
                         if val:
                             break
                     return val
                 elif f_type == "line":
-                    try:
-                        return LineWrapper(self.philo_id, self.bytes[0], self.db)["n"]
-                    except IndexError:
+                    if not self.bytes:
                         # Not a word hit
                         return ""
+                    return self.line["n"]
                 else:
                     try:
-                        return self.ancestors[f_type][key]
+                        return self.ancestor(f_type)[key]
                     except KeyError:
                         return ""
             else:
@@ -102,7 +291,9 @@ class HitWrapper:
 class ObjectWrapper:
     """Class representing doc, div1, div2, div3, para, sent objects"""
 
-    def __init__(self, hit, db, obj_type=False, row=None):
+    __slots__ = ("db", "hit", "philo_id", "object_type", "bytes", "row", "words", "rows", "_page")
+
+    def __init__(self, hit, db, obj_type=False, row=None, rows=None):
         self.db = db
         self.hit = hit
         if obj_type:
@@ -118,22 +309,22 @@ class ObjectWrapper:
         self.bytes = []
         self.row = row
         self.words = []
-        page_i = self["page"]
-        page_id = [self.hit[0], 0, 0, 0, 0, 0, 0, 0, page_i]
-        self.page = PageWrapper(page_id, db)
+        self.rows = rows
+        self._page = None
+
+    @property
+    def page(self):
+        if self._page is None:
+            page_id = [self.hit[0], 0, 0, 0, 0, 0, 0, 0, self["page"]]
+            self._page = PageWrapper(page_id, self.db, rows=self.rows)
+        return self._page
 
     def __getitem__(self, key):
         if key in TEXT_OBJECT_LEVELS:
             return ObjectWrapper(self.hit, self.db, key)
         else:
-            if self.object_type in SHARED_CACHE:
-                philo_id, row = SHARED_CACHE[self.object_type]
-                if philo_id == self.philo_id:
-                    self.row = row
             if self.row is None:
                 self.row = self.db.get_id_lowlevel(self.philo_id)
-                if self.db.cached:
-                    SHARED_CACHE[self.object_type] = (self.philo_id, self.row)
             return _safe_lookup(self.row, key)
 
     def __getattr__(self, name):
@@ -143,11 +334,15 @@ class ObjectWrapper:
 class PageWrapper:
     """Class representing page objects"""
 
-    def __init__(self, id, db):
+    __slots__ = ("db", "philo_id", "object_type", "row", "bytes")
+
+    def __init__(self, id, db, rows=None):
         self.db = db
         self.philo_id = id
         self.object_type = "page"
         self.row = None
+        if rows is not None:
+            self.row = rows.get(("pages", " ".join(str(s) for s in id)))
         self.bytes = []
 
     def __getitem__(self, key):
@@ -167,13 +362,17 @@ class PageWrapper:
 class LineWrapper:
     """Class representing line objects"""
 
-    def __init__(self, philo_id, byte_offset, db):
+    __slots__ = ("db", "philo_id", "doc_id", "object_type", "hit_offset", "row", "bytes")
+
+    def __init__(self, philo_id, byte_offset, db, rows=None):
         self.db = db
         self.philo_id = philo_id
         self.doc_id = philo_id[0]
         self.object_type = "line"
         self.hit_offset = byte_offset
         self.row = None
+        if rows is not None:
+            self.row = rows.get(("lines", self.doc_id, byte_offset))
         self.bytes = []
 
     def __getitem__(self, key):
@@ -193,11 +392,15 @@ class LineWrapper:
 class WordWrapper:
     """Class representing word objects"""
 
-    def __init__(self, id, db, byte):
+    __slots__ = ("db", "philo_id", "object_type", "row", "byte")
+
+    def __init__(self, id, db, byte, rows=None):
         self.db = db
         self.philo_id = id
         self.object_type = "word"
         self.row = None
+        if rows is not None:
+            self.row = rows.get(("words", _id_string(id, db.width)))
         self.byte = byte
 
     def __getitem__(self, key):
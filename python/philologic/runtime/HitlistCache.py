@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Size- and age-bounded cache of query results in a database's hitlists/ directory.
+
+Every result is a group of files sharing a hash prefix: <hash>.hitlist with its .done, .terms and
+.error flags, or <hash>.approximate_terms. Accesses are recorded in hitlists/cache.db so that
+sweeps can evict the least recently (lru) or least frequently (lfu) used results once the
+directory exceeds its byte budget. Results still being written are never evicted.
+
+A search claims its hitlist by creating it exclusively and holding a shared flock on it until
+.done is written, so concurrent identical queries attach to the running search instead of
+starting another one. A hitlist without .done that nobody holds a lock on was abandoned by a
+crashed worker, and is discarded so that the search can be run again."""
+
+import fcntl
+import os
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+
+CACHE_DB = "cache.db"
+GRACE_PERIOD = 60  # results used this recently may still be read by a running search
+
+CacheEntry = namedtuple("CacheEntry", "files size mtime pinned")
+
+_CACHES = {}
+
+
+def entry_key(filename):
+    """Return the cache key shared by a result file and its side files"""
+    return os.path.basename(filename).split(".", 1)[0]
+
+
+class HitlistCache:
+    """Access tracking and eviction for one hitlists/ directory"""
+
+    def __init__(self, hitlist_path):
+        self.path = hitlist_path
+        self.db_file = os.path.join(hitlist_path, CACHE_DB)
+        self.conn = None
+
+    def __connect(self):
+        if self.conn is None:
+            new_file = not os.path.exists(self.db_file)
+            self.conn = sqlite3.connect(self.db_file, timeout=5)
+            self.conn.execute("PRAGMA synchronous=OFF")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, last_access REAL, accesses INTEGER)"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL)")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO stats VALUES (?, 0)",
+                [("hits",), ("misses",), ("evictions",), ("evicted_bytes",), ("last_sweep",)],
+            )
+            self.conn.commit()
+            if new_file:
+                try:
+                    os.chmod(self.db_file, 0o666)  # shared by the web server and the search daemon
+                except OSError:
+                    pass
+        return self.conn
+
+    def record_access(self, filename, hit):
+        """Record a lookup of a result, counting it as a cache hit or miss"""
+        try:
+            conn = self.__connect()
+            with conn:
+                conn.execute(
+                    "INSERT INTO entries VALUES (?, ?, 1) ON CONFLICT(key) DO UPDATE "
+                    "SET last_access=excluded.last_access, accesses=accesses+1",
+                    (entry_key(filename), time.time()),
+                )
+                conn.execute("UPDATE stats SET value=value+1 WHERE name=?", ("hits" if hit else "misses",))
+        except sqlite3.Error:
+            pass  # tracking is best effort and must never break a query
+
+    def entries(self):
+        """Group the files of the hitlists directory by cache key"""
+        files = {}
+        for dir_entry in os.scandir(self.path):
+            if dir_entry.name.startswith(CACHE_DB) or not dir_entry.is_file():
+                continue
+            try:
+                files.setdefault(entry_key(dir_entry.name), []).append((dir_entry.name, dir_entry.stat()))
+            except FileNotFoundError:
+                continue
+        groups = {}
+        for key, group in files.items():
+            names = [name for name, _ in group]
+            size = sum(stat.st_size for _, stat in group)
+            mtime = max(stat.st_mtime for _, stat in group)
+            in_progress = [name for name in names if name.endswith(".hitlist") and name + ".done" not in names]
+            pinned = any(not is_abandoned(os.path.join(self.path, name)) for name in in_progress)
+            groups[key] = CacheEntry(names, size, mtime, pinned)
+        return groups
+
+    def sweep(self, max_bytes, max_age=None, policy="lru"):
+        """Evict results unused for max_age seconds, then evict by policy until the directory
+        fits in max_bytes. Returns the number of results evicted."""
+        now = time.time()
+        conn = self.__connect()
+        accesses = {key: (last_access, count) for key, last_access, count in conn.execute("SELECT * FROM entries")}
+        entries = self.entries()
+        total = sum(entry.size for entry in entries.values())
+        evicted = []
+        candidates = []
+        for key, entry in entries.items():
+            last_access, count = accesses.get(key, (0, 0))
+            last_access = max(last_access, entry.mtime)
+            if entry.pinned or now - last_access < GRACE_PERIOD:
+                continue
+            if max_age and now - last_access > max_age:
+                evicted.append(key)
+                total -= entry.size
+            elif policy == "lfu":
+                candidates.append(((count, last_access), key))
+            else:
+                candidates.append((last_access, key))
+        candidates.sort()
+        for _, key in candidates:
+            if total <= max_bytes:
+                break
+            evicted.append(key)
+            total -= entries[key].size
+        evicted_bytes = 0
+        for key in evicted:
+            for name in entries[key].files:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+            evicted_bytes += entries[key].size
+        with conn:
+            conn.executemany("DELETE FROM entries WHERE key=?", [(key,) for key in evicted])
+            conn.executemany("DELETE FROM entries WHERE key=?", [(key,) for key in accesses if key not in entries])
+            conn.execute("UPDATE stats SET value=value+? WHERE name='evictions'", (len(evicted),))
+            conn.execute("UPDATE stats SET value=value+? WHERE name='evicted_bytes'", (evicted_bytes,))
+        return len(evicted)
+
+    def sweep_if_due(self, interval, max_bytes, max_age=None, policy="lru"):
+        """Sweep unless another process has done so in the last interval seconds"""
+        now = time.time()
+        try:
+            conn = self.__connect()
+            with conn:
+                claimed = conn.execute(
+                    "UPDATE stats SET value=? WHERE name='last_sweep' AND value<?", (now, now - interval)
+                ).rowcount
+            if claimed:
+                self.sweep(max_bytes, max_age, policy)
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        """Return hit/miss counters and the current size of the cache"""
+        conn = self.__connect()
+        stats = {name: value for name, value in conn.execute("SELECT * FROM stats")}
+        for name in ("hits", "misses", "evictions", "evicted_bytes"):
+            stats[name] = int(stats[name])
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        entries = self.entries()
+        stats["entries"] = len(entries)
+        stats["pinned"] = sum(1 for entry in entries.values() if entry.pinned)
+        stats["bytes"] = sum(entry.size for entry in entries.values())
+        return stats
+
+
+def claim(filename):
+    """Create and lock the hitlist of a new search. Returns it open for writing, or None if another
+    search already claimed it. The lock is released when the file and every copy of it inherited by
+    forked workers are closed, so close it only after writing .done."""
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        return None
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    return os.fdopen(fd, "wb")
+
+
+def _lock_abandoned(filename):
+    """Return the hitlist open with an exclusive lock if it was abandoned, else None"""
+    if os.path.exists(filename + ".done"):
+        return None
+    try:
+        hitlist_fh = open(filename, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(hitlist_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # the search may have finished, or been discarded and claimed again, since the first check
+        if os.stat(filename).st_ino == os.fstat(hitlist_fh.fileno()).st_ino:
+            if not os.path.exists(filename + ".done"):
+                return hitlist_fh
+    except OSError:
+        pass
+    hitlist_fh.close()
+    return None
+
+
+def is_abandoned(filename):
+    """True if the hitlist is unfinished and no live process holds its claim"""
+    hitlist_fh = _lock_abandoned(filename)
+    if hitlist_fh is None:
+        return False
+    hitlist_fh.close()
+    return True
+
+
+def discard_abandoned(filename):
+    """Remove an abandoned hitlist and its side files so that the search can be claimed again.
+    Returns True if it was abandoned."""
+    hitlist_fh = _lock_abandoned(filename)
+    if hitlist_fh is None:
+        return False
+    with hitlist_fh:
+        for name in (filename, filename + ".terms", filename + ".error"):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+    return True
+
+
+def get_cache(hitlist_path):
+    """Return the process-wide HitlistCache for a hitlists directory"""
+    if hitlist_path not in _CACHES:
+        _CACHES[hitlist_path] = HitlistCache(hitlist_path)
+    return _CACHES[hitlist_path]
+
+
+def record_access(filename, hit):
+    get_cache(os.path.dirname(filename)).record_access(filename, hit)
+
+
+if __name__ == "__main__":
+    for stat, value in get_cache(os.path.join(sys.argv[1], "hitlists")).stats().items():
+        print("%s: %s" % (stat, value))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Wake up hitlist readers when corpus_search writes hits or flags a hitlist as done, using inotify"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (OSError, AttributeError, TypeError):
+    # No inotify outside of Linux: HitList falls back to polling
+    _libc = None
+
+
+class HitlistNotifier:
+    """Watch a hitlist file for new hits and its directory for the .done flag.
+    Raises OSError when inotify is not available or no more instances can be created."""
+
+    def __init__(self, filename):
+        self.fd = -1
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            self.__add_watch(filename, IN_MODIFY | IN_CLOSE_WRITE)
+            self.__add_watch(os.path.dirname(filename) or ".", IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO)
+        except OSError:
+            self.close()
+            raise
+
+    def __add_watch(self, path, mask):
+        if _inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", path)
+
+    def wait(self, timeout):
+        """Block until the hitlist changes or timeout (in seconds) expires. Returns True on change."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __del__(self):
+        self.close()
@@ -7,7 +7,7 @@ import subprocess
 import sys
 import unicodedata
 
-from . import HitList
+from . import HitList, HitlistCache
 from .HitList import NoHits
 from .QuerySyntax import group_terms, parse_query
 
@@ -18,33 +18,58 @@ def metadata_query(db, filename, param_dicts, sort_order, raw_results=False):
     """Prepare and execute SQL metadata query."""
     if db.locals["debug"]:
         print("METADATA_QUERY:", param_dicts, file=sys.stderr)
+    corpus_fh = HitlistCache.claim(filename)
+    if corpus_fh is None:
+        # the same corpus is being written by another request: wait for it, since searches read it whole
+        corpus = HitList.HitList(filename, 0, db, raw=raw_results, sort_order=sort_order)
+        corpus.finish()
+        return corpus
     prev = None
     for d in param_dicts:
         query = query_recursive(db, d, prev, sort_order)
         prev = query
     try:
-        corpus_fh = open(filename, "wb")
         for corpus_obj in query:
             obj_id = [int(x) for x in corpus_obj["philo_id"].split(" ")]
             corpus_fh.write(struct.pack("=7i", *obj_id))
-        corpus_fh.close()
+        corpus_fh.flush()
     except Exception as e:
         print(str(e), file=sys.stderr)
         # should clean up file
         flag = open(filename + ".done", "w")
         flag.write("1")
         flag.close()
+        corpus_fh.close()
         return NoHits()
     flag = open(filename + ".done", "w")
     flag.write("1")
     flag.close()
+    corpus_fh.close()  # releases the claim on the corpus, so only once it is flagged as done
     return HitList.HitList(filename, 0, db, raw=raw_results, sort_order=sort_order)
 
 
 def query_recursive(db, param_dict, parent, sort_order):
     #    print >> sys.stderr, "query_recursive:",param_dict,parent
     r = query_lowlevel(db, param_dict, sort_order)
-    if parent:
+    if parent and db.philo_key_shifts is not None:
+        # same merge as below, comparing philo_keys with the key range of the outer object
+        try:
+            outer_hit = next(parent)
+        except StopIteration:
+            return
+        lowest, highest = corpus_key_range(db, outer_hit["philo_id"])
+        for inner_hit in r:
+            while highest < inner_hit["philo_key"]:
+                try:
+                    outer_hit = next(parent)
+                except StopIteration:
+                    return
+                lowest, highest = corpus_key_range(db, outer_hit["philo_id"])
+            if inner_hit["philo_key"] < lowest:
+                continue
+            else:
+                yield inner_hit
+    elif parent:
         try:
             outer_hit = next(parent)
         except StopIteration:
@@ -86,14 +111,15 @@ def query_lowlevel(db, param_dict, sort_order):
             clauses.append(sql_clause)
     if not sort_order:
         sort_order = ["rowid"]
+    columns = "philo_id, philo_key" if db.philo_key_shifts is not None else "philo_id"
     if clauses:
         query = (
-            "SELECT philo_id FROM toms WHERE "
+            "SELECT %s FROM toms WHERE " % columns
             + " AND ".join("(%s)" % c for c in clauses)
             + " order by %s;" % ", ".join(sort_order)
         )
     else:
-        query = "SELECT philo_id FROM toms order by %s;" % ", ".join(sort_order)
+        query = "SELECT %s FROM toms order by %s;" % (columns, ", ".join(sort_order))
     if db.locals["debug"]:
         print("INNER QUERY: ", "%s %% %s" % (query, vars), sort_order, file=sys.stderr)
     results = db.dbh.execute(query, vars)
@@ -267,6 +293,14 @@ def obj_cmp(x, y):
         return 0
 
 
+def corpus_key_range(db, philo_id):
+    """philo_key range of the objects matched by corpus_cmp against a corpus object"""
+    philo_id = str_to_hit(philo_id)
+    if 0 in philo_id:
+        philo_id = philo_id[: philo_id.index(0)]
+    return db.philo_key_range(philo_id)
+
+
 def corpus_cmp(x, y):
     if 0 in x:
         depth = x.index(0)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""Memory-mapped per-level object tables written by the object_index post filter.
+
+Each level (doc, div1, div2, div3, para) has its objects in document order, keyed by their philo_id
+packed into 64 bits with the widths of the loaded corpus. Hits and other philo_ids are mapped
+to their ancestor at a level with a vectorized binary search over the keys. The toms rows of each
+level are also stored column by column, so that metadata reads are array lookups shared by all
+processes through the page cache, with the SQLite table as the fallback. Requires NumPy."""
+
+import json
+import os
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LEVEL_DEPTHS = {"doc": 1, "div1": 2, "div2": 3, "div3": 4, "para": 5}
+DEPTH_LEVELS = {depth: level for level, depth in LEVEL_DEPTHS.items()}
+COLUMN_TYPES = {"codes": np.uint32, "int32": np.int32, "int64": np.int64} if np is not None else {}
+INT_NULLS = {"int32": -(1 << 31), "int64": -(1 << 63)}  # the smallest value stands for null
+
+_OBJECT_INDEXES = {}
+
+
+class ObjectIndex:
+    """Lookups and column access over the object tables of a database"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "objects.json")) as config_file:
+            self.config = json.load(config_file)
+        bits = self.config["bits"]
+        self.shifts = [np.uint64(sum(bits[position + 1 :])) for position in range(len(bits))]
+        self.limits = [1 << bit for bit in bits]
+        self.columns = self.config.get("columns", {})  # absent from databases loaded before columns
+        self.arrays = {}
+        self.row_views = {}
+        self.line_views = None
+        self.facets = {}
+        self.vocabulary = None
+        self.dictionary_value = lru_cache(maxsize=65536)(self.dictionary_value)
+
+    def array(self, name, dtype):
+        """Memory-map the array stored in data/objects/name"""
+        if name not in self.arrays:
+            filename = os.path.join(self.path, name)
+            if os.path.getsize(filename):
+                # a plain view indexes much faster than the memmap subclass
+                self.arrays[name] = np.memmap(filename, dtype=dtype, mode="r").view(np.ndarray)
+            else:
+                self.arrays[name] = np.zeros(0, dtype=dtype)
+        return self.arrays[name]
+
+    def keys(self, level):
+        return self.array(level + ".keys", np.uint64)
+
+    def pack(self, philo_ids, depth):
+        """Pack the first depth elements of each row of philo_ids. Returns the keys and a mask of the
+        rows whose elements all fit in the packed widths, i.e. which may exist in the database."""
+        keys = np.zeros(len(philo_ids), dtype=np.uint64)
+        valid = np.ones(len(philo_ids), dtype=bool)
+        for position in range(depth):
+            column = philo_ids[:, position]
+            valid &= column < self.limits[position]
+            keys |= column.astype(np.uint64) << self.shifts[position]
+        return keys, valid
+
+    def lookup(self, level, philo_ids):
+        """Return the position in the level's tables of the ancestor at that level of each row of
+        philo_ids (a 2-D array of hits or object ids), or -1 where there is none"""
+        philo_ids = np.asarray(philo_ids)
+        keys = self.keys(level)
+        packed, valid = self.pack(philo_ids, LEVEL_DEPTHS[level])
+        positions = np.searchsorted(keys, packed)
+        found = valid & (positions < len(keys))
+        found[found] = keys[positions[found]] == packed[found]
+        return np.where(found, positions, -1)
+
+    def word_counts(self, level):
+        """Prefix sums of the word counts of a level's objects, starting with 0"""
+        return self.array(level + ".word_counts", np.uint64)
+
+    def total_word_count(self, philo_ids):
+        """Sum the word counts of the distinct objects identified by the rows of philo_ids, as
+        stored in a corpus hitlist. Rows which are not doc, div or para objects count for 0."""
+        philo_ids = np.asarray(philo_ids)
+        nonzero = philo_ids[:, :5] != 0
+        depths = np.where(nonzero.any(axis=1), 5 - np.argmax(nonzero[:, ::-1], axis=1), 0)
+        objects = ~philo_ids[:, 5:].any(axis=1)
+        total = 0
+        for level in self.config.get("word_counts", []):
+            positions = self.lookup(level, philo_ids[objects & (depths == LEVEL_DEPTHS[level])])
+            positions = np.unique(positions[positions >= 0])
+            if not len(positions):
+                continue
+            # runs of consecutive objects are summed as one range of the prefix sums
+            breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+            starts = positions[np.concatenate(([0], breaks))]
+            ends = positions[np.concatenate((breaks - 1, [len(positions) - 1]))] + 1
+            prefix_sums = self.word_counts(level)
+            total += int((prefix_sums[ends] - prefix_sums[starts]).sum())
+        return total
+
+    def doc_offsets(self, level):
+        """Start position of the objects of each doc in a level's tables, followed by the end"""
+        return self.array(level + ".doc_offsets", np.uint32)
+
+    def has_columns(self, level):
+        return level in self.columns
+
+    def column(self, level, name):
+        """Return the stored values of a toms column for all objects of a level: an integer array with
+        the smallest value of its type for nulls, or a uint32 array of dictionary codes, 0 for nulls"""
+        for column_name, encoding in self.columns[level]:
+            if column_name == name and encoding != "philo_id":
+                return self.array("%s.%s.%s" % (level, name, encoding), COLUMN_TYPES[encoding])
+        raise KeyError(name)
+
+    def dictionary_value(self, level, name, code):
+        """Decode a dictionary code of a column"""
+        if not code:
+            return None
+        offsets = self.array("%s.%s.dictionary.offsets" % (level, name), np.uint64)
+        dictionary = self.array("%s.%s.dictionary" % (level, name), np.uint8)
+        return json.loads(dictionary[offsets[code - 1] : offsets[code]].tobytes().decode("utf8"))
+
+    def values(self, level, name, positions):
+        """Values of a toms column for the objects at the given positions of a level"""
+        stored = self.column(level, name)[positions]
+        if stored.dtype == np.uint32:
+            return [self.dictionary_value(level, name, code) for code in stored.tolist()]
+        null = np.iinfo(stored.dtype).min
+        return [None if value == null else value for value in stored.tolist()]
+
+    def dictionary(self, level, name):
+        """Decode all the values of a column dictionary, in code order from 1"""
+        offsets = self.array("%s.%s.dictionary.offsets" % (level, name), np.uint64).tolist()
+        dictionary = self.array("%s.%s.dictionary" % (level, name), np.uint8).tobytes()
+        return [json.loads(dictionary[start:end].decode("utf8")) for start, end in zip(offsets, offsets[1:])]
+
+    def facet_values(self, field, levels):
+        """Return the distinct non-null values of field over the objects of the given levels, and
+        for each level the id of the value of each object in that list, -1 for nulls"""
+        if (field, levels) not in self.facets:
+            values = []
+            value_ids = {}
+            level_ids = {}
+            for level in levels:
+                stored = self.column(level, field)
+                if stored.dtype == np.uint32:
+                    level_values = self.dictionary(level, field)
+                    local_ids = stored.astype(np.int64) - 1
+                else:
+                    not_null = stored != np.iinfo(stored.dtype).min
+                    level_values, inverse = np.unique(stored[not_null], return_inverse=True)
+                    level_values = level_values.tolist()
+                    local_ids = np.full(len(stored), -1, dtype=np.int64)
+                    local_ids[not_null] = inverse
+                mapping = np.array(
+                    [value_ids.setdefault(value, len(value_ids)) for value in level_values] + [-1], dtype=np.int64
+                )
+                level_ids[level] = mapping[local_ids]  # nulls take the trailing -1
+            values = [None] * len(value_ids)
+            for value, value_id in value_ids.items():
+                values[value_id] = value
+            self.facets[field, levels] = (values, level_ids)
+        return self.facets[field, levels]
+
+    def facet(self, field, levels, philo_ids):
+        """Map each row of philo_ids to the id of its value of field, taken from its ancestor at the first
+        of the levels which has a value for it. Rows with ancestors at those levels but no value are
+        mapped to -1, and rows without any ancestor at those levels to -2."""
+        level_ids = self.facet_values(field, levels)[1]
+        ids = np.full(len(philo_ids), -2, dtype=np.int64)
+        for level in levels:
+            positions = self.lookup(level, philo_ids)
+            unresolved = (ids < 0) & (positions >= 0)
+            ids[unresolved] = np.maximum(level_ids[level][positions[unresolved]], -1)
+        return ids
+
+    def facet_word_counts(self, field, levels, corpus=None):
+        """Sum the word counts of the objects with each value of field, as the total word count of a
+        metadata query on that value would. With corpus, the objects of a corpus hitlist of another
+        metadata query, only the objects nested within corpus objects, or the corpus objects nested
+        within objects with the value, are counted. Returns the sums per value id, followed by the sum
+        for the objects without a value."""
+        values, level_ids = self.facet_values(field, levels)
+        totals = np.zeros(len(values) + 1, dtype=np.float64)
+
+        def add(ids, weights):
+            ids = np.where(ids == -1, len(values), ids)  # nulls are summed in the trailing slot
+            has_value = ids >= 0
+            totals[:] += np.bincount(ids[has_value], weights=weights[has_value], minlength=len(totals))
+
+        corpus_depths = {}
+        if corpus is not None:
+            corpus = np.asarray(corpus)
+            nonzero = corpus[:, :5] != 0
+            depths = np.where(nonzero.any(axis=1), 5 - np.argmax(nonzero[:, ::-1], axis=1), 0)
+            corpus_depths = {depth: corpus[depths == depth] for depth in np.unique(depths[depths > 0]).tolist()}
+        for level in levels:
+            word_counts = np.diff(self.word_counts(level)).astype(np.float64)
+            if corpus is None:
+                add(level_ids[level], word_counts)
+            for depth, corpus_objects in corpus_depths.items():
+                if depth <= LEVEL_DEPTHS[level]:
+                    # objects of the level within a corpus object share its packed key prefix
+                    corpus_keys, valid = self.pack(corpus_objects, depth)
+                    prefix_mask = ~((np.uint64(1) << self.shifts[depth - 1]) - np.uint64(1))
+                    inside = np.isin(self.keys(level) & prefix_mask, corpus_keys[valid])
+                    add(level_ids[level][inside], word_counts[inside])
+                else:
+                    corpus_level = DEPTH_LEVELS[depth]
+                    positions = self.lookup(corpus_level, corpus_objects)
+                    ancestors = self.lookup(level, corpus_objects)
+                    found = (positions >= 0) & (ancestors >= 0)
+                    corpus_word_counts = np.diff(self.word_counts(corpus_level)).astype(np.float64)
+                    add(level_ids[level][ancestors[found]], corpus_word_counts[positions[found]])
+        return totals
+
+    def row(self, philo_id):
+        """Return the toms row of a doc, div or para object as a dict, or None if it is not stored in
+        the object tables, in which case it should be read from toms"""
+        philo_id = [int(i) for i in philo_id]
+        depth = len(philo_id)
+        while depth and not philo_id[depth - 1]:
+            depth -= 1
+        level = DEPTH_LEVELS.get(depth)
+        if level not in self.columns:
+            return None
+        key = 0
+        for value, limit, shift in zip(philo_id, self.limits, self.shifts):
+            if value >= limit:
+                return None
+            key |= value << int(shift)
+        if level not in self.row_views:
+            # memoryviews return Python ints, which is much faster than NumPy for single items
+            self.row_views[level] = (
+                memoryview(self.keys(level)),
+                [
+                    (name, encoding, None if encoding == "philo_id" else memoryview(self.column(level, name)))
+                    for name, encoding in self.columns[level]
+                ],
+            )
+        keys, columns = self.row_views[level]
+        position = bisect_left(keys, key)
+        if position == len(keys) or keys[position] != key:
+            return None
+        row = {}
+        for name, encoding, column in columns:
+            if encoding == "codes":
+                row[name] = self.dictionary_value(level, name, column[position])
+            elif encoding == "philo_id":
+                row[name] = " ".join(str(i) for i in philo_id[:depth] + [0] * (7 - depth))
+            else:
+                value = column[position]
+                row[name] = None if value == INT_NULLS[encoding] else value
+        return row
+
+    def has_lines(self):
+        return bool(self.config.get("lines"))
+
+    def line_rowid(self, doc_id, byte_offset):
+        """Return the rowid in the lines table of the line of a doc containing byte_offset, the first
+        one by start_byte and end_byte if lines overlap, or None. Lines are sorted by start_byte, so
+        those starting before the offset are a prefix, and the running maximum of end_byte finds the
+        first of them which ends after it."""
+        if self.line_views is None:
+            self.line_views = {
+                name: memoryview(self.array("lines." + name, np.uint64))
+                for name in ("starts", "max_ends", "rowids", "doc_offsets")
+            }
+        doc_offsets = self.line_views["doc_offsets"]
+        doc_id, byte_offset = int(doc_id), int(byte_offset)
+        if not 0 <= doc_id < len(doc_offsets) - 1:
+            return None
+        lo, hi = doc_offsets[doc_id], doc_offsets[doc_id + 1]
+        hi = bisect_left(self.line_views["starts"], byte_offset, lo, hi)
+        position = bisect_right(self.line_views["max_ends"], byte_offset, lo, hi)
+        if position == hi:
+            return None
+        return self.line_views["rowids"][position]
+
+    def has_years(self, field):
+        return field in self.config.get("years", {})
+
+    def year_range(self, field):
+        """First and last year of a field indexed by year"""
+        years = self.config["years"][field]
+        return years["first"], years["last"]
+
+    def year_totals(self, field, starts, ends, philo_type=None):
+        """Total word count, or number of objects of philo_type, of the objects whose year is within
+        each of the inclusive ranges from starts to ends"""
+        years = self.config["years"][field]
+        if philo_type is None:
+            prefix_sums = self.array("years.%s.word_counts" % field, np.uint64)
+        elif philo_type in years["types"]:
+            prefix_sums = self.array("years.%s.%s.counts" % (field, philo_type), np.uint64)
+        else:
+            return np.zeros(len(starts), dtype=np.int64)
+        span = years["last"] - years["first"] + 1
+        starts = np.clip(np.asarray(starts, dtype=np.int64) - years["first"], 0, span)
+        ends = np.clip(np.asarray(ends, dtype=np.int64) - years["first"] + 1, 0, span)
+        totals = prefix_sums[ends].astype(np.int64) - prefix_sums[starts].astype(np.int64)
+        return np.maximum(totals, 0)
+
+    def has_words(self):
+        return bool(self.config.get("words"))
+
+    def word_positions(self, philo_ids):
+        """Return the position in the token stream of the word identified by each row of philo_ids
+        (a 2-D array of 7 element word ids), or -1 where there is no such word"""
+        philo_ids = np.asarray(philo_ids)
+        bits = self.config["words"]["bits"]
+        keys = np.zeros(len(philo_ids), dtype=np.uint64)
+        valid = np.ones(len(philo_ids), dtype=bool)
+        for position, bit in enumerate(bits):
+            column = philo_ids[:, position]
+            valid &= column < (1 << bit)
+            keys |= column.astype(np.uint64) << np.uint64(sum(bits[position + 1 :]))
+        word_keys = self.array("words.keys", np.uint64)
+        positions = np.searchsorted(word_keys, keys)
+        found = valid & (positions < len(word_keys))
+        found[found] = word_keys[positions[found]] == keys[found]
+        if not self.config["words"]["in_order"]:
+            positions[found] = self.array("words.positions", np.uint64)[positions[found]]
+        return np.where(found, positions, -1)
+
+    def token_stream(self):
+        """Vocabulary ids of all the words in document order"""
+        return self.array("words.names", np.uint32)
+
+    def sentence_starts(self):
+        """Position in the token stream of the first word of each sentence, followed by the end"""
+        return self.array("words.sentences", np.uint64)
+
+    def words(self):
+        """The words of the vocabulary ids of the token stream, and a dict of their ids"""
+        if self.vocabulary is None:
+            offsets = self.array("words.vocabulary.offsets", np.uint64).tolist()
+            vocabulary = self.array("words.vocabulary", np.uint8).tobytes()
+            words = [json.loads(vocabulary[start:end].decode("utf8")) for start, end in zip(offsets, offsets[1:])]
+            self.vocabulary = (words, {word: word_id for word_id, word in enumerate(words)})
+        return self.vocabulary
+
+    def has_word_counts(self):
+        return bool(self.config.get("word_counts"))
+
+    def has_ranks(self, fields):
+        return all(field in self.config["ranks"] for field in fields)
+
+    def sort_ranks(self, field, philo_ids):
+        """Collation rank of field for each row of philo_ids, taken from its deepest ancestor with a
+        value for field, as in the metadata sort of HitList"""
+        ranks = np.full(len(philo_ids), self.config["ranks"][field]["missing"], dtype=np.uint32)
+        resolved = np.zeros(len(philo_ids), dtype=bool)
+        for level in reversed(self.config["ranks"][field]["levels"]):
+            positions = self.lookup(level, philo_ids)
+            level_ranks = self.array("%s.%s.ranks" % (level, field), np.uint32)
+            found = ~resolved & (positions >= 0)
+            found[found] = level_ranks[positions[found]] > 0
+            ranks[found] = level_ranks[positions[found]]
+            resolved |= found
+        return ranks
+
+    def sort(self, philo_ids, fields):
+        """Return the stable order of philo_ids sorted by the given metadata fields"""
+        return np.lexsort([self.sort_ranks(field, philo_ids) for field in reversed(fields)])
+
+
+def load_object_index(db_path):
+    """Return the process-wide ObjectIndex of a database, or None if NumPy is missing or the
+    database was loaded without object tables. Reopened when the tables are rebuilt."""
+    if np is None:
+        return None
+    path = os.path.join(db_path, "objects")
+    try:
+        mtime = os.stat(os.path.join(path, "objects.json")).st_mtime
+    except OSError:
+        return None
+    if path not in _OBJECT_INDEXES or _OBJECT_INDEXES[path][0] != mtime:
+        _OBJECT_INDEXES[path] = (mtime, ObjectIndex(path))
+    return _OBJECT_INDEXES[path][1]
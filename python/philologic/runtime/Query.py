@@ -5,15 +5,22 @@ import os
 import subprocess
 import re
 import sys
+import traceback
 import unicodedata
 from datetime import datetime
 
-from philologic.runtime import HitList
+from philologic.runtime import HitList, HitlistCache, libphilo, search_daemon
 from philologic.runtime.QuerySyntax import group_terms, parse_query
+from philologic.runtime.TermIndex import load_term_index
 
 # Work around issue where environ PATH does not contain path to C core
 os.environ["PATH"] += ":/usr/local/bin/"
 
+# Hits written and made readable before the rest of the search, enough for a page of concordance
+FIRST_PAGE = 25
+# Exit status of corpus_search when it stopped at its limit before the end of the results
+EXIT_TRUNCATED = 2
+
 
 def query(
     db,
@@ -22,7 +29,7 @@ def query(
     corpus_size=0,
     method=None,
     method_arg=None,
-    limit=3000,
+    limit=None,
     filename="",
     query_debug=False,
     sort_order=None,
@@ -41,55 +48,169 @@ def query(
         hfile = str(origpid) + ".hitlist"
     dir = db.path + "/hitlists/"
     filename = filename or (dir + hfile)
-    hl = open(filename, "wb")
-    err = open("/dev/null", "w")
-    freq_file = db.path + "/frequencies/normalized_word_frequencies"
+    # the daemon worker claims the hitlist itself, or finds it claimed by an identical running query
+    if search_daemon.submit(db.path, terms, corpus_file, method, method_arg, filename, limit):
+        if query_debug:
+            print("QUERY SENT TO SEARCH DAEMON", file=sys.stderr)
+        return HitList.HitList(
+            filename,
+            words_per_hit,
+            db,
+            sort_order=sort_order,
+            raw=raw_results,
+            terms=split,
+            corpus_file=corpus_file,
+        )
+    hl = HitlistCache.claim(filename)
+    if hl is None:
+        # an identical query, or a daemon worker which acknowledged too late, is already writing it
+        if query_debug:
+            print("ATTACHING TO RUNNING SEARCH", file=sys.stderr)
+        return HitList.HitList(
+            filename,
+            words_per_hit,
+            db,
+            sort_order=sort_order,
+            raw=raw_results,
+            terms=split,
+            corpus_file=corpus_file,
+        )
     if query_debug:
         print("FORKING", file=sys.stderr)
     pid = os.fork()
     if pid == 0:
-        os.umask(0)
-        os.chdir(dir)
-        os.setsid()
-        pid = os.fork()
-        if pid > 0:
-            os._exit(0)
-        else:
-            # now we're detached from the parent, and can do our work.
-            if query_debug:
-                print("WORKER DETACHED at ", datetime.now() - tstart, file=sys.stderr)
-            args = ["corpus_search"]
-            if corpus_file:
-                args.extend(("-c", corpus_file))
-            if method and method_arg:
-                args.extend(("-m", method, "-a", str(method_arg)))
-            args.extend(("-o", "binary", db.path))
-
-            worker = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=hl, stderr=err, env=os.environ)
-            # worker2 = subprocess.Popen("head -c 1", stdin=subprocess.PIPE, stdout=worker.stdin, stderr=err)
-
-            query_log_fh = filename + ".terms"
-            if query_debug:
-                print("LOGGING TERMS to " + filename + ".terms", file=sys.stderr)
-            logger = subprocess.Popen(["tee", query_log_fh], stdin=subprocess.PIPE, stdout=worker.stdin)
-            expand_query_not(split, freq_file, logger.stdin, db.locals["lowercase_index"])
-            logger.stdin.close()
-            worker.stdin.close()
-
-            returncode = worker.wait()
-
-            if returncode == -11:
-                print("SEGFAULT", file=sys.stderr)
-                seg_flag = open(filename + ".error", "w")
-                seg_flag.close()
-            # do something to mark query as finished
-            flag = open(filename + ".done", "w")
-            flag.write(" ".join(args) + "\n")
-            flag.close()
-            os._exit(0)
+        # never return from here: an exception would run the rest of the web request in the worker
+        status = 1
+        try:
+            os.umask(0)
+            os.chdir(dir)
+            os.setsid()
+            pid = os.fork()
+            if pid > 0:
+                status = 0
+            else:
+                # now we're detached from the parent, and can do our work.
+                if query_debug:
+                    print("WORKER DETACHED at ", datetime.now() - tstart, file=sys.stderr)
+                run_search(
+                    db.path,
+                    split,
+                    corpus_file,
+                    method,
+                    method_arg,
+                    filename,
+                    db.locals["lowercase_index"],
+                    limit=limit,
+                    hitlist_fh=hl,
+                    query_debug=query_debug,
+                )
+                status = 0
+        except Exception:
+            traceback.print_exc()
+            flag_error(filename, "query worker error")
+        finally:
+            os._exit(status)
     else:
         hl.close()
-        return HitList.HitList(filename, words_per_hit, db, sort_order=sort_order, raw=raw_results)
+        return HitList.HitList(
+            filename,
+            words_per_hit,
+            db,
+            sort_order=sort_order,
+            raw=raw_results,
+            terms=split,
+            corpus_file=corpus_file,
+        )
+
+
+def flag_error(filename, message):
+    """Flag a hitlist whose search failed as done, with an error, so that readers stop waiting for it"""
+    open(filename + ".error", "w").close()
+    with open(filename + ".done", "w") as flag:
+        flag.write(message + "\n")
+
+
+def run_search(
+    db_path,
+    split,
+    corpus_file,
+    method,
+    method_arg,
+    filename,
+    lowercase=True,
+    limit=None,
+    first_page=FIRST_PAGE,
+    hitlist_fh=None,
+    query_debug=False,
+):
+    """Run corpus_search on split terms, writing binary hits to filename and flagging it as done.
+    The search stops after limit hits, and the first first_page hits are made readable at once.
+    This is the body of the detached query worker, shared with the search daemon."""
+    if hitlist_fh is None:
+        hitlist_fh = open(filename, "wb")
+    groups = expand_groups(split, db_path, lowercase)
+    if groups is not None and libphilo.available():
+        try:
+            word_search = libphilo.Search(db_path, groups, corpus_file, method, method_arg)
+        except (OSError, ValueError):
+            word_search = None
+        if word_search is not None:
+            if query_debug:
+                print("SEARCHING IN PROCESS", file=sys.stderr)
+            with open(filename + ".terms", "wb") as terms_file:
+                terms_file.write(format_expanded_query(groups))
+            with word_search:
+                truncated = libphilo.write_hits(word_search, hitlist_fh, limit, first_page)
+            with open(filename + ".done", "w") as flag:
+                if truncated:
+                    flag.write("truncated\n")
+                flag.write("libcorpus_search %s\n" % db_path)
+            hitlist_fh.close()  # releases the claim on the hitlist, so only once it is flagged as done
+            return
+    err = open("/dev/null", "w")
+    freq_file = db_path + "/frequencies/normalized_word_frequencies"
+    args = ["corpus_search"]
+    if corpus_file:
+        args.extend(("-c", corpus_file))
+    if method and method_arg:
+        args.extend(("-m", method, "-a", str(method_arg)))
+    if limit:
+        args.extend(("-l", str(limit)))
+    if first_page:
+        args.extend(("-p", str(first_page)))
+    args.extend(("-o", "binary", db_path))
+
+    worker = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=hitlist_fh, stderr=err, env=os.environ)
+    # worker2 = subprocess.Popen("head -c 1", stdin=subprocess.PIPE, stdout=worker.stdin, stderr=err)
+
+    query_log_fh = filename + ".terms"
+    if query_debug:
+        print("LOGGING TERMS to " + filename + ".terms", file=sys.stderr)
+    if groups is not None:
+        expanded = format_expanded_query(groups)
+        with open(query_log_fh, "wb") as terms_file:
+            terms_file.write(expanded)
+        worker.stdin.write(expanded)
+    else:
+        logger = subprocess.Popen(["tee", query_log_fh], stdin=subprocess.PIPE, stdout=worker.stdin)
+        expand_query_not(split, freq_file, logger.stdin, lowercase)
+        logger.stdin.close()
+    worker.stdin.close()
+
+    returncode = worker.wait()
+    err.close()
+
+    if returncode == -11:
+        print("SEGFAULT", file=sys.stderr)
+        seg_flag = open(filename + ".error", "w")
+        seg_flag.close()
+    # do something to mark query as finished
+    flag = open(filename + ".done", "w")
+    if returncode == EXIT_TRUNCATED:
+        flag.write("truncated\n")
+    flag.write(" ".join(args) + "\n")
+    flag.close()
+    hitlist_fh.close()
 
 
 def get_expanded_query(hitlist):
@@ -128,6 +249,24 @@ def split_terms(grouped):
     return split
 
 
+def expand_groups(split, db_path, lowercase=True):
+    """Expand split terms in-process with the TermIndex, returning one word list per group.
+    Returns None when the database has no vocabulary index or a term is not a valid Python regex
+    or uses egrep-only syntax, in which case callers should use the egrep pipeline."""
+    term_index = load_term_index(db_path)
+    if term_index is None:
+        return None
+    try:
+        return term_index.expand(split, lowercase)
+    except re.error:
+        return None
+
+
+def format_expanded_query(groups):
+    """Format expanded groups as corpus_search input, as written by expand_query_not"""
+    return "\n".join("".join(word + "\n" for word in group) for group in groups).encode("utf8")
+
+
 def expand_query_not(split, freq_file, dest_fh, lowercase=True):
     first = True
     grep_proc = None
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Process-wide LRU cache of the toms, pages, lines and words rows read through DB.
+
+There is one bounded cache per database, keyed by (table, philo_id) or, for lines, by
+("lines", doc_id, byte_offset). It outlives DB instances so that a long-lived WSGI process keeps
+it across requests, and it is cleared when toms.db is modified, e.g. by reloading the database."""
+
+import os
+import threading
+from collections import OrderedDict
+
+ROW_CACHE_SIZE = 50000  # default maximum number of rows per database
+MISSING = object()  # returned by RowCache.get for keys which are not cached
+
+_ROW_CACHES = {}
+
+
+class RowCache:
+    """Bounded least recently used mapping of row keys to rows, with hit-rate counters"""
+
+    def __init__(self, max_size=ROW_CACHE_SIZE):
+        self.max_size = max_size
+        self.rows = OrderedDict()
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key):
+        """Return the cached row for key, which may be None for rows known not to exist, or MISSING"""
+        with self.lock:
+            try:
+                row = self.rows[key]
+            except KeyError:
+                self.misses += 1
+                return MISSING
+            self.rows.move_to_end(key)
+            self.hits += 1
+            return row
+
+    def put(self, key, row):
+        with self.lock:
+            self.rows[key] = row
+            self.rows.move_to_end(key)
+            self.__evict()
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self.__evict()
+
+    def __evict(self):
+        while len(self.rows) > self.max_size:
+            self.rows.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+
+    def stats(self):
+        """Return the size and counters of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.rows),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def get_row_cache(db_path, max_size=None):
+    """Return the RowCache of a database, emptied if toms.db changed since the last call.
+    max_size resizes the cache when given."""
+    db_path = os.path.abspath(db_path)
+    try:
+        mtime = os.stat(os.path.join(db_path, "toms.db")).st_mtime
+    except OSError:
+        mtime = None
+    if db_path not in _ROW_CACHES:
+        _ROW_CACHES[db_path] = RowCache()
+    cache = _ROW_CACHES[db_path]
+    if cache.mtime != mtime:
+        cache.clear()
+        cache.mtime = mtime
+    if max_size is not None and max_size != cache.max_size:
+        cache.resize(max_size)
+    return cache
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""In-process term expansion over the memory-mapped vocabulary built at load time"""
+
+import mmap
+import os
+import re
+import unicodedata
+
+_TERM_INDEXES = {}
+_REGEX_META = set(".[](){}*+?|^$\\")
+_QUANTIFIERS = set("*+?{")
+# POSIX bracket classes, back-references and GNU escapes, and Python extensions
+_EGREP_ONLY = re.compile(r"\[[:=.]|\\[0-9A-Za-z<>`']|\(\?")
+
+
+class UnsupportedPattern(re.error):
+    """A term whose egrep meaning a Python regex does not reproduce"""
+
+
+def compile_pattern(pattern):
+    """Compile a term to match whole words, raising UnsupportedPattern for egrep syntax which Python
+    reads differently, or for alternation outside parentheses, which the egrep pipeline only anchors
+    on its first branch"""
+    if _EGREP_ONLY.search(pattern) or top_level_alternation(pattern):
+        raise UnsupportedPattern("egrep syntax in %s" % pattern, pattern)
+    return re.compile(pattern)
+
+
+def top_level_alternation(pattern):
+    """True if pattern has a | outside of parentheses and bracket expressions"""
+    depth = 0
+    position = 0
+    length = len(pattern)
+    while position < length:
+        char = pattern[position]
+        if char == "\\":
+            position += 1
+        elif char == "[":
+            position += 1
+            if position < length and pattern[position] == "^":
+                position += 1
+            if position < length and pattern[position] == "]":
+                position += 1
+            while position < length and pattern[position] != "]":
+                position += 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth <= 0:
+            return True
+        position += 1
+    return False
+
+
+def normalize_token(token, lowercase=True):
+    """Apply the lowercasing and accent stripping used to build normalized_word_frequencies"""
+    if lowercase:
+        token = token.lower()
+    return "".join(i for i in unicodedata.normalize("NFKD", token) if not unicodedata.combining(i))
+
+
+def literal_runs(pattern):
+    """Split a regex into the literal prefix every match starts with and the literal substrings
+    every match contains. Returns (prefix, runs); alternation at the top level disables both."""
+    runs = []
+    current = ""
+    prefix = None
+    position = 0
+    length = len(pattern)
+    while position < length:
+        char = pattern[position]
+        literal = None
+        if char == "\\" and position + 1 < length and not pattern[position + 1].isalnum():
+            literal = pattern[position + 1]
+            position += 2
+        elif char not in _REGEX_META:
+            literal = char
+            position += 1
+        elif char == "|":
+            return "", []
+        elif char == "[":
+            position += 1
+            if position < length and pattern[position] == "^":
+                position += 1
+            if position < length and pattern[position] == "]":
+                position += 1
+            while position < length and pattern[position] != "]":
+                if pattern[position] == "[" and pattern[position + 1 : position + 2] == ":":
+                    class_end = pattern.find(":]", position + 2)
+                    position = class_end + 2 if class_end != -1 else length
+                else:
+                    position += 1
+            position += 1
+        elif char == "(":
+            depth = 0
+            while position < length:
+                if pattern[position] == "\\":
+                    position += 1
+                elif pattern[position] == "(":
+                    depth += 1
+                elif pattern[position] == ")":
+                    depth -= 1
+                    if depth == 0:
+                        break
+                position += 1
+            position += 1
+        else:
+            position += 1
+        if literal is not None and position < length and pattern[position] in _QUANTIFIERS:
+            if pattern[position] == "+":
+                current += literal
+            literal = None
+        if literal is not None:
+            current += literal
+            continue
+        if prefix is None:
+            prefix = current
+        if current:
+            runs.append(current)
+        current = ""
+        while position < length and pattern[position] in _QUANTIFIERS:
+            if pattern[position] == "{":
+                repeat_end = pattern.find("}", position)
+                position = repeat_end if repeat_end != -1 else length
+            position += 1
+    if prefix is None:
+        prefix = current
+    if current:
+        runs.append(current)
+    return prefix, runs
+
+
+class TermIndex:
+    """Sorted vocabulary of norm_word TAB word lines with a byte trigram index, all memory-mapped.
+    Reproduces the egrep based expansion of Query.expand_query_not without spawning processes."""
+
+    def __init__(self, frequencies_path):
+        self.path = frequencies_path
+        self.vocabulary = self.__map("vocabulary")
+        self.offsets = self.__map("vocabulary.offsets").cast("Q")
+        self.trigrams = self.__map("vocabulary.trigrams")
+        self.trigram_offsets = self.__map("vocabulary.trigrams.offsets").cast("Q")
+        self.postings = self.__map("vocabulary.trigrams.postings").cast("I")
+        try:
+            self.counts = self.__map("vocabulary.counts").cast("Q")
+        except FileNotFoundError:  # databases loaded before word counts were stored
+            self.counts = None
+        self.size = len(self.offsets)
+        self.trigram_count = len(self.trigrams) // 3
+
+    def __map(self, name):
+        with open(os.path.join(self.path, name), "rb") as file_handle:
+            try:
+                return memoryview(mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ))
+            except ValueError:  # empty file
+                return memoryview(b"")
+
+    def __len__(self):
+        return self.size
+
+    def line(self, n):
+        """Return the norm_word and word of line n as bytes"""
+        start = self.offsets[n]
+        if n + 1 < self.size:
+            end = self.offsets[n + 1] - 1
+        else:
+            end = len(self.vocabulary) - 1
+        norm_word, word = self.vocabulary[start:end].tobytes().split(b"\t", 1)
+        return norm_word, word
+
+    def norm_word(self, n):
+        return self.line(n)[0]
+
+    def prefix_range(self, prefix):
+        """Binary search for the lines whose normalized form starts with prefix"""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.norm_word(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+        hi = self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.norm_word(mid)[: len(prefix)] <= prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start, lo
+
+    def trigram_postings(self, trigram):
+        """Return the sorted line numbers containing trigram"""
+        lo, hi = 0, self.trigram_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.trigrams[mid * 3 : mid * 3 + 3].tobytes() < trigram:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.trigram_count or self.trigrams[lo * 3 : lo * 3 + 3].tobytes() != trigram:
+            return self.postings[0:0]
+        return self.postings[self.trigram_offsets[lo] : self.trigram_offsets[lo + 1]]
+
+    def candidates(self, prefix, runs):
+        """Return line numbers which may match a pattern with the given literal prefix and runs"""
+        start, end = self.prefix_range(prefix.encode("utf8"))
+        trigrams = set()
+        for run in runs:
+            run = run.encode("utf8")
+            trigrams.update(run[i : i + 3] for i in range(len(run) - 2))
+        if not trigrams:
+            return range(start, end)
+        postings = sorted((self.trigram_postings(trigram) for trigram in trigrams), key=len)
+        shortest = postings[0]
+        lo = _bisect(shortest, start)
+        hi = _bisect(shortest, end)
+        matches = []
+        for line_number in shortest[lo:hi]:
+            for other in postings[1:]:
+                position = _bisect(other, line_number)
+                if position == len(other) or other[position] != line_number:
+                    break
+            else:
+                matches.append(line_number)
+        return matches
+
+    def grep_word(self, token, lowercase=True):
+        """Line numbers whose normalized form matches token, like grep_word"""
+        pattern = normalize_token(token, lowercase)
+        regex = compile_pattern(pattern)
+        prefix, runs = literal_runs(pattern)
+        if prefix == pattern:
+            start, end = self.prefix_range(pattern.encode("utf8"))
+            return [n for n in range(start, end) if self.norm_word(n) == pattern.encode("utf8")]
+        if pattern.startswith(prefix) and pattern[len(prefix) :] == ".*":
+            return list(range(*self.prefix_range(prefix.encode("utf8"))))
+        return [n for n in self.candidates(prefix, runs) if regex.fullmatch(self.norm_word(n).decode("utf8"))]
+
+    def grep_exact(self, token):
+        """Line numbers whose word matches a quoted token exactly, like grep_exact"""
+        pattern = token[1:-1]
+        regex = compile_pattern(pattern)
+        prefix, runs = literal_runs(pattern)
+        # The normalized forms only give a conservative filter: lowercasing the last character of the
+        # prefix depends on its context (e.g. final sigma) so it is left out of the binary search.
+        prefix = normalize_token(prefix)[:-1]
+        runs = [normalize_token(run)[:-1] for run in runs]
+        return [n for n in self.candidates(prefix, runs) if regex.fullmatch(self.line(n)[1].decode("utf8"))]
+
+    def group_lines(self, group, lowercase=True):
+        """Line numbers of the words matched by one OR group with its NOT clauses"""
+        exclude = []
+        for i, (kind, token) in enumerate(group):
+            if kind == "NOT":
+                exclude = group[i + 1 :]
+                group = group[:i]
+                break
+        line_numbers = set()
+        for kind, token in group:
+            if kind == "TERM" or kind == "RANGE":
+                line_numbers.update(self.grep_word(token, lowercase))
+            elif kind == "QUOTE":
+                line_numbers.update(self.grep_exact(token))
+        matches = []
+        excluded = [
+            (kind, compile_pattern(normalize_token(token, lowercase) if kind == "TERM" else token[1:-1]))
+            for kind, token in exclude
+            if kind == "TERM" or kind == "QUOTE"
+        ]
+        for n in line_numbers:
+            norm_word, word = (i.decode("utf8") for i in self.line(n))
+            for kind, regex in excluded:
+                if kind == "TERM" and regex.fullmatch(norm_word):
+                    break
+                if kind == "QUOTE" and regex.fullmatch(word):
+                    break
+            else:
+                matches.append(n)
+        return matches
+
+    def expand_group(self, group, lowercase=True):
+        """Expand one OR group with its NOT clauses into the sorted list of unique index words"""
+        return sorted(set(self.line(n)[1].decode("utf8") for n in self.group_lines(group, lowercase)))
+
+    def group_frequency(self, group, lowercase=True):
+        """Number of occurrences in the corpus of the words matched by a group, or None if the
+        vocabulary was built without word counts or cannot expand the group"""
+        if self.counts is None:
+            return None
+        try:
+            return sum(self.counts[n] for n in self.group_lines(group, lowercase))
+        except re.error:
+            return None
+
+    def expand(self, split, lowercase=True):
+        """Expand split query groups, returning one sorted word list per group"""
+        return [self.expand_group(group, lowercase) for group in split]
+
+
+def _bisect(sequence, value):
+    lo, hi = 0, len(sequence)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if sequence[mid] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def load_term_index(db_path):
+    """Return the process-wide TermIndex for a database, or None if it was loaded without one.
+    The index is reopened when the vocabulary changes, e.g. after reloading the database."""
+    frequencies_path = os.path.join(db_path, "frequencies")
+    try:
+        mtime = os.stat(os.path.join(frequencies_path, "vocabulary")).st_mtime
+    except OSError:
+        return None
+    if frequencies_path not in _TERM_INDEXES or _TERM_INDEXES[frequencies_path][0] != mtime:
+        try:
+            _TERM_INDEXES[frequencies_path] = (mtime, TermIndex(frequencies_path))
+        except OSError:
+            return None
+    return _TERM_INDEXES[frequencies_path][1]
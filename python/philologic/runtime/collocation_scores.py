@@ -1,16 +1,102 @@
 #!/usr/bin/env python3
-"""Compute collocation scores"""
+"""Compute collocation scores
 
+Collocates are scored all at once from arrays of their counts in the windows of the hits and of their
+corpus frequencies, read from frequencies/word_frequencies once per process. Each collocate is the cell
+of a 2x2 contingency table: its count in the windows (O11), the total count of all collocates in the
+windows (R1), its corpus frequency (C1) and the corpus word count (N)."""
 
-from math import log
+import os
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-def pointwise_mutual_information(total_word_count, collocate_count, collocate, cursor):
-    """Calculate Pointwise Mutual Information."""
-    if collocate_count < 5:
-        return 0
-    query = """select count(*) from words where philo_name='%s'""" % collocate
-    cursor.execute(query)
-    total_collocate_count = cursor.fetchone()[0]
-    score = log(collocate_count / total_word_count * total_collocate_count)
-    return score
+MIN_PMI_COUNT = 5  # collocates seen fewer times get a PMI of 0
+MEASURES = ("pmi", "log_likelihood", "t_score", "dice")
+
+_WORD_FREQUENCIES = {}
+
+
+def load_word_frequencies(db_path):
+    """Return the corpus frequency of each word as a dict and the corpus word count, cached per process
+    and reread when word_frequencies changes"""
+    filename = os.path.join(db_path, "frequencies", "word_frequencies")
+    mtime = os.stat(filename).st_mtime
+    if filename not in _WORD_FREQUENCIES or _WORD_FREQUENCIES[filename][0] != mtime:
+        frequencies = {}
+        with open(filename, encoding="utf8") as frequencies_file:
+            for line in frequencies_file:
+                try:
+                    word, count = line.rstrip("\n").split("\t")
+                    frequencies[word] = int(count)
+                except ValueError:
+                    continue
+        _WORD_FREQUENCIES[filename] = (mtime, frequencies, sum(frequencies.values()))
+    return _WORD_FREQUENCIES[filename][1:]
+
+
+def corpus_counts(db_path, words):
+    """Corpus frequencies of words, and the corpus word count"""
+    frequencies, total_words = load_word_frequencies(db_path)
+    return np.array([frequencies.get(word, 0) for word in words], dtype=np.float64), total_words
+
+
+def contingency(counts, corpus_frequencies, total_words):
+    """Observed counts O11, R1, C1 and N, and expected count E11, as float arrays"""
+    o11 = np.asarray(counts, dtype=np.float64)
+    r1 = o11.sum()
+    # a collocate is seen at least as often in the corpus as in the windows
+    c1 = np.maximum(np.asarray(corpus_frequencies, dtype=np.float64), o11)
+    n = max(float(total_words), r1, c1.max(initial=0))
+    return o11, r1, c1, n, r1 * c1 / n
+
+
+def pointwise_mutual_information(counts, corpus_frequencies, total_words):
+    """log2(O11 / E11), 0 for collocates seen fewer than MIN_PMI_COUNT times"""
+    o11, r1, c1, n, e11 = contingency(counts, corpus_frequencies, total_words)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.log2(o11 / e11)
+    return np.where((o11 >= MIN_PMI_COUNT) & np.isfinite(scores), scores, 0.0)
+
+
+def log_likelihood(counts, corpus_frequencies, total_words):
+    """Dunning's G2 over the four cells of the contingency table"""
+    o11, r1, c1, n, e11 = contingency(counts, corpus_frequencies, total_words)
+    observed = (o11, r1 - o11, c1 - o11, n - r1 - c1 + o11)
+    expected = (e11, r1 * (n - c1) / n, (n - r1) * c1 / n, (n - r1) * (n - c1) / n)
+    scores = np.zeros(len(o11))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for observed_cell, expected_cell in zip(observed, expected):
+            observed_cell = np.maximum(observed_cell, 0)
+            terms = observed_cell * np.log(observed_cell / expected_cell)
+            scores += np.where(observed_cell > 0, terms, 0.0)
+    return 2 * scores
+
+
+def t_score(counts, corpus_frequencies, total_words):
+    """(O11 - E11) / sqrt(O11)"""
+    o11, r1, c1, n, e11 = contingency(counts, corpus_frequencies, total_words)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(o11 > 0, (o11 - e11) / np.sqrt(o11), 0.0)
+
+
+def dice(counts, corpus_frequencies, total_words):
+    """2 * O11 / (R1 + C1)"""
+    o11, r1, c1, n, e11 = contingency(counts, corpus_frequencies, total_words)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(r1 + c1 > 0, 2 * o11 / (r1 + c1), 0.0)
+
+
+SCORE_FUNCTIONS = {
+    "pmi": pointwise_mutual_information,
+    "log_likelihood": log_likelihood,
+    "t_score": t_score,
+    "dice": dice,
+}
+
+
+def association_scores(counts, corpus_frequencies, total_words, measures=MEASURES):
+    """Return a dict of the score arrays of the collocates for each of the measures"""
+    return {measure: SCORE_FUNCTIONS[measure](counts, corpus_frequencies, total_words) for measure in measures}
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Restrict a finished word search hitlist to a corpus of metadata objects without searching again.
+
+A hit belongs to the corpus when the philo_id of its first word starts with the id of a corpus
+object, which is how corpus_search -c matches them. Object ids are grouped by depth, and the hit
+prefixes of each depth are tested for membership in one vectorized pass per chunk of hits."""
+
+import mmap
+import os
+import struct
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CHUNK_SIZE = 65536  # hits filtered at a time
+
+
+def read_corpus(corpus_file):
+    """Return the object ids of a corpus hitlist grouped by depth, as {depth: set of id prefixes}"""
+    objects = {}
+    with open(corpus_file, "rb") as corpus_fh:
+        for object_id in struct.iter_unpack("=7I", corpus_fh.read()):
+            depth = 7
+            while depth and not object_id[depth - 1]:
+                depth -= 1
+            objects.setdefault(depth, set()).add(object_id[:depth])
+    return objects
+
+
+def pack_prefixes(objects, depth):
+    """Pack id prefixes of the given depth into integers with the smallest radix per position that
+    fits the corpus. Returns the sorted packed corpus keys and the radices, or None if the keys
+    would not fit in 63 bits."""
+    prefixes = np.array(sorted(objects), dtype=np.uint64).reshape(len(objects), depth)
+    radices = [int(prefixes[:, position].max()) + 1 for position in range(depth)]
+    key_range = 1
+    for radix in radices:
+        key_range *= radix
+    if key_range >= 1 << 63:
+        return None
+    return np.unique(pack(prefixes, radices)[0]), radices
+
+
+def pack(ids, radices):
+    """Pack the first len(radices) columns of ids, returning the keys and a mask of the rows whose
+    values are all within the radices"""
+    keys = np.zeros(len(ids), dtype=np.uint64)
+    valid = np.ones(len(ids), dtype=bool)
+    for position, radix in enumerate(radices):
+        column = ids[:, position].astype(np.uint64)
+        valid &= column < radix
+        keys = keys * np.uint64(radix) + np.where(valid, column, 0)
+    return keys, valid
+
+
+def first_word_ids(hits):
+    """The 7 element philo_id of the first word of each hit: the sentence id, then the word position
+    stored after the page number"""
+    return np.column_stack((hits[:, :6], hits[:, 7]))
+
+
+def matching_chunks(source_file, corpus_file, width):
+    """Yield the hits of source_file which fall within the corpus, as bytes, one chunk at a time"""
+    objects = read_corpus(corpus_file)
+    hit_size = 4 * width
+    count = os.path.getsize(source_file) // hit_size
+    if not count or not objects:
+        return
+    with open(source_file, "rb") as source_fh:
+        buffer = mmap.mmap(source_fh.fileno(), count * hit_size, access=mmap.ACCESS_READ)
+    if np is None:
+        for start in range(0, count, CHUNK_SIZE):
+            chunk = array("I", buffer[start * hit_size : (start + CHUNK_SIZE) * hit_size])
+            matches = array("I")
+            for offset in range(0, len(chunk), width):
+                hit = chunk[offset : offset + width]
+                philo_id = tuple(hit[:6]) + (hit[7],)
+                if any(philo_id[:depth] in prefixes for depth, prefixes in objects.items()):
+                    matches.extend(hit)
+            yield matches.tobytes()
+        return
+    packed = {depth: pack_prefixes(prefixes, depth) for depth, prefixes in objects.items()}
+    hits = np.frombuffer(buffer, dtype=np.uint32).reshape(count, width)
+    for start in range(0, count, CHUNK_SIZE):
+        chunk = hits[start : start + CHUNK_SIZE]
+        ids = first_word_ids(chunk)
+        mask = np.zeros(len(chunk), dtype=bool)
+        for depth, prefixes in objects.items():
+            if packed[depth] is None:  # ids too wide to pack, test them one by one
+                mask |= np.array([tuple(philo_id[:depth]) in prefixes for philo_id in ids.tolist()], dtype=bool)
+            else:
+                keys, radices = packed[depth]
+                chunk_keys, valid = pack(ids, radices)
+                mask |= valid & np.isin(chunk_keys, keys)
+        yield chunk[mask].tobytes()
+
+
+def filter_hitlist(source_file, corpus_file, output, width, limit=None):
+    """Write the hits of source_file which fall within the corpus to the open file output, stopping
+    after limit hits. Returns True if hits were left out because of the limit."""
+    hit_size = 4 * width
+    written = 0
+    for matches in matching_chunks(source_file, corpus_file, width):
+        if limit and len(matches) > (limit - written) * hit_size:
+            output.write(matches[: (limit - written) * hit_size])
+            output.flush()
+            return True
+        output.write(matches)
+        output.flush()
+        written += len(matches) // hit_size
+    return False
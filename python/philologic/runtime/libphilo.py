@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""ctypes bindings to libcorpus_search, running word searches inside the Python process.
+Database handles stay open between searches, so long-lived processes such as the search daemon
+avoid the start-up cost of a corpus_search process for every query."""
+
+import ctypes
+import ctypes.util
+import os
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CHUNK_SIZE = 8192
+
+_DBH = {}
+
+
+def _load_library():
+    candidates = [
+        os.getenv("PHILOLOGIC_SEARCH_LIBRARY"),
+        ctypes.util.find_library("corpus_search"),
+        "/usr/local/lib/libcorpus_search.so",
+    ]
+    for candidate in candidates:
+        if not candidate:
+            continue
+        try:
+            library = ctypes.CDLL(candidate)
+        except OSError:
+            continue
+        library.init_dbh_folder.argtypes = [ctypes.c_char_p]
+        library.init_dbh_folder.restype = ctypes.c_void_p
+        library.new_search.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p]
+        library.new_search.restype = ctypes.c_void_p
+        library.search_add_word.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        library.search_add_word.restype = ctypes.c_int
+        library.search_next_stage.argtypes = [ctypes.c_void_p]
+        library.search_next_stage.restype = ctypes.c_int
+        library.search_hit_width.argtypes = [ctypes.c_void_p]
+        library.search_hit_width.restype = ctypes.c_int
+        library.search_hits.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint32), ctypes.c_int]
+        library.search_hits.restype = ctypes.c_int
+        library.free_search.argtypes = [ctypes.c_void_p]
+        library.free_search.restype = None
+        library.delete_dbh.argtypes = [ctypes.c_void_p]
+        library.delete_dbh.restype = ctypes.c_int
+        ctypes.c_int.in_dll(library, "corpus_search_verbose").value = 0
+        return library
+    return None
+
+
+_LIBRARY = _load_library()
+
+
+def available():
+    """True if libcorpus_search could be loaded"""
+    return _LIBRARY is not None
+
+
+class _Database:
+    """An open database handle, closed once neither the cache nor a running search refers to it"""
+
+    def __init__(self, handle):
+        self.handle = handle
+
+    def __del__(self):
+        if self.handle and _LIBRARY is not None:
+            _LIBRARY.delete_dbh(self.handle)
+            self.handle = None
+
+
+def open_db(db_path):
+    """Return the cached database handle for db_path, or None if its index files are missing. The
+    handle is reopened when the index files are replaced, as when the database is rebuilt."""
+    # init_dbh_folder does not report missing files to its caller, so check them first
+    try:
+        index_stats = [os.stat(os.path.join(db_path, name)) for name in ("index", "index.1")]
+    except OSError:
+        _DBH.pop(db_path, None)
+        return None
+    if not os.path.exists(os.path.join(db_path, "src/dbspecs4.h")):
+        return None
+    version = tuple((stat.st_ino, stat.st_mtime_ns) for stat in index_stats)
+    if db_path not in _DBH or _DBH[db_path][0] != version:
+        _DBH.pop(db_path, None)  # searches still running on the old files keep their handle open
+        handle = _LIBRARY.init_dbh_folder(os.fsencode(db_path))
+        if not handle:
+            return None
+        _DBH[db_path] = (version, _Database(handle))
+    return _DBH[db_path][1]
+
+
+class Search:
+    """A word search over expanded query groups: one list of index words per group, as returned by
+    TermIndex.expand. Iterating yields chunks of hits in the binary hitlist format."""
+
+    def __init__(self, db_path, groups, corpus_file=None, method=None, method_arg=None):
+        self.handle = None
+        self.db = None
+        if _LIBRARY is None:
+            raise OSError("libcorpus_search is not available")
+        self.db = open_db(db_path)
+        if self.db is None:
+            raise OSError("no search index in %s" % db_path)
+        if method and method_arg:
+            method, method_arg = method.encode("utf8"), int(method_arg)
+        else:
+            method, method_arg = None, 0
+        self.handle = _LIBRARY.new_search(
+            self.db.handle, method, method_arg, os.fsencode(corpus_file) if corpus_file else None
+        )
+        if not self.handle:
+            raise OSError("cannot open corpus file %s" % corpus_file)
+        for i, group in enumerate(groups):
+            if i > 0:
+                if _LIBRARY.search_next_stage(self.handle) < 0:
+                    self.close()
+                    raise ValueError("too many terms in query")
+            for word in group:
+                _LIBRARY.search_add_word(self.handle, word.encode("utf8"))
+        self.width = _LIBRARY.search_hit_width(self.handle)
+
+    def read(self, max_hits=CHUNK_SIZE):
+        """Return the next max_hits hits or fewer as a (hits, width) NumPy array, or as a flat
+        array of unsigned ints when NumPy is not installed. Empty once the search is exhausted."""
+        buffer = (ctypes.c_uint32 * (max_hits * self.width))()
+        count = _LIBRARY.search_hits(self.handle, buffer, max_hits)
+        if np is not None:
+            return np.frombuffer(buffer, dtype=np.uint32, count=count * self.width).reshape(count, self.width)
+        hits = array("I")
+        hits.frombytes(memoryview(buffer).cast("B")[: count * self.width * 4])
+        return hits
+
+    def __iter__(self):
+        while True:
+            hits = self.read()
+            if not len(hits):
+                break
+            yield hits
+
+    def close(self):
+        if self.handle:
+            _LIBRARY.free_search(self.handle)
+            self.handle = None
+        self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+def write_hits(word_search, output, limit=None, first_page=None):
+    """Write the hits of a search to an open hitlist file, flushing every chunk so that readers see
+    them right away. The first chunk holds first_page hits. Returns True if the search was stopped
+    at limit hits before the end of the results."""
+    written = 0
+    chunk_size = first_page or CHUNK_SIZE
+    while True:
+        if limit:
+            if written >= limit:
+                return len(word_search.read(1)) > 0
+            chunk_size = min(chunk_size, limit - written)
+        hits = word_search.read(chunk_size).tobytes()
+        if not hits:
+            return False
+        output.write(hits)
+        output.flush()
+        written += len(hits) // (4 * word_search.width)
+        chunk_size = CHUNK_SIZE
+
+
+def search(db_path, groups, corpus_file=None, method=None, method_arg=None, limit=None):
+    """Run a search to completion, or until limit hits, and return all hits as one array"""
+    chunks = []
+    total = 0
+    with Search(db_path, groups, corpus_file, method, method_arg) as word_search:
+        width = word_search.width
+        while limit is None or total < limit:
+            hits = word_search.read(CHUNK_SIZE if limit is None else min(CHUNK_SIZE, limit - total))
+            if not len(hits):
+                break
+            chunks.append(hits)
+            total += len(hits) if np is not None else len(hits) // width
+    if np is not None:
+        if not chunks:
+            return np.zeros((0, width), dtype=np.uint32)
+        return np.concatenate(chunks)
+    hits = array("I")
+    for chunk in chunks:
+        hits.extend(chunk)
+    return hits
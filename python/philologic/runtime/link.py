@@ -61,9 +61,16 @@ def byte_range_to_link(db, config, request, obj_level="div1"):
     cursor = db.dbh.cursor()
     cursor.execute("SELECT philo_id FROM toms WHERE filename=?", (request.filename,))
     doc_id = cursor.fetchone()[0].split()[0]
-    cursor.execute(
-        f"SELECT philo_id FROM toms WHERE philo_type='{obj_level}' AND philo_id like '{doc_id} %' AND start_byte <= {request.start_byte} ORDER BY rowid desc"
-    )
+    if db.philo_key_shifts is not None:
+        lowest, highest = db.philo_key_range([doc_id])
+        cursor.execute(
+            f"SELECT philo_id FROM toms WHERE philo_type='{obj_level}' AND philo_key BETWEEN ? AND ? AND start_byte <= {request.start_byte} ORDER BY rowid desc",
+            (lowest, highest),
+        )
+    else:
+        cursor.execute(
+            f"SELECT philo_id FROM toms WHERE philo_type='{obj_level}' AND philo_id like '{doc_id} %' AND start_byte <= {request.start_byte} ORDER BY rowid desc"
+        )
     philo_id = cursor.fetchone()[0]
     philo_id = philo_id.split()
     while int(philo_id[-1]) == 0:
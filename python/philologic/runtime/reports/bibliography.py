@@ -31,7 +31,7 @@ def bibliography_results(request, config):
     }
     results = []
     result_type = "doc"
-    for hit in hits[start - 1 : end]:
+    for hit in hits.get_resolved_slice(start - 1, end):
         citation_hrefs = citation_links(db, config, hit)
         metadata_fields = {}
         for metadata in db.locals["metadata_fields"]:
@@ -66,5 +66,7 @@ def bibliography_results(request, config):
     bibliography_object["results"] = results
     bibliography_object["results_length"] = len(hits)
     bibliography_object["query_done"] = hits.done
+    bibliography_object["results_truncated"] = hits.truncated
+    bibliography_object["results_estimate"] = hits.estimate_length()._asdict()
     bibliography_object["result_type"] = result_type
     return bibliography_object, hits
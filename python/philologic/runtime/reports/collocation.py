@@ -4,8 +4,20 @@
 import os
 from collections import defaultdict
 import timeit
+from philologic.runtime.collocation_scores import MEASURES, SCORE_FUNCTIONS, corpus_counts
 from philologic.runtime.DB import DB
+from philologic.runtime.ObjectIndex import load_object_index
 from philologic.runtime.Query import get_expanded_query
+from multiprocess import Pool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SENTENCE_CHUNK = 65536  # sentences with hits whose collocates are counted at a time
+MIN_SHARD_SIZE = 100000  # fewest hits counted by each collocation worker
+TOP_COLLOCATES = 1000  # highest ranked collocates returned when counting with the token stream
 
 
 def collocation_results(request, config):
@@ -45,57 +57,82 @@ def collocation_results(request, config):
         hits = db.query(request["q"], "proxy", request["arg"], raw_results=True, **request.metadata)
     hits.finish()
 
-    stored_sentence_id = None
-    stored_sentence_counts = defaultdict(int)
-    sentence_hit_count = 1
-    hits_done = request.start or 0
-    max_time = request.max_time or 10
-    all_collocates = defaultdict(lambda: {"count": 0})
-    cursor = db.dbh.cursor()
-    start_time = timeit.default_timer()
-    try:
-        for hit in hits[hits_done:]:
-            word_id = " ".join([str(i) for i in hit[:6]]) + " " + str(hit[7])
-            query = """select parent, rowid from words where philo_id='%s' limit 1""" % word_id
-            cursor.execute(query)
-            result = cursor.fetchone()
-            parent = result["parent"]
-            if parent != stored_sentence_id:
-                rowid = int(result["rowid"])
-                sentence_hit_count = 1
-                stored_sentence_id = parent
-                stored_sentence_counts = defaultdict(int)
-                if collocate_distance:
-                    begin_rowid = rowid - collocate_distance
-                    if begin_rowid < 0:
-                        begin_rowid = 0
-                    end_rowid = rowid + collocate_distance
-                    row_query = """select philo_name from words where parent='%s' and rowid between %d and %d""" % (
-                        parent,
-                        begin_rowid,
-                        end_rowid,
-                    )
+    # Collocates are ranked by count unless colloc_sort requests an association measure
+    sort_by = request.colloc_sort
+    if sort_by not in MEASURES or np is None or not os.path.exists(db.path + "/frequencies/word_frequencies"):
+        sort_by = "count"
+    hits_done = int(request.start or 0)
+    if hits_done:  # the client adds these counts to those of earlier requests, so they can't be scored here
+        sort_by = "count"
+    object_index = load_object_index(db.path)
+    if object_index is not None and object_index.has_words():
+        all_collocates = indexed_collocates(
+            object_index,
+            hits,
+            hits_done,
+            collocate_distance,
+            filter_list,
+            workers=config.collocation_workers,
+            sort_by=sort_by,
+        )
+        hits_done = len(hits)
+    else:
+        stored_sentence_id = None
+        stored_sentence_counts = defaultdict(int)
+        sentence_hit_count = 1
+        max_time = request.max_time or 10
+        all_collocates = defaultdict(lambda: {"count": 0})
+        cursor = db.dbh.cursor()
+        start_time = timeit.default_timer()
+        try:
+            for hit in hits[hits_done:]:
+                word_id = " ".join([str(i) for i in hit[:6]]) + " " + str(hit[7])
+                query = """select parent, rowid from words where philo_id='%s' limit 1""" % word_id
+                cursor.execute(query)
+                result = cursor.fetchone()
+                parent = result["parent"]
+                if parent != stored_sentence_id:
+                    rowid = int(result["rowid"])
+                    sentence_hit_count = 1
+                    stored_sentence_id = parent
+                    stored_sentence_counts = defaultdict(int)
+                    if collocate_distance:
+                        begin_rowid = rowid - collocate_distance
+                        if begin_rowid < 0:
+                            begin_rowid = 0
+                        end_rowid = rowid + collocate_distance
+                        row_query = """select philo_name from words where parent='%s' and rowid between %d and %d""" % (
+                            parent,
+                            begin_rowid,
+                            end_rowid,
+                        )
+                    else:
+                        row_query = """select philo_name from words where parent='%s'""" % (parent,)
+                    cursor.execute(row_query)
+                    for i in cursor:
+                        collocate = i["philo_name"]
+                        if collocate not in filter_list:
+                            stored_sentence_counts[collocate] += 1
                 else:
-                    row_query = """select philo_name from words where parent='%s'""" % (parent,)
-                cursor.execute(row_query)
-                for i in cursor:
-                    collocate = i["philo_name"]
-                    if collocate not in filter_list:
-                        stored_sentence_counts[collocate] += 1
-            else:
-                sentence_hit_count += 1
-            for word in stored_sentence_counts:
-                if stored_sentence_counts[word] < sentence_hit_count:
-                    continue
-                all_collocates[word]["count"] += 1
-            hits_done += 1
-            elapsed = timeit.default_timer() - start_time
-            # avoid timeouts by splitting the query if more than request.max_time (in
-            # seconds) has been spent in the loop
-            if elapsed > int(max_time):
-                break
-    except IndexError:
-        collocation_object["hits_done"] = len(hits)
+                    sentence_hit_count += 1
+                for word in stored_sentence_counts:
+                    if stored_sentence_counts[word] < sentence_hit_count:
+                        continue
+                    all_collocates[word]["count"] += 1
+                hits_done += 1
+                elapsed = timeit.default_timer() - start_time
+                # avoid timeouts by splitting the query if more than request.max_time (in
+                # seconds) has been spent in the loop
+                if elapsed > int(max_time):
+                    break
+        except IndexError:
+            collocation_object["hits_done"] = len(hits)
+
+        # scores of partial counts would be wrong: collocates stay ranked by count until all hits are counted
+        if sort_by != "count" and hits_done >= len(hits):
+            words = list(all_collocates)
+            counts = np.array([all_collocates[word]["count"] for word in words], dtype=np.int64)
+            all_collocates = rank_collocates(db.path, words, counts, sort_by)
 
     collocation_object["collocates"] = all_collocates
     collocation_object["results_length"] = len(hits)
@@ -109,6 +146,117 @@ def collocation_results(request, config):
     return collocation_object
 
 
+def indexed_collocates(object_index, hits, hits_done, collocate_distance, filter_list, workers=1, sort_by="count"):
+    """Count the collocates of the hits from hits_done on with the token stream of the object index, in
+    up to workers processes for large hitlists, and return the TOP_COLLOCATES ranked first by sort_by.
+    As in the SQL loop, the window is taken around the first hit of each sentence, and a word occurring
+    m times in the window of a sentence with k hits is counted min(m, k) times."""
+    all_collocates = defaultdict(lambda: {"count": 0})
+    if hits_done >= len(hits):
+        return all_collocates
+    hits.map_hits()
+    words, word_ids = object_index.words()
+    filter_ids = np.array([word_ids[word] for word in filter_list if word in word_ids], dtype=np.uint32)
+    shards = shard_bounds(hits.hits[hits_done:], workers)
+    if len(shards) == 1:
+        counts = count_collocates(object_index, first_word_ids(hits.hits[hits_done:]), collocate_distance, filter_ids)
+    else:
+        shards = [
+            (
+                hits.dbh.path,
+                hits.filename,
+                hits.length,
+                hits_done + start,
+                hits_done + stop,
+                collocate_distance,
+                filter_ids,
+            )
+            for start, stop in shards
+        ]
+        with Pool(len(shards)) as pool:
+            counts = sum(pool.map(count_shard, shards))
+    collocates = np.flatnonzero(counts)
+    return rank_collocates(
+        hits.dbh.path, [words[word_id] for word_id in collocates.tolist()], counts[collocates], sort_by, TOP_COLLOCATES
+    )
+
+
+def rank_collocates(db_path, words, counts, sort_by, limit=None):
+    """Return the collocates ordered by decreasing count or association score, with their scores,
+    keeping the first limit"""
+    all_collocates = defaultdict(lambda: {"count": 0})
+    if sort_by == "count":
+        scores = counts
+    else:
+        frequencies, total_words = corpus_counts(db_path, words)
+        scores = SCORE_FUNCTIONS[sort_by](counts, frequencies, total_words)
+    for position in np.argsort(-scores, kind="stable")[:limit].tolist():
+        all_collocates[words[position]]["count"] = int(counts[position])
+        if sort_by != "count":
+            all_collocates[words[position]][sort_by] = float(scores[position])
+    return all_collocates
+
+
+def shard_bounds(hits, workers):
+    """Split hits into at most workers ranges, one per CPU, of at least MIN_SHARD_SIZE hits, cut between
+    sentences so that the hits of a sentence are counted together"""
+    shards = min(workers, os.cpu_count() or 1, len(hits) // MIN_SHARD_SIZE)
+    if shards <= 1:
+        return [(0, len(hits))]
+    sentence_starts = np.flatnonzero((hits[1:, :6] != hits[:-1, :6]).any(axis=1)) + 1
+    cuts = np.searchsorted(sentence_starts, [len(hits) * shard // shards for shard in range(1, shards)])
+    bounds = sorted({0, len(hits)} | set(sentence_starts[cuts[cuts < len(sentence_starts)]].tolist()))
+    return list(zip(bounds, bounds[1:]))
+
+
+def count_shard(shard):
+    """Pool worker counting the collocates of a range of hits of a hitlist file"""
+    db_path, filename, width, start, stop, collocate_distance, filter_ids = shard
+    object_index = load_object_index(db_path)
+    hits = np.memmap(filename, dtype=np.uint32, mode="r", offset=start * width * 4, shape=(stop - start, width))
+    return count_collocates(object_index, first_word_ids(hits), collocate_distance, filter_ids)
+
+
+def first_word_ids(hits):
+    """The philo_id of the first word of each hit: its sentence id, then the word position after the page"""
+    return np.column_stack((hits[:, :6], hits[:, 7]))
+
+
+def count_collocates(object_index, word_ids, collocate_distance, filter_ids):
+    """Return the collocate counts per vocabulary id of the hits whose first words are the rows of
+    word_ids, within collocate_distance words or the whole sentence, leaving out filter_ids"""
+    tokens = object_index.token_stream()
+    sentence_starts = object_index.sentence_starts().astype(np.int64)
+    vocabulary_size = object_index.config["words"]["vocabulary"]
+    counts = np.zeros(vocabulary_size, dtype=np.int64)
+    positions = object_index.word_positions(word_ids)
+    positions = positions[positions >= 0].astype(np.int64)
+    if not len(positions):
+        return counts
+    sentences = np.searchsorted(sentence_starts, positions, side="right") - 1
+    # consecutive hits in the same sentence share the window of the first one
+    firsts = np.flatnonzero(np.concatenate(([True], sentences[1:] != sentences[:-1])))
+    sentence_hits = np.diff(np.append(firsts, len(sentences)))
+    for chunk in range(0, len(firsts), SENTENCE_CHUNK):
+        chunk_firsts = firsts[chunk : chunk + SENTENCE_CHUNK]
+        starts = sentence_starts[sentences[chunk_firsts]]
+        ends = sentence_starts[sentences[chunk_firsts] + 1]
+        if collocate_distance:
+            starts = np.maximum(starts, positions[chunk_firsts] - collocate_distance)
+            ends = np.minimum(ends, positions[chunk_firsts] + collocate_distance + 1)
+        lengths = ends - starts
+        windows = np.repeat(np.arange(len(chunk_firsts)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        names = tokens[np.repeat(starts, lengths) + offsets].astype(np.int64)
+        kept = ~np.isin(names, filter_ids)
+        pairs, occurrences = np.unique(windows[kept] * vocabulary_size + names[kept], return_counts=True)
+        hit_counts = sentence_hits[chunk : chunk + SENTENCE_CHUNK][pairs // vocabulary_size]
+        counts += np.bincount(
+            pairs % vocabulary_size, weights=np.minimum(occurrences, hit_counts), minlength=vocabulary_size
+        ).astype(np.int64)
+    return counts
+
+
 def build_filter_list(request, config):
     """set up filtering with stopwords or most frequent terms."""
     if config.stopwords and request.colloc_filter_choice == "stopwords":
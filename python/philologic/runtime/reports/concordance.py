@@ -35,7 +35,7 @@ def concordance_results(request, config):
             compiled_regex = re.compile(r"%s" % pattern)
             formatting_regexes.append((compiled_regex, replacement))
     results = []
-    for hit in hits[start - 1 : end]:
+    for hit in hits.get_resolved_slice(start - 1, end):
         citation_hrefs = citation_links(db, config, hit)
         metadata_fields = {}
         for metadata in db.locals["metadata_fields"]:
@@ -57,4 +57,6 @@ def concordance_results(request, config):
     concordance_object["results"] = results
     concordance_object["results_length"] = len(hits)
     concordance_object["query_done"] = hits.done
+    concordance_object["results_truncated"] = hits.truncated
+    concordance_object["results_estimate"] = hits.estimate_length()._asdict()
     return concordance_object
@@ -5,6 +5,21 @@ import timeit
 
 from philologic.runtime.link import make_absolute_query_link
 from philologic.runtime.DB import DB
+from philologic.runtime.ObjectIndex import load_object_index
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FACET_LEVELS = {
+    "doc": ("doc",),
+    "div1": ("div1",),
+    "div2": ("div2",),
+    "div3": ("div3",),
+    "div": ("div3", "div2", "div1", "para"),  # deepest div with a value, then the paragraph
+    "para": ("para",),
+}
 
 
 def frequency_results(request, config, sorted_results=False):
@@ -21,6 +36,19 @@ def frequency_results(request, config, sorted_results=False):
     else:
         hits = db.query(request["q"], request["method"], request["arg"], raw_results=True, **request.metadata)
 
+    facet_levels = indexed_facet_levels(db, request.frequency_field, biblio_search)
+    frequency_object = None
+    if facet_levels is not None:
+        frequency_object = indexed_frequency_results(
+            request, config, db, hits, request.frequency_field, facet_levels, biblio_search
+        )
+    if frequency_object is not None:
+        if sorted_results is True:
+            frequency_object["results"] = sorted(
+                frequency_object["results"].items(), key=lambda x: x[1]["count"], reverse=True
+            )
+        return frequency_object
+
     if sorted_results is True:
         hits.finish()
 
@@ -150,3 +178,92 @@ def frequency_results(request, config, sorted_results=False):
         )
 
     return frequency_object
+
+
+def indexed_facet_levels(db, field, biblio_search):
+    """Return the object levels from which the values of field are read if the object index can compute
+    the facet, or None"""
+    object_index = load_object_index(db.path)
+    levels = FACET_LEVELS.get(db.locals["metadata_types"].get(field))
+    if object_index is None or levels is None:
+        return None
+    if not all(object_index.has_columns(level) and field in dict(object_index.columns[level]) for level in levels):
+        return None
+    if not biblio_search and not all(level in object_index.config.get("word_counts", []) for level in levels):
+        return None
+    return levels
+
+
+def indexed_frequency_results(request, config, db, hits, field, levels, biblio_search):
+    """Count all the hits by value of field in one pass over the hitlist with the object index, instead
+    of looking up each hit and querying each value for its word count. Returns None when the facet
+    should be computed by frequency_results instead."""
+    object_index = load_object_index(db.path)
+    hits.finish()
+    frequency_object = {"results": {}, "more_results": False, "hits_done": len(hits)}
+    frequency_object["results_length"] = len(hits)
+    frequency_object["query"] = dict([i for i in request])
+    if not len(hits):
+        return frequency_object
+    hits.map_hits()
+    # only the doc to para positions are needed, which come first in both word and object hits
+    value_ids = object_index.facet(field, levels, hits.hits[:, :5])
+    null_count = int(np.count_nonzero(value_ids == -1))
+    if null_count and not biblio_search and len(levels) > 1:
+        # the objects without a value at one level are nested in or contain those of the others,
+        # so their words can't be summed per level
+        return None
+    values = object_index.facet_values(field, levels)[0]
+    counts = np.bincount(value_ids[value_ids >= 0], minlength=len(values))
+    if not biblio_search:
+        other_metadata = dict([(k, v) for k, v in request.metadata.items() if v and k != field])
+        corpus = None
+        if other_metadata:
+            corpus_hits = db.query(**other_metadata)
+            corpus_hits.finish()
+            if len(corpus_hits):
+                corpus_hits.map_hits()
+                corpus = corpus_hits.hits
+            else:
+                corpus = np.zeros((0, 7), dtype=np.uint32)
+        word_counts = object_index.facet_word_counts(field, levels, corpus)
+
+    results = frequency_object["results"]
+    for value_id in np.flatnonzero(counts).tolist():
+        key = values[value_id]
+        if not key and len(levels) > 1:  # hits in divs with an empty value are left out, as in the loop above
+            continue
+        results[key] = {
+            "count": int(counts[value_id]),
+            "metadata": {field: key},
+            "url": make_absolute_query_link(
+                config,
+                request,
+                frequency_field="",
+                start="0",
+                end="0",
+                report=request.report,
+                script="",
+                **{field: '"%s"' % key}
+            ),
+        }
+        if not biblio_search:
+            results[key]["total_word_count"] = int(word_counts[value_id])
+    if null_count:
+        results["NULL"] = {
+            "count": null_count,
+            "url": make_absolute_query_link(
+                config,
+                request,
+                frequency_field="",
+                start="0",
+                end="0",
+                report=request.report,
+                script="",
+                **{field: '"NULL"'}
+            ),
+            "metadata": {field: '"NULL"'},
+        }
+        if not biblio_search:
+            results["NULL"]["total_word_count"] = int(word_counts[-1])
+    return frequency_object
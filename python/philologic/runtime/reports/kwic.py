@@ -22,12 +22,14 @@ def kwic_results(request, config):
     }
     kwic_object["results"] = []
 
-    for hit in hits[start - 1 : end]:
+    for hit in hits.get_resolved_slice(start - 1, end):
         kwic_result = kwic_hit_object(hit, config, db)
         kwic_object["results"].append(kwic_result)
 
     kwic_object["results_length"] = len(hits)
     kwic_object["query_done"] = hits.done
+    kwic_object["results_truncated"] = hits.truncated
+    kwic_object["results_estimate"] = hits.estimate_length()._asdict()
 
     return kwic_object
 
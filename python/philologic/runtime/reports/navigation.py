@@ -18,9 +18,15 @@ def generate_text_object(request, config, note=False):
     db = DB(config.db_path + "/data/", width=width)
     if note:
         target = request.target.replace("#", "")
-        doc_id = request.philo_id.split()[0] + " %"
+        doc_id = request.philo_id.split()[0]
         cursor = db.dbh.cursor()
-        cursor.execute("select philo_id from toms where id=? and philo_id like ? limit 1", (target, doc_id))
+        if db.philo_key_shifts is not None:
+            cursor.execute(
+                "select philo_id from toms where id=? and philo_key between ? and ? limit 1",
+                (target, *db.philo_key_range([doc_id])),
+            )
+        else:
+            cursor.execute("select philo_id from toms where id=? and philo_id like ? limit 1", (target, doc_id + " %"))
         philo_id = cursor.fetchall()[0]["philo_id"].split()[:7]
         obj = db[philo_id]
     else:
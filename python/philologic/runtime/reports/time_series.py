@@ -7,6 +7,13 @@ from collections import defaultdict
 
 from philologic.runtime.link import make_absolute_query_link
 from philologic.runtime.DB import DB
+from philologic.runtime.ObjectIndex import load_object_index
+from philologic.runtime.reports.frequency import indexed_facet_levels
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def generate_time_series(request, config):
@@ -36,6 +43,23 @@ def generate_time_series(request, config):
         date_range = "%d-%d" % (start, end)
         date_ranges.append((start, date_range))
 
+    # Date totals are read from the per-year counts of the object index when the year field has them
+    object_index = load_object_index(db.path)
+    indexed_totals = None
+    if object_index is not None and object_index.has_years(config.time_series_year_field):
+        starts = [start_range for start_range, _ in date_ranges]
+        indexed_totals = object_index.year_totals(
+            config.time_series_year_field,
+            starts,
+            [start_range + interval - 1 for start_range in starts],
+            philo_type=None if request.q else db.locals.default_object_level,
+        ).tolist()
+    # With years readable from the object index, the search is run once and its hits counted per date range
+    hit_counts = None
+    facet_levels = indexed_facet_levels(db, config.time_series_year_field, True)
+    if indexed_totals is not None and facet_levels is not None:
+        hit_counts = count_hits_by_year(request, config, db, facet_levels, start_date, end_date, interval)
+
     absolute_count = defaultdict(int)
     date_counts = {}
     total_hits = 0
@@ -43,34 +67,43 @@ def generate_time_series(request, config):
     start_time = timeit.default_timer()
     max_time = request.max_time or 10
     cursor = db.dbh.cursor()
-    for start_range, date_range in date_ranges:
-        request.metadata[config.time_series_year_field] = date_range
-        hits = db.query(request["q"], request["method"], request["arg"], raw_results=True, **request.metadata)
-        hits.finish()
-        hit_len = len(hits)
+    for position, (start_range, date_range) in enumerate(date_ranges):
+        if hit_counts is not None:
+            hit_len = hit_counts[position]
+        else:
+            request.metadata[config.time_series_year_field] = date_range
+            hits = db.query(request["q"], request["method"], request["arg"], raw_results=True, **request.metadata)
+            hits.finish()
+            hit_len = len(hits)
         params = {"report": "concordance", "start": "0", "end": "0"}
         params[config.time_series_year_field] = date_range
         url = make_absolute_query_link(config, request, **params)
         absolute_count[start_range] = {"label": start_range, "count": hit_len, "url": url}
 
         # Get date total count
-        if interval != 1:
-            end_range = start_range + (int(request["year_interval"]) - 1)
-            if request.q:
-                query = 'select sum(word_count) from toms where %s between "%d" and "%d"' % (
-                    config.time_series_year_field,
-                    start_range,
-                    end_range,
-                )
-            else:
-                query = f"SELECT COUNT(*) FROM toms WHERE philo_type='{db.locals.default_object_level}' AND {config.time_series_year_field} BETWEEN {start_range} AND {end_range}"
+        if indexed_totals is not None:
+            date_counts[start_range] = indexed_totals[position]
         else:
-            if request.q:
-                query = "select sum(word_count) from toms where %s='%s'" % (config.time_series_year_field, start_range)
+            if interval != 1:
+                end_range = start_range + (int(request["year_interval"]) - 1)
+                if request.q:
+                    query = 'select sum(word_count) from toms where %s between "%d" and "%d"' % (
+                        config.time_series_year_field,
+                        start_range,
+                        end_range,
+                    )
+                else:
+                    query = f"SELECT COUNT(*) FROM toms WHERE philo_type='{db.locals.default_object_level}' AND {config.time_series_year_field} BETWEEN {start_range} AND {end_range}"
             else:
-                query = f"SELECT COUNT(*) FROM toms WHERE philo_type='{db.locals.default_object_level}' AND {config.time_series_year_field}='{start_range}'"
-        cursor.execute(query)
-        date_counts[start_range] = cursor.fetchone()[0] or 0
+                if request.q:
+                    query = "select sum(word_count) from toms where %s='%s'" % (
+                        config.time_series_year_field,
+                        start_range,
+                    )
+                else:
+                    query = f"SELECT COUNT(*) FROM toms WHERE philo_type='{db.locals.default_object_level}' AND {config.time_series_year_field}='{start_range}'"
+            cursor.execute(query)
+            date_counts[start_range] = cursor.fetchone()[0] or 0
         total_hits += hit_len
         elapsed = timeit.default_timer() - start_time
         last_date_done = start_range
@@ -90,8 +123,31 @@ def generate_time_series(request, config):
     return time_series_object
 
 
+def count_hits_by_year(request, config, db, levels, start_date, end_date, interval):
+    """Search the whole date range at once and return the number of hits in each date range, by
+    reading the year of each hit from the object index"""
+    field = config.time_series_year_field
+    buckets = len(range(start_date, end_date + 1, interval))
+    request.metadata[field] = "%d-%d" % (start_date, end_date)
+    hits = db.query(request["q"], request["method"], request["arg"], raw_results=True, **request.metadata)
+    hits.finish()
+    if not len(hits):
+        return [0] * buckets
+    hits.map_hits()
+    object_index = load_object_index(db.path)
+    value_ids = object_index.facet(field, levels, hits.hits[:, :5])
+    years = np.array([int(value) for value in object_index.facet_values(field, levels)[0]], dtype=np.int64)
+    hit_years = years[value_ids[value_ids >= 0]]
+    hit_years = hit_years[(hit_years >= start_date) & (hit_years <= end_date)]
+    return np.bincount((hit_years - start_date) // interval, minlength=buckets).tolist()
+
+
 def get_start_end_date(db, config, start_date=None, end_date=None):
     """Get start and end date of dataset"""
+    object_index = load_object_index(db.path)
+    if object_index is not None and object_index.has_years(config.time_series_year_field):
+        min_date, max_date = object_index.year_range(config.time_series_year_field)
+        return start_date or min_date, end_date or max_date
     date_finder = re.compile(r"^.*?(\d{1,}).*")
     cursor = db.dbh.cursor()
     cursor.execute(
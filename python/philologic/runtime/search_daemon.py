@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Persistent pre-forked search daemon.
+
+Workers accept query jobs over a Unix socket and run them with Query.run_search, streaming hits
+into the same hitlists/<hash>.hitlist files as the forked query workers. Each worker keeps the
+configuration, term index and libcorpus_search handle of every database it has served loaded
+between queries.
+A worker creates and claims the hitlist itself before acknowledging a job, and the client only
+searches on its own if it can still claim the hitlist after the daemon failed to answer.
+Query.query falls back to forking its own worker when the daemon is not running.
+The socket is only open to the group of the web server, and jobs are only run on the databases of
+the database roots the daemon was started with, writing to their hitlists directory."""
+
+import grp
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+
+from philologic.Config import Config, db_locals_defaults, db_locals_header
+from philologic.runtime import HitlistCache
+from philologic.runtime.TermIndex import load_term_index
+
+SOCKET_PATH = os.getenv("PHILOLOGIC_SEARCH_SOCKET", "/var/lib/philologic4/search.sock")
+ACK_TIMEOUT = 1.0
+
+
+def submit(db_path, terms, corpus_file, method, method_arg, filename, limit=None, socket_path=SOCKET_PATH):
+    """Hand a query over to the search daemon. Returns True once a worker has claimed the hitlist, or
+    found it claimed by an identical query, and False if no daemon accepted the job."""
+    if not os.path.exists(socket_path):
+        return False
+    job = {
+        "db_path": db_path,
+        "terms": terms,
+        "corpus_file": corpus_file,
+        "method": method,
+        "method_arg": method_arg,
+        "filename": filename,
+        "limit": limit,
+    }
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(ACK_TIMEOUT)
+            client.connect(socket_path)
+            client.sendall(json.dumps(job).encode("utf8") + b"\n")
+            acknowledgement = client.recv(3)
+    except OSError:
+        return False
+    return acknowledgement == b"OK\n"
+
+
+def serve(database_roots, socket_path=SOCKET_PATH, workers=4, group=None):
+    """Listen on socket_path and keep a pool of workers running until SIGTERM or SIGINT. Only the
+    databases directly under database_roots are searched, and only members of group, or of the
+    daemon's group, may connect."""
+    database_roots = {os.path.realpath(root) for root in database_roots}
+    if not database_roots:
+        print("No database root given to the search daemon", file=sys.stderr)
+        return
+    if os.path.exists(socket_path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(socket_path)
+            print("A search daemon is already listening on %s" % socket_path, file=sys.stderr)
+            return
+        except OSError:
+            os.remove(socket_path)  # left behind by a daemon that did not exit cleanly
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    if group is not None:
+        os.chown(socket_path, -1, grp.getgrnam(group).gr_gid)
+    os.chmod(socket_path, 0o660)
+    server.listen(128)
+
+    children = set()
+    running = [True]
+
+    def stop(signum, frame):
+        running[0] = False
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print("Search daemon listening on %s with %d workers" % (socket_path, workers), file=sys.stderr)
+    try:
+        while running[0]:
+            while running[0] and len(children) < workers:
+                pid = os.fork()
+                if pid == 0:
+                    worker_loop(server, database_roots)
+                    os._exit(0)
+                children.add(pid)
+            try:
+                pid, _ = os.wait()
+                children.discard(pid)
+            except ChildProcessError:
+                pass
+            except InterruptedError:
+                pass
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def worker_loop(server, database_roots):
+    """Accept and run jobs forever in a worker process"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    databases = {}
+    while True:
+        connection, _ = server.accept()
+        with connection:
+            connection.settimeout(ACK_TIMEOUT)
+            try:
+                job = json.loads(connection.makefile("rb").readline().decode("utf8"))
+                if not valid_job(job, database_roots):
+                    continue
+                # None if an identical query, or the client after giving up on us, is already writing it
+                hitlist_fh = HitlistCache.claim(job["filename"])
+            except (OSError, ValueError, KeyError, TypeError):
+                continue  # closing without an answer lets the client run the search itself at once
+            try:
+                connection.sendall(b"OK\n")
+            except OSError:
+                pass  # the client gave up, and will read the hitlist we claimed
+        if hitlist_fh is not None:
+            run_job(job, databases, hitlist_fh)
+
+
+def valid_job(job, database_roots):
+    """True if the job searches the data directory of a database directly under one of database_roots,
+    and its hitlist and corpus file, if any, are hitlists of that database"""
+    db_path = os.path.realpath(job["db_path"])
+    database = os.path.dirname(db_path)
+    if os.path.basename(db_path) != "data" or os.path.dirname(database) not in database_roots:
+        return False
+    hitlists = os.path.join(db_path, "hitlists")
+    filename = os.path.realpath(job["filename"])
+    if os.path.dirname(filename) != hitlists or not filename.endswith(".hitlist"):
+        return False
+    if job["corpus_file"] and os.path.dirname(os.path.realpath(job["corpus_file"])) != hitlists:
+        return False
+    return True
+
+
+def run_job(job, databases, hitlist_fh=None):
+    """Run one query job, reusing the database state loaded by previous jobs"""
+    from philologic.runtime.Query import flag_error, run_search, split_terms
+    from philologic.runtime.QuerySyntax import group_terms, parse_query
+
+    filename = job["filename"]
+    try:
+        db_locals = load_db_locals(job["db_path"], databases)
+        load_term_index(job["db_path"])
+        split = split_terms(group_terms(parse_query(job["terms"])))
+        run_search(
+            job["db_path"],
+            split,
+            job["corpus_file"],
+            job["method"],
+            job["method_arg"],
+            filename,
+            db_locals["lowercase_index"],
+            limit=job.get("limit"),
+            hitlist_fh=hitlist_fh,
+        )
+    except Exception:
+        traceback.print_exc()
+        flag_error(filename, "search daemon error")
+    finally:
+        if hitlist_fh is not None:
+            hitlist_fh.close()
+
+
+def load_db_locals(db_path, databases):
+    """Return the db.locals.py configuration of a database, reloading it if the file has changed"""
+    locals_file = db_path + "/db.locals.py"
+    mtime = os.stat(locals_file).st_mtime
+    if db_path not in databases or databases[db_path][0] != mtime:
+        databases[db_path] = (mtime, Config(locals_file, db_locals_defaults, db_locals_header))
+    return databases[db_path][1]
@@ -13,6 +13,6 @@ setup(
         "philologic.runtime.reports",
         "philologic.loadtime",
     ],
-    scripts=["scripts/philoload4"],
+    scripts=["scripts/philoload4", "scripts/philosearchd"],
     install_requires=["lxml", "python-levenshtein", "natsort", "multiprocess", "tqdm"],
 )
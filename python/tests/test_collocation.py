@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Compare collocate counts from the token stream with the rule of the SQL collocation loop"""
+
+import json
+import random
+import sqlite3
+from collections import Counter
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from philologic.loadtime.PostFilters import write_token_stream
+from philologic.runtime.ObjectIndex import ObjectIndex
+from philologic.runtime.reports import collocation
+
+VOCABULARY = ["le", "la", "de", "chat", "chien", "et"]
+
+
+def make_words(sentence_count, seed):
+    """Rows of a words table in document order: the 7 element philo_id and the word"""
+    rng = random.Random(seed)
+    words = []
+    for sentence in range(1, sentence_count + 1):
+        doc = 1 + sentence * 3 // sentence_count
+        for word in range(1, rng.randint(1, 14) + 1):
+            words.append(((doc, 1, 1, 1, 1, sentence, word), rng.choice(VOCABULARY)))
+    return words
+
+
+def make_hits(words, seed, probability=0.3):
+    """Hitlist rows on random words, often several in the same sentence"""
+    rng = random.Random(seed)
+    return np.array(
+        [philo_id[:6] + (0, philo_id[6], 0) for philo_id, _ in words if rng.random() < probability], dtype=np.uint32
+    )
+
+
+def build_index(tmp_path, words):
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE words (philo_id TEXT, philo_name TEXT)")
+    conn.executemany("INSERT INTO words VALUES (?, ?)", [(" ".join(map(str, p)) + " 0 0", w) for p, w in words])
+    destination = tmp_path / "objects"
+    destination.mkdir()
+    stream = write_token_stream(conn.cursor(), str(destination))
+    with open(destination / "objects.json", "w") as output:
+        json.dump({"bits": [8] * 7, "words": stream}, output)
+    return ObjectIndex(str(destination))
+
+
+def loop_counts(words, hits, distance, filter_list):
+    """The counting rule of the SQL loop in collocation_results: the window is read around the first
+    hit of each sentence, and each word of the window is counted once for each hit of the sentence
+    up to the number of times it occurs in the window"""
+    positions = {philo_id: position for position, (philo_id, _) in enumerate(words)}
+    counts = Counter()
+    stored_sentence_id = None
+    for hit in hits.tolist():
+        philo_id = tuple(hit[:6]) + (hit[7],)
+        position = positions[philo_id]
+        if philo_id[:6] != stored_sentence_id:
+            stored_sentence_id = philo_id[:6]
+            sentence_hit_count = 1
+            stored_sentence_counts = Counter(
+                word
+                for other_position, (other_id, word) in enumerate(words)
+                if other_id[:6] == stored_sentence_id
+                and (not distance or abs(other_position - position) <= distance)
+                and word not in filter_list
+            )
+        else:
+            sentence_hit_count += 1
+        for word, count in stored_sentence_counts.items():
+            if count >= sentence_hit_count:
+                counts[word] += 1
+    return counts
+
+
+def indexed_counts(object_index, hits, distance, filter_list):
+    words, word_ids = object_index.words()
+    filter_ids = np.array([word_ids[word] for word in filter_list if word in word_ids], dtype=np.uint32)
+    counts = collocation.count_collocates(object_index, collocation.first_word_ids(hits), distance, filter_ids)
+    return Counter({words[word_id]: int(counts[word_id]) for word_id in np.flatnonzero(counts).tolist()})
+
+
+@pytest.mark.parametrize("distance", [None, 1, 3])
+@pytest.mark.parametrize("filter_list", [set(), {"de", "et"}])
+def test_counts_match_sql_loop(tmp_path, distance, filter_list):
+    words = make_words(200, 1)
+    object_index = build_index(tmp_path, words)
+    hits = make_hits(words, 2)
+    sentences = hits[:, 5]
+    assert (sentences[1:] == sentences[:-1]).sum() > 50  # many sentences with several hits
+    expected = loop_counts(words, hits, distance, filter_list)
+    assert expected
+    assert indexed_counts(object_index, hits, distance, filter_list) == expected
+
+
+def test_counts_in_chunks(tmp_path, monkeypatch):
+    words = make_words(200, 3)
+    object_index = build_index(tmp_path, words)
+    hits = make_hits(words, 4)
+    monkeypatch.setattr(collocation, "SENTENCE_CHUNK", 7)
+    assert indexed_counts(object_index, hits, 2, set()) == loop_counts(words, hits, 2, set())
+
+
+def test_shards_keep_sentences_whole(monkeypatch):
+    monkeypatch.setattr(collocation, "MIN_SHARD_SIZE", 10)
+    monkeypatch.setattr(collocation.os, "cpu_count", lambda: 8)
+    # runs of 1 to 60 hits in the same sentence, long enough to straddle every even cut
+    rng = random.Random(5)
+    hits = []
+    for sentence in range(1, 40):
+        hits.extend([(1, 1, 1, 1, 1, sentence, 0, word, 0) for word in range(rng.randint(1, 60))])
+    hits = np.array(hits, dtype=np.uint32)
+    for workers in (2, 3, 8):
+        bounds = collocation.shard_bounds(hits, workers)
+        assert 1 < len(bounds) <= workers
+        assert bounds[0][0] == 0 and bounds[-1][1] == len(hits)
+        assert all(stop == start for (_, stop), (start, _) in zip(bounds, bounds[1:]))
+        for start, _ in bounds[1:]:
+            assert hits[start, 5] != hits[start - 1, 5]
+
+
+def test_shard_counts_add_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(collocation, "MIN_SHARD_SIZE", 20)
+    monkeypatch.setattr(collocation.os, "cpu_count", lambda: 4)
+    words = make_words(300, 6)
+    object_index = build_index(tmp_path, words)
+    hits = make_hits(words, 7, probability=0.8)
+    hitlist = tmp_path / "hits.hitlist"
+    hits.tofile(str(hitlist))
+    filter_ids = np.array([object_index.words()[1]["de"]], dtype=np.uint32)
+    for distance in (None, 2):
+        expected = collocation.count_collocates(object_index, collocation.first_word_ids(hits), distance, filter_ids)
+        bounds = collocation.shard_bounds(hits, 4)
+        assert len(bounds) == 4
+        shards = [(str(tmp_path), str(hitlist), 9, start, stop, distance, filter_ids) for start, stop in bounds]
+        assert np.array_equal(sum(collocation.count_shard(shard) for shard in shards), expected)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Compare corpus filtering of cached hitlists with a brute-force prefix match"""
+
+import io
+import random
+import struct
+
+import pytest
+
+from philologic.runtime import hitlist_filter
+
+WIDTH = 9  # one term hitlist: a 7 element philo_id, then the page and the byte offset
+
+
+def make_hits(max_values, count, seed):
+    rng = random.Random(seed)
+    hits = set()
+    while len(hits) < count:
+        hits.add(tuple(rng.randint(1, limit) for limit in max_values))
+    return [hit[:6] + (rng.randint(0, 3),) + hit[6:] + (rng.randint(0, 1 << 20),) for hit in sorted(hits)]
+
+
+def make_corpus(hits, count, seed, min_depth=1):
+    """Corpus objects of every depth taken from the hits, zero-padded to 7 positions, with some ids
+    that match no hit"""
+    rng = random.Random(seed)
+    objects = set()
+    for _ in range(count):
+        philo_id = rng.choice(hits)
+        philo_id = philo_id[:6] + (philo_id[7],)
+        depth = rng.randint(min_depth, 7)
+        objects.add(philo_id[:depth] + (0,) * (7 - depth))
+    objects.add((hits[-1][0] + 1, 0, 0, 0, 0, 0, 0))
+    objects.add((hits[0][0], hits[0][1], 0, 0, 0, 0, 0) if hits[0][1] > 1 else (hits[0][0], 9999, 0, 0, 0, 0, 0))
+    return sorted(objects)
+
+
+def brute_force(hits, objects):
+    prefixes = []
+    for philo_id in objects:
+        depth = 7
+        while depth and not philo_id[depth - 1]:
+            depth -= 1
+        prefixes.append(philo_id[:depth])
+    matches = []
+    for hit in hits:
+        philo_id = hit[:6] + (hit[7],)
+        if any(philo_id[: len(prefix)] == prefix for prefix in prefixes):
+            matches.append(hit)
+    return matches
+
+
+def filtered(tmp_path, hits, objects, limit=None):
+    source_file = tmp_path / "source.hitlist"
+    corpus_file = tmp_path / "corpus.hitlist"
+    source_file.write_bytes(b"".join(struct.pack("=9I", *hit) for hit in hits))
+    corpus_file.write_bytes(b"".join(struct.pack("=7I", *philo_id) for philo_id in objects))
+    output = io.BytesIO()
+    truncated = hitlist_filter.filter_hitlist(str(source_file), str(corpus_file), output, WIDTH, limit)
+    return list(struct.iter_unpack("=9I", output.getvalue())), truncated
+
+
+CASES = {
+    "narrow": ((40, 5, 4, 3, 30, 12, 200), 5000, 300, 1),
+    # ids so wide that the corpus keys can't be packed in 63 bits
+    "wide": ((2, (1 << 31) - 1, (1 << 31) - 1, 3, (1 << 31) - 1, 4, (1 << 31) - 1), 3000, 200, 2),
+}
+
+
+@pytest.fixture(params=["numpy", "sets"])
+def numpy_path(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(hitlist_filter, "np", None)
+    monkeypatch.setattr(hitlist_filter, "CHUNK_SIZE", 1000)  # several chunks per hitlist
+    return request.param
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_filter_matches_prefixes(tmp_path, numpy_path, case):
+    max_values, hit_count, object_count, min_depth = CASES[case]
+    hits = make_hits(max_values, hit_count, 1)
+    objects = make_corpus(hits, object_count, 2, min_depth)
+    if case == "wide" and numpy_path == "numpy":
+        by_depth = {}
+        for philo_id in objects:
+            prefix = tuple(philo_id)
+            while not prefix[-1]:
+                prefix = prefix[:-1]
+            by_depth.setdefault(len(prefix), set()).add(prefix)
+        assert any(hitlist_filter.pack_prefixes(prefixes, depth) is None for depth, prefixes in by_depth.items())
+    expected = brute_force(hits, objects)
+    assert expected and len(expected) < len(hits)
+    assert filtered(tmp_path, hits, objects) == (expected, False)
+
+
+def test_filter_limit(tmp_path, numpy_path):
+    hits = make_hits(CASES["narrow"][0], 5000, 3)
+    objects = make_corpus(hits, 300, 4)
+    expected = brute_force(hits, objects)
+    assert filtered(tmp_path, hits, objects, limit=len(expected) - 10) == (expected[:-10], True)
+    assert filtered(tmp_path, hits, objects, limit=len(expected)) == (expected, False)
+
+
+def test_filter_out_of_range_positions(tmp_path, numpy_path):
+    # with radices (3, 2), hit (1, 3) would pack to the key of object (2, 1)
+    objects = [(1, 1, 0, 0, 0, 0, 0), (2, 1, 0, 0, 0, 0, 0)]
+    hits = [(doc, div, 1, 1, 1, 1, 0, 1, 0) for doc in (1, 2, 3) for div in (1, 2, 3, 7)]
+    assert filtered(tmp_path, hits, objects) == (brute_force(hits, objects), False)
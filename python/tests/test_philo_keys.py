@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Compare the philo_key ranges of object prefixes with the LIKE queries they replace"""
+
+import random
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from philologic.loadtime.PostFilters import OBJECT_LEVELS, philo_id_keys
+from philologic.runtime.DB import DB
+from philologic.runtime.MetadataQuery import corpus_key_range
+
+NARROW_BITS = [3, 2, 2, 2, 4, 5, 7]
+WIDEST_BITS = [20, 10, 5, 5, 5, 8, 10]  # 63 bits, the widest ids that still fit
+
+
+def make_ids(bits, seed):
+    """Objects zero-padded to 7 positions and 9 position words, with the largest value of each position
+    used somewhere"""
+    rng = random.Random(seed)
+    objects = [()]
+    for width in bits[:6]:
+        objects = [
+            parent + (value,)
+            for parent in objects
+            for value in sorted({1, rng.randint(1, (1 << width) - 1), (1 << width) - 1})
+        ]
+    words = [
+        sentence + (word, rng.randint(0, 50), rng.randint(0, 1 << 20))
+        for sentence in objects
+        for word in (1, (1 << bits[6]) - 1)
+    ]
+    toms = {philo_id[:depth] + (0,) * (7 - depth) for philo_id in objects for depth in range(1, 6)}
+    return sorted(toms), words
+
+
+def philo_type(philo_id):
+    return OBJECT_LEVELS[philo_id.index(0) - 1] if 0 in philo_id[:7] else "word"
+
+
+def build_db(tmp_path, bits, seed):
+    toms, words = make_ids(bits, seed)
+    conn = sqlite3.connect(str(tmp_path / "toms.db"))
+    for table, philo_ids in (("toms", toms), ("words", words)):
+        conn.execute("CREATE TABLE %s (philo_type TEXT, philo_id TEXT)" % table)
+        conn.executemany(
+            "INSERT INTO %s VALUES (?, ?)" % table,
+            [(philo_type(philo_id), " ".join(map(str, philo_id))) for philo_id in philo_ids],
+        )
+    conn.commit()
+    conn.close()
+    philo_id_keys(SimpleNamespace(destination=str(tmp_path)))
+    return DB(str(tmp_path), cached=False), toms, words
+
+
+@pytest.mark.parametrize("bits", [NARROW_BITS, WIDEST_BITS])
+def test_keys_pack_philo_ids(tmp_path, bits):
+    db, _, _ = build_db(tmp_path, bits, 1)
+    assert db.philo_key_shifts == [sum(bits[position + 1 :]) for position in range(7)]
+    for table in ("toms", "words"):
+        for philo_id, philo_key in db.dbh.execute("SELECT philo_id, philo_key FROM %s" % table):
+            assert db.philo_key(philo_id.split()[:7]) == philo_key
+        philo_ids = [philo_id for philo_id, in db.dbh.execute("SELECT philo_id FROM %s ORDER BY philo_key" % table)]
+        assert philo_ids == sorted(philo_ids, key=lambda philo_id: [int(i) for i in philo_id.split()])
+
+
+@pytest.mark.parametrize("bits", [NARROW_BITS, WIDEST_BITS])
+def test_ranges_match_like(tmp_path, bits):
+    db, toms, words = build_db(tmp_path, bits, 2)
+    prefixes = {philo_id[:depth] for philo_id in toms + words for depth in range(1, 8)}
+    prefixes = {prefix for prefix in prefixes if 0 not in prefix}
+    for prefix in sorted(prefixes):
+        lowest, highest = db.philo_key_range(prefix)
+        padded = " ".join(map(str, prefix + (0,) * (7 - len(prefix))))
+        assert corpus_key_range(db, padded) == (lowest, highest)
+        for table in ("toms", "words"):
+            like = "SELECT philo_id FROM %s WHERE philo_id LIKE ?" % table
+            between = "SELECT philo_id FROM %s WHERE philo_key BETWEEN ? AND ?" % table
+            expected = {philo_id for philo_id, in db.dbh.execute(like, (" ".join(map(str, prefix)) + " %",))}
+            if len(prefix) == 7 and table == "toms":  # whole ids, which LIKE can't match with a trailing space
+                expected = {
+                    philo_id for philo_id, in db.dbh.execute("SELECT philo_id FROM toms WHERE philo_id=?", (padded,))
+                }
+            assert {philo_id for philo_id, in db.dbh.execute(between, (lowest, highest))} == expected
+
+
+def test_values_out_of_range(tmp_path):
+    db, _, _ = build_db(tmp_path, WIDEST_BITS, 3)
+    assert db.philo_key([1 << 20]) is None
+    assert db.philo_key([1, 1 << 10]) is None
+    assert db.philo_key([1, 1, 1, 1, 1, 1, 1 << 10]) is None
+    assert db.philo_key([1, 1, 1, 1, 1, 1, 1, 0, 0]) is not None
+    assert db.philo_key([1, 1, 1, 1, 1, 1, 1, 3, 0]) is None
+    assert db.philo_key_range([1 << 20]) is None
+    assert db.philo_key_range([]) == (0, (1 << 63) - 1)
+
+
+def test_too_wide_to_pack(tmp_path):
+    db, _, _ = build_db(tmp_path, WIDEST_BITS[:6] + [11], 4)
+    assert db.philo_key_shifts is None
+    assert db.philo_key([1, 1]) is None
+    assert "philo_key" not in [row[1] for row in db.dbh.execute("PRAGMA table_info(toms)")]
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Compare in-process term expansion with the egrep pipeline it replaces"""
+
+import os
+import shutil
+import tempfile
+import unicodedata
+
+import pytest
+
+from philologic.loadtime.PostFilters import write_vocabulary
+from philologic.runtime import Query
+from philologic.runtime.QuerySyntax import group_terms, parse_query
+
+WORDS = ["Allons", "allons", "allez", "Aller", "été", "Été", "étais", "l'été", "nous", "vous", "nous-mêmes", "a1b2"]
+
+IN_PROCESS_QUERIES = [
+    "allons",
+    "all.*",
+    "[ae]ll.*",
+    "été",
+    ".*ou.*",
+    "all.* NOT allez",
+    '"Allons"',
+    '"all.*"',
+    '"(Allons|été)"',
+]
+
+# egrep syntax that Python regexes read differently, left to the egrep pipeline
+EGREP_QUERIES = [
+    "[[:alpha:]]ll.*",
+    "a[[:digit:]].*",
+    "(n|v)ou\\1*",
+    "\\<nous",
+    '"Allons|été"',
+    '"[[:upper:]].*"',
+    "all.* NOT [[:alpha:]]llez",
+]
+
+
+@pytest.fixture(scope="module")
+def db_path(tmp_path_factory):
+    if shutil.which("egrep") is None:
+        pytest.skip("egrep is not installed")
+    path = str(tmp_path_factory.mktemp("db"))
+    frequencies = os.path.join(path, "frequencies")
+    os.mkdir(frequencies)
+    vocabulary = []
+    with open(os.path.join(frequencies, "normalized_word_frequencies"), "w") as output:
+        for count, word in enumerate(WORDS, 1):
+            norm_word = "".join(i for i in unicodedata.normalize("NFKD", word.lower()) if not unicodedata.combining(i))
+            print(norm_word + "\t" + word, file=output)
+            vocabulary.append((norm_word.encode("utf8"), word.encode("utf8"), count))
+    write_vocabulary(frequencies, vocabulary)
+    return path
+
+
+def egrep_expansion(split, db_path):
+    with tempfile.TemporaryFile() as dest_fh:
+        Query.expand_query_not(split, os.path.join(db_path, "frequencies", "normalized_word_frequencies"), dest_fh)
+        dest_fh.seek(0)
+        return dest_fh.read()
+
+
+def search_expansion(split, db_path):
+    """The expansion run_search sends to corpus_search"""
+    groups = Query.expand_groups(split, db_path)
+    if groups is None:
+        return egrep_expansion(split, db_path)
+    return Query.format_expanded_query(groups)
+
+
+@pytest.mark.parametrize("query", IN_PROCESS_QUERIES + EGREP_QUERIES)
+def test_expansion_matches_egrep(db_path, query):
+    split = Query.split_terms(group_terms(parse_query(query)))
+    assert search_expansion(split, db_path) == egrep_expansion(split, db_path)
+
+
+@pytest.mark.parametrize("query", IN_PROCESS_QUERIES + EGREP_QUERIES)
+def test_egrep_syntax_falls_back(db_path, query):
+    split = Query.split_terms(group_terms(parse_query(query)))
+    assert (Query.expand_groups(split, db_path) is None) == (query in EGREP_QUERIES)
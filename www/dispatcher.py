@@ -2,15 +2,14 @@
 """Routing for PhiloLogic4."""
 
 
-import datetime
 import os
 from asyncio import get_event_loop
 from cgi import FieldStorage
-from random import randint
-from glob import glob
 from wsgiref.handlers import CGIHandler
 
 from philologic.runtime import WebConfig, WSGIHandler
+from philologic.runtime.HitlistCache import get_cache
+from philologic.runtime.RowCache import get_row_cache
 
 import reports
 from webApp import angular
@@ -21,8 +20,12 @@ path = os.path.abspath(os.path.dirname(__file__))
 def philo_dispatcher(environ, start_response):
     """Dispatcher function."""
     loop = get_event_loop()
-    clean_task = loop.create_task(clean_up())
     config = WebConfig(path)
+    try:
+        get_row_cache(os.path.join(path, "data"), config.row_cache_size)
+    except AttributeError:  # broken web_config.cfg
+        pass
+    clean_task = loop.create_task(clean_up(config))
     request = WSGIHandler(environ, config)
     response = ""
     if request.content_type == "application/json" or request.format == "json":
@@ -44,15 +47,16 @@ def philo_dispatcher(environ, start_response):
     loop.run_until_complete(clean_task)
 
 
-async def clean_up():
-    """clean-up hitlist every now and then"""
-    rand = randint(0, 10)
-    if rand == 1:
-        hit_list_path = os.path.join(path, "data/hitlists/*")
-        for filename in glob(hit_list_path):
-            file_modified = datetime.datetime.fromtimestamp(os.path.getmtime(filename))
-            if datetime.datetime.now() - file_modified > datetime.timedelta(minutes=10):
-                os.remove(filename)
+async def clean_up(config):
+    """Sweep the hitlist cache once the configured interval has elapsed"""
+    try:
+        max_bytes = config.hitlist_cache_size * 1024 * 1024
+        interval = config.hitlist_cache_sweep_interval
+        max_age = config.hitlist_cache_max_age
+        policy = config.hitlist_cache_policy
+    except AttributeError:  # broken web_config.cfg
+        return
+    get_cache(os.path.join(path, "data/hitlists")).sweep_if_due(interval, max_bytes, max_age, policy)
 
 
 if __name__ == "__main__":
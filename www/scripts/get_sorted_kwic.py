@@ -57,6 +57,7 @@ def get_sorted_hits(all_results, sort_keys, request, config, db, start, end):
     kwic_object['results'] = kwic_results
     kwic_object['results_length'] = len(hits)
     kwic_object["query_done"] = hits.done
+    kwic_object["results_truncated"] = hits.truncated
 
     return kwic_object
 
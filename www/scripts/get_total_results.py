@@ -35,6 +35,9 @@ def get_total_results(environ, start_response):
     else:
         hits = db.query(request["q"], request["method"], request["arg"],
                         **request.metadata)
+    if request.estimate:
+        yield json.dumps(hits.estimate_length()._asdict()).encode('utf8')
+        return
     total_results = 0
     hits.finish()
     total_results = len(hits)